@@ -1,36 +1,119 @@
 #!/usr/bin/env python
 
+import argparse
 import asyncio
 import logging
 import os
-import sys
 
-from scarchive import Archive, Client
+from scarchive import AsyncArchive, Client
 
 
-async def main(archive, client, url):
-    crawl_for_user = await client.resolve_user(url)
-    async for user in client.crawl_user_followings(crawl_for_user.id):
-        if archive.find_user(user.id) is None:
-            archive.add_user(user)
-            logging.info("username={} user_id={} Added user".format(user.username, user.id))
-        else:
-            logging.debug("username={} user_id={} User exists".format(user.username, user.id))
+# Crawl the following graph outwards from seed_urls, adding every user found to the archive. Seeds are at depth 0,
+# and only users shallower than max_depth have their followings crawled, so max_depth=1 adds just the seeds'
+# followings. The frontier is kept in the archive, so an interrupted crawl can be picked up again with resume=True.
+async def main(archive, client, seed_urls, max_depth=1, num_workers=8, resume=False):
+    queue = asyncio.Queue()
+    async with archive.buffered_writer() as writer:
+        if not resume:
+            await archive.clear_frontier()
+            for user in await resolve_seeds(client, seed_urls):
+                await writer.add_user(user)
+                await writer.add_frontier(user.id, 0)
+            await writer.flush()
+
+        # Everything that's ever been in the frontier has been visited; what isn't done yet still needs expanding.
+        # visited maps each user to the shallowest depth they've been found at.
+        frontier = await archive.list_frontier()
+        visited = dict((user_id, depth) for user_id, depth, _ in frontier)
+        for user_id, depth, done in frontier:
+            if not done:
+                queue.put_nowait((user_id, depth))
+        logging.info("visited_count={} queued_count={} Starting following crawl".format(len(visited), queue.qsize()))
+
+        workers = [
+            asyncio.ensure_future(expand_users(client, writer, queue, visited, max_depth, worker_id))
+            for worker_id in range(num_workers)]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+
+
+async def resolve_seeds(client, seed_urls):
+    users = await asyncio.gather(*[client.resolve_user(url) for url in seed_urls], return_exceptions=True)
+    for url, user in zip(seed_urls, users):
+        if isinstance(user, Exception):
+            logging.error("url={} Failed to resolve seed user: {}".format(url, user))
+    return [user for user in users if not isinstance(user, Exception)]
+
+
+async def expand_users(client, writer, queue, visited, max_depth, worker_id):
+    while True:
+        user_id, depth = await queue.get()
+        if visited[user_id] < depth:
+            # Found shallower since it was queued; that expansion is queued too.
+            queue.task_done()
+            continue
+        try:
+            await expand_user(client, writer, queue, visited, user_id, depth, max_depth)
+            logging.info("user_id={} depth={} worker_id={} Expanded user".format(user_id, depth, worker_id))
+        except Exception as e:
+            # Leave the user unfinished in the frontier, so a resumed crawl tries again.
+            logging.error("user_id={} depth={} worker_id={} Failed to expand user: {}".format(user_id, depth, worker_id, e))
+        queue.task_done()
+
+
+# Add user_id's followings, and queue those shallower than max_depth for expanding. Workers run concurrently, so a
+# user can be found at a shallower depth after they've already been found (or even expanded) at a deeper one; they're
+# then expanded again, so everything within max_depth of the seeds is reached however the crawl was ordered.
+async def expand_user(client, writer, queue, visited, user_id, depth, max_depth):
+    added_count = 0
+    async for users in client.crawl_user_following_pages(user_id):
+        for user in users:
+            previous_depth = visited.get(user.id)
+            if previous_depth is not None and previous_depth <= depth + 1:
+                continue
+            visited[user.id] = depth + 1
+            if previous_depth is None:
+                await writer.add_user(user)
+                added_count += 1
+            if depth + 1 < max_depth:
+                await writer.add_frontier(user.id, depth + 1)
+                await queue.put((user.id, depth + 1))
+    await writer.finish_frontier(user_id, depth)
+    logging.debug("user_id={} added_count={} Added followings".format(user_id, added_count))
+
+
+def read_seed_urls(args):
+    seed_urls = list(args.urls)
+    if args.seeds_file:
+        with open(args.seeds_file) as f:
+            seed_urls.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return seed_urls
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the users followed by one or more Soundcloud users.")
+    parser.add_argument("urls", nargs="*", metavar="URL", help="seed profile URL, e.g. https://soundcloud.com/username")
+    parser.add_argument("--seeds-file", help="file of seed profile URLs, one per line")
+    parser.add_argument("--depth", type=int, default=1, help="how many hops of followings to add (default: 1)")
+    parser.add_argument("--workers", type=int, default=8, help="number of users to expand concurrently")
+    parser.add_argument("--resume", action="store_true", help="continue the previous, interrupted crawl")
+    args = parser.parse_args()
 
-    if len(sys.argv) != 2:
-        print("USAGE: {} https://soundcloud.com/username".format(sys.argv[0]))
-        sys.exit(1)
+    seed_urls = read_seed_urls(args)
+    if not seed_urls and not args.resume:
+        parser.print_usage()
+        parser.exit(1)
 
-    archive = Archive(db_file=os.environ.get("SC_ARCHIVE_DB", "archive.db"))
+    archive = AsyncArchive(db_file=os.environ.get("SC_ARCHIVE_DB", "archive.db"))
     client = Client(client_id=os.environ.get("SC_CLIENT_ID"))
     logging.basicConfig(level=logging.INFO)
 
     try:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(main(archive, client, sys.argv[1]))
+        loop.run_until_complete(main(archive, client, seed_urls, args.depth, args.workers, args.resume))
     finally:
+        loop.run_until_complete(client.close())
+        loop.run_until_complete(archive.close())
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from scarchive import AsyncArchive, Client
+from scarchive.fake_soundcloud import FakeSoundcloud
+
+import add_user_followings
+
+
+class AddUserFollowingsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.work_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.work_dir, "archive.db")
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.work_dir)
+
+    # Each of users 1..20 follows the next two. From user 1 with max_depth=2, users 1, 2 and 3 are expanded, and
+    # their followings 4 and 5 are added without being expanded. 3 is followed twice but only added once.
+    def test_crawl(self):
+        server = FakeSoundcloud(num_users=20, followings_per_user=2)
+
+        async def test():
+            await server.start()
+            archive = AsyncArchive(self.db_file)
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    await add_user_followings.main(
+                        archive, client, ["https://soundcloud.com/user1"], max_depth=2, num_workers=4)
+                    self.assertEqual([user.id async for user in archive.list_all_users()], [1, 2, 3, 4, 5])
+                    self.assertEqual(await archive.list_frontier(), [(1, 0, 1), (2, 1, 1), (3, 1, 1)])
+                    # One resolve, and one followings page for each expanded user.
+                    self.assertEqual(server.requests, 4)
+
+                    # Interrupted before user 3 was expanded: resuming only expands 3.
+                    await archive.clear_frontier()
+                    await archive.write_rows([], [], [(1, 0), (2, 1), (3, 1)], [(1, 0), (2, 1)])
+                    await add_user_followings.main(archive, client, [], max_depth=2, num_workers=4, resume=True)
+                    self.assertEqual(await archive.list_frontier(), [(1, 0, 1), (2, 1, 1), (3, 1, 1)])
+                    self.assertEqual(server.requests, 5)
+            finally:
+                await archive.close()
+                await server.stop()
+
+        self.loop.run_until_complete(test())
+
+    # Seeds 1 and 3, with 3's followings slow to arrive: 4 is first found through 1 -> 2 -> 4, at max_depth, but 3 ->
+    # 4 is shorter, so 4 still gets expanded.
+    def test_crawl_finds_shorter_paths(self):
+        server = FakeSoundcloud(num_users=20, followings_per_user=2)
+
+        async def test():
+            await server.start()
+            archive = AsyncArchive(self.db_file)
+            try:
+                async with SlowClient(client_id="test") as client:
+                    client.base_url = server.url
+                    client.slow_user_ids = {3}
+                    await add_user_followings.main(
+                        archive, client, ["https://soundcloud.com/user1", "https://soundcloud.com/user3"],
+                        max_depth=2, num_workers=4)
+                    self.assertEqual([user.id async for user in archive.list_all_users()], [1, 2, 3, 4, 5, 6, 7])
+                    self.assertEqual(await archive.list_frontier(),
+                                     [(1, 0, 1), (3, 0, 1), (2, 1, 1), (4, 1, 1), (5, 1, 1)])
+            finally:
+                await archive.close()
+                await server.stop()
+
+        self.loop.run_until_complete(test())
+
+
+class SlowClient(Client):
+
+    slow_user_ids = ()
+
+    async def crawl_user_following_pages(self, user_id):
+        if user_id in self.slow_user_ids:
+            await asyncio.sleep(0.2)
+        async for page in super().crawl_user_following_pages(user_id):
+            yield page
+
+
+if __name__ == "__main__":
+    unittest.main()
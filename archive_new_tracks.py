@@ -2,133 +2,509 @@
 
 import aiohttp
 import asyncio
+import json
 import logging
+import multiprocessing
 import os
+import time
 
-from mutagen import MutagenError
-from mutagen.id3 import APIC, TALB, TPE1, TIT2, ID3
-from mutagen.mp3 import MP3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from scarchive import Archive, Client
+from scarchive import (ArtworkCache, AsyncArchive, Client, CrawlScheduler, CrawlState, Job, JobQueue, Metrics,
+                       RequestBudget, TrackStore)
+from scarchive.dedup import HashingFile, hash_audio_file, link_duplicate
+from scarchive.tagging import artwork_url, build_id3_tag, id3_tag_size, tag_track_file
 
-async def crawl_tracks(client, archive, userq, trackq, worker_id):
+
+# Crawl users from the job queue, highest priority first, until there are none left or the run (across every worker
+# process) has spent its request budget. The budget is checked before each crawl, so crawls already under way can
+# take the run a little over it.
+async def crawl_tracks(client, archive, jobs, worker_id, scheduler, budget=None):
     while True:
-        user = await userq.get()
-        new_tracks_count = await crawl_new_tracks(client, archive, trackq, user)
-        logging.info("user_id={} new_tracks_count={} worker_id={} Finished new crawling tracks".format(user.id, new_tracks_count, worker_id))
-        userq.task_done()
+        if budget is not None and await budget.spent():
+            # The rest stay due, so the next run picks them up, with higher priority for having waited.
+            cancelled_count = await jobs.cancel_pending(Job.CRAWL_USER)
+            if cancelled_count:
+                logging.info("request_budget={} cancelled_count={} Request budget spent, leaving the rest for the next run".format(budget.budget, cancelled_count))
+            return
+        job = await jobs.claim_next(Job.CRAWL_USER, [Job.CRAWL_USER])
+        if job is None:
+            return
+        with jobs.metrics.busy("crawl"):
+            try:
+                new_tracks_count = await crawl_new_tracks(client, archive, jobs, job.key, scheduler)
+                await jobs.complete(job)
+                logging.info("user_id={} new_tracks_count={} worker_id={} Finished new crawling tracks".format(job.key, new_tracks_count, worker_id))
+            except Exception as e:
+                logging.error("user_id={} worker_id={} Failed to crawl tracks: {}".format(job.key, worker_id, e))
+                await jobs.fail(job, e)
+
+
+async def crawl_new_tracks(client, archive, jobs, user_id, scheduler):
+    state = await archive.find_crawl_state(user_id) or CrawlState(user_id)
+
+    # One cheap request tells us whether the user has anything new: either the profile is unchanged (304), or
+    # its track_count matches what we saw last time. If the request fails outright, fall back to crawling.
+    track_count, etag, not_modified = await client.fetch_user_track_count(user_id, etag=state.etag)
+    if not_modified or (track_count is not None and track_count == state.track_count):
+        logging.debug("user_id={} track_count={} No new tracks for user".format(user_id, state.track_count))
+        now = time.time()
+        await archive.update_crawl_status(user_id, state.track_count, etag, now, scheduler.next_check_at(state, now))
+        return 0
+
+    logging.info("user_id={} since={} Crawling new tracks for user".format(user_id, state.last_track_created_at))
+    # On a user's first crawl, knowing track_count lets several pages be fetched at once.
+    new_tracks = await queue_new_tracks(
+        client, archive, jobs, user_id, since=state.last_track_created_at, total=track_count)
+
+    # New tracks update the user's upload cadence, which decides when they're next checked.
+    now = time.time()
+    if new_tracks:
+        state.upload_interval = scheduler.upload_interval(state, new_tracks)
+        state.last_new_track_at = now
+        state.last_track_created_at = max([state.last_track_created_at or ""] +
+                                          [track.created_at for track in new_tracks if track.created_at])
+    await archive.update_crawl_status(user_id, track_count, etag, now, scheduler.next_check_at(state, now),
+                                      state.upload_interval, state.last_new_track_at)
+    return len(new_tracks)
+
+
+# Queue download jobs for user_id's tracks that aren't in the archive yet, and return them. Because jobs are
+# durable, the crawl state can safely be updated as soon as this returns.
+async def queue_new_tracks(client, archive, jobs, user_id, since, total=None):
+    all_new_tracks = []
+    pages = client.crawl_user_track_pages(user_id, since=since, total=total)
+    try:
+        async for tracks in pages:
+            known_track_ids = await archive.known_track_ids(track.id for track in tracks)
+            new_tracks = [track for track in tracks if track.id not in known_track_ids]
+            await queue_downloads(jobs, new_tracks)
+            all_new_tracks.extend(new_tracks)
+            # Without a high-water mark, the first archived track is where the last crawl got to. With one, the
+            # archived tracks are those from the same second as it, and crawling stops by itself past them.
+            if since is None and len(new_tracks) < len(tracks):
+                break
+    finally:
+        # Stop any pages still being fetched ahead.
+        await pages.aclose()
+    return all_new_tracks
 
 
-async def crawl_new_tracks(client, archive, queue, user):
-    logging.info("user_id={} Crawling new tracks for user".format(user.id))
-    new_tracks_count = 0
-    async for track in client.crawl_user_tracks(user.id):
-        if archive.find_track(track.id):
-            return new_tracks_count
-        await queue.put(track)
-        new_tracks_count += 1
+# Queue download jobs for tracks. Downloads that already finished aren't repeated, but failed ones are retried.
+async def queue_downloads(jobs, tracks):
+    await jobs.enqueue(Job.DOWNLOAD_TRACK, ((track.id, Job.track_payload(track)) for track in tracks), requeue=("failed",))
 
 
-async def archive_tracks(client, archive, queue, worker_id, base_dir):
+# Partial downloads which start with an inline ID3 tag get their own suffix, so they're never resumed as plain audio.
+PART_SUFFIX = ".mp3.part"
+INLINE_TAGS_PART_SUFFIX = ".mp3.id3.part"
+# A partial file's ETag is kept next to it, so a resumed download only appends to the same version of the track.
+ETAG_SUFFIX = ".etag"
+
+
+async def archive_tracks(client, archive, artwork_cache, jobs, tagq, worker_id, store, inline_tags, dedup):
+    while True:
+        # Crawl jobs still in progress may queue more downloads, so wait for them before giving up.
+        job = await jobs.claim_next(Job.DOWNLOAD_TRACK, [Job.CRAWL_USER, Job.DOWNLOAD_TRACK])
+        if job is None:
+            return
+        track = job.track()
+        with jobs.metrics.busy("download"):
+            try:
+                track.uri = await download_track(track, client, artwork_cache, store, inline_tags)
+            except Exception as e:
+                track.uri = None
+                logging.error("user_id={} track_id={} worker_id={} Failed to download track: {}".format(track.user_id, track.id, worker_id, e))
+        if track.uri is None:
+            # The partial file is kept, so the retry resumes where this attempt left off.
+            await jobs.fail(job, "download failed")
+        elif dedup and await link_duplicate_track(archive, store, track):
+            # The file is now shared with an identical track that's already archived (and tagged).
+            await add_archived_track(archive, track, worker_id)
+            await jobs.complete(job)
+        elif inline_tags:
+            # Tracks tagged while downloading skip the tagging stage.
+            await add_archived_track(archive, track, worker_id)
+            await jobs.complete(job)
+        else:
+            await tagq.put((job, track))
+
+
+# Tag downloaded tracks on executor, so that parsing and rewriting MP3s doesn't block the event loop.
+async def tag_tracks(artwork_cache, archive, jobs, queue, executor, worker_id):
+    loop = asyncio.get_event_loop()
     while True:
-        track = await queue.get()
-        track.uri = await download_track(track, client, base_dir)
-        if track.uri is not None:
-            await add_tags_to_track_file(track.uri, track)
-            archive.add_track(track)
-            logging.info("user_id={} track_id={} worker_id={} Archived track".format(track.user_id, track.id, worker_id))
+        job, track = await queue.get()
+        with jobs.metrics.busy("tag"):
+            try:
+                artwork = await fetch_artwork(artwork_cache, track)
+                with jobs.metrics.timer("tag_seconds"):
+                    await loop.run_in_executor(executor, tag_track_file, track.uri, track, artwork)
+                await add_archived_track(archive, track, worker_id)
+                await jobs.complete(job)
+            except Exception as e:
+                logging.error("user_id={} track_id={} worker_id={} Failed to tag track: {}".format(track.user_id, track.id, worker_id, e))
+                await jobs.fail(job, e)
         queue.task_done()
 
 
-async def download_track(track, client, base_dir):
-    # Tracks are saved to disk at base_dir/user_id/track_id.mp3.
-    user_dir = "/".join([base_dir, str(track.user_id)])
-    track_file = "{}/{}.mp3".format(user_dir, track.id)
-    # Create user directories if they do not exist.
-    if not os.path.exists(user_dir):
-        os.mkdir(user_dir)
-    with open(track_file, "wb") as fd:
-        # TODO: this could throw an exception (??)
-        await client.save_track_to_file(track, fd)
+# If an archived track has the same audio as track, replace track's file with a hardlink to it. The shared file keeps
+# the first track's tags. Returns True if the file was linked.
+async def link_duplicate_track(archive, store, track):
+    for original in await archive.find_tracks_by_sha256(track.sha256):
+        if original.id != track.id and await store.run(link_duplicate, original.uri, track.uri):
+            logging.info("user_id={} track_id={} original_track_id={} Linked duplicate track".format(
+                track.user_id, track.id, original.id))
+            return True
+    return False
+
+
+async def add_archived_track(archive, track, worker_id):
+    await archive.add_track(track)
+    await archive.advance_crawl_mark(track)
+    logging.info("user_id={} track_id={} worker_id={} Archived track".format(track.user_id, track.id, worker_id))
+
+
+async def fetch_artwork(artwork_cache, track):
+    url = artwork_url(track)
+    if url is None:
+        return None
+    try:
+        return await artwork_cache.get(url)
+    except aiohttp.ClientError as e:
+        logging.warning("user_id={} track_id={} url={} Failed to fetch artwork: {}".format(track.user_id, track.id, url, e))
+        return None
+
+
+async def download_track(track, client, artwork_cache, store, inline_tags=False):
+    # Where tracks are saved on disk is up to store's layout.
+    await store.make_user_dir(track.user_id)
+    track_file = store.track_path(track.user_id, track.id)
+    # Download to a partial file and only move it into place once it's complete and on disk, so a failed
+    # download never leaves a truncated track_file behind. The partial file is kept on failure, so the next
+    # attempt (or the next run) can resume it.
+    part_file = store.track_path(track.user_id, track.id, INLINE_TAGS_PART_SUFFIX if inline_tags else PART_SUFFIX)
+    etag_file = part_file + ETAG_SUFFIX
+    # The audio is hashed as it's downloaded, starting with whatever an earlier attempt already saved.
+    audio_hash = await store.run(hash_audio_file, part_file)
+    etag = await store.run(read_etag, etag_file)
+    fd = await store.run(open, part_file, "ab")
+    try:
+        audio_fd = await start_inline_tags(fd, track, artwork_cache) if inline_tags else fd
+        audio_fd = HashingFile(audio_fd, audio_hash)
+        saved = await client.save_track_to_file(
+            track, audio_fd, etag, lambda new_etag: store.run(write_etag, etag_file, new_etag))
+        if saved:
+            track.sha256 = audio_fd.audio_hash.hexdigest()
+            fd.flush()
+            await store.run(os.fsync, fd.fileno())
+    finally:
+        await store.run(fd.close)
+    if not saved:
+        return None
+    await store.run(os.replace, part_file, track_file)
+    await store.run(remove_file, etag_file)
 
     return track_file
 
 
-async def add_tags_to_track_file(track_file, track):
+def read_etag(path):
     try:
-        mp3 = MP3(track_file, ID3=ID3)
-    except Exception as e:
-        logging.warning(
-            "user_id={} track_id={} uri={} Failed to parse MP3 from track file".format(track.user_id, track.id, track.uri))
+        with open(path) as f:
+            return f.read() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_etag(path, etag):
+    with open(path, "w") as f:
+        f.write(etag)
+
+
+# Write the track's ID3 tag at the start of a new partial file (or find the one already there when resuming), and
+# return a file object for the audio that follows it.
+async def start_inline_tags(fd, track, artwork_cache):
+    if fd.seek(0, os.SEEK_END) == 0:
+        fd.write(build_id3_tag(track, await fetch_artwork(artwork_cache, track)))
+        return OffsetFile(fd, fd.tell())
+    with open(fd.name, "rb") as f:
+        return OffsetFile(fd, id3_tag_size(f.read(10)))
+
+
+# A file whose first offset bytes are hidden, so the client sees only the audio after an inline ID3 tag.
+class OffsetFile(object):
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos += self.offset
+        return self.fd.seek(pos, whence) - self.offset
+
+    def tell(self):
+        return self.fd.tell() - self.offset
+
+    def truncate(self):
+        return self.fd.truncate(max(self.fd.tell(), self.offset)) - self.offset
+
+    def write(self, data):
+        return self.fd.write(data)
+
+
+# Find the tracks whose downloads were interrupted, i.e. that have a partial file somewhere in store, under any
+# layout. Returns (track_id, suffix, path)s.
+async def find_partial_downloads(store):
+    return await store.find_files((PART_SUFFIX, INLINE_TAGS_PART_SUFFIX))
+
+
+# Queue up interrupted downloads, so download_track resumes them where they left off. Tracks the job queue already
+# has don't need an API call. Partials are moved to where download_track will look for them; those it can't resume
+# (the track has been archived since, or the partial was started with the other inline_tags setting) are removed.
+async def resume_partial_downloads(client, archive, jobs, store, inline_tags=False):
+    for track_id, suffix, path in await find_partial_downloads(store):
+        job = await archive.find_job(Job.DOWNLOAD_TRACK, track_id)
+        if job is not None and job.state == "done":
+            logging.info("track_id={} path={} Removing partial download of archived track".format(track_id, path))
+            await store.run(remove_partial, path)
+            continue
+        track = job.track() if job is not None else await client.fetch_track(track_id)
+        if track is None:
+            continue
+        if suffix != (INLINE_TAGS_PART_SUFFIX if inline_tags else PART_SUFFIX):
+            logging.info("track_id={} path={} Removing partial download with other inline_tags setting".format(
+                track_id, path))
+            await store.run(remove_partial, path)
+        else:
+            await store.make_user_dir(track.user_id)
+            await store.run(move_partial, path, store.track_path(track.user_id, track.id, suffix))
+            logging.info("user_id={} track_id={} Resuming partial download".format(track.user_id, track.id))
+        await queue_downloads(jobs, [track])
+
+
+# Move the partial download src, and its ETag, to dst, unless dst already exists (e.g. a later attempt under the
+# current layout), in which case src is removed instead.
+def move_partial(src, dst):
+    if src == dst:
         return
-            
-    # Make sure this MP3 has valid ID3 tags header, etc. If the file already
-    # has valid ID3 tags, Mutagen will thrown an Exception, and we'll ignore it!
+    if os.path.exists(dst):
+        remove_partial(src)
+        return
+    os.replace(src, dst)
     try:
-        mp3.add_tags()
-    except MutagenError:
-        logging.warning(
-            "user_id={} track_id={} uri={} Track file already has ID3 tags".format(track.user_id, track.id, track.uri))
-        #pass
+        os.replace(src + ETAG_SUFFIX, dst + ETAG_SUFFIX)
+    except FileNotFoundError:
+        pass
+
 
-    # Set title, artist, and album (which is hardcoded to "Soundcloud Tracks").
-    mp3.tags.add(TIT2(encoding=3, text=track.title))
-    mp3.tags.add(TPE1(encoding=3, text=track.username))
-    mp3.tags.add(TALB(encoding=3, text=u"Soundcloud Tracks"))
+def remove_partial(path):
+    remove_file(path)
+    remove_file(path + ETAG_SUFFIX)
 
-    # Add artwork if the track has it. We use the 500x500 image variant rather than the "large" default.
-    if track.artwork_url:
-        artwork_url = track.artwork_url.replace("-large.jpg", "-t500x500.jpg")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(artwork_url) as r:
-                mp3.tags.add(APIC(encoding=3, mime="image/jpeg", type=3, data=await r.read()))
 
-    mp3.save()
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
-async def main(archive, client, archive_dir):
-    # Create a queue and consumers to archive tracks from the queue.
-    user_queue = asyncio.Queue(maxsize=25)
-    tracks_queue = asyncio.Queue(maxsize=100)
+# Users whose crawl jobs are in one of these states are queued again with their new priority. That includes pending
+# jobs, which a run that ran out of request budget may have left behind.
+CRAWL_REQUEUE = ("pending", "cancelled", "done", "failed")
 
-    user_workers = [
-        asyncio.ensure_future(crawl_tracks(client, archive, user_queue, tracks_queue, worker_id))
-        for worker_id in range(8)]
 
-    archive_workers = [
-        asyncio.ensure_future(archive_tracks(client, archive, tracks_queue, worker_id, archive_dir))
-        for worker_id in range(4)]
+# Start a run: queue crawls of the users that are due to be checked, with their priorities, and resume partial
+# downloads. This runs once per run, before any worker processes start.
+async def enqueue(archive, client, store, batch_size=500, scheduler=None, inline_tags=False):
+    scheduler = scheduler or CrawlScheduler()
+    now = time.time()
+    due_count = 0
+    await RequestBudget.reset(archive)
+    async with JobQueue(archive) as jobs:
+        await resume_partial_downloads(client, archive, jobs, store, inline_tags)
+        crawls = []
+        async for state in archive.list_due_crawl_states(now):
+            crawls.append((state.user_id, None, scheduler.priority(state, now)))
+            if len(crawls) >= batch_size:
+                await jobs.enqueue(Job.CRAWL_USER, crawls, requeue=CRAWL_REQUEUE)
+                due_count += len(crawls)
+                crawls = []
+        await jobs.enqueue(Job.CRAWL_USER, crawls, requeue=CRAWL_REQUEUE)
+        due_count += len(crawls)
+    logging.info("due_count={} Queued crawls of due users".format(due_count))
 
-    # Find new tracks for users in the archive and add them to the queue.
-    for user in archive.list_all_users():
-        #crawl_new_tracks(client, archive, tracks_queue, user)
-        await user_queue.put(user)
 
-    # Wait until they've all been archived, then clean up.
-    await user_queue.join()
-    for worker in user_workers:
-        worker.cancel()
+# Work through the job queue until there's nothing left to crawl or download. Several processes can run this
+# against the same archive at once.
+async def main(archive, client, artwork_cache, store, num_crawl_workers=8, num_archive_workers=4,
+               num_tag_workers=2, tag_executor=None, inline_tags=False, metrics=None, dedup=True, scheduler=None,
+               request_budget=None):
+    tag_queue = asyncio.Queue(maxsize=100)
+    tag_executor = tag_executor or ThreadPoolExecutor(max_workers=num_tag_workers)
+    scheduler = scheduler or CrawlScheduler()
+    budget = RequestBudget(archive, client, request_budget) if request_budget else None
 
-    await tracks_queue.join()
-    for worker in archive_workers:
-        worker.cancel()
+    metrics = metrics or Metrics()
+    for stage, count in (("crawl", num_crawl_workers), ("download", num_archive_workers), ("tag", num_tag_workers)):
+        metrics.set("workers", count, stage=stage)
+    metrics.add_collector(lambda m: m.set("queue_depth", tag_queue.qsize(), queue="tag"))
+    metrics.add_collector(lambda m: collect_artwork_stats(m, artwork_cache))
+    samplers = [asyncio.ensure_future(sample_job_counts(archive, metrics)),
+                asyncio.ensure_future(metrics.sample_loop_lag())]
 
+    async with JobQueue(archive, metrics=metrics) as jobs:
+        tag_workers = [
+            asyncio.ensure_future(tag_tracks(artwork_cache, archive, jobs, tag_queue, tag_executor, worker_id))
+            for worker_id in range(num_tag_workers)]
+
+        # These only cap concurrency; the client's rate limiters decide how many requests are actually in flight.
+        await asyncio.gather(*(
+            [crawl_tracks(client, archive, jobs, worker_id, scheduler, budget)
+             for worker_id in range(num_crawl_workers)] +
+            [archive_tracks(client, archive, artwork_cache, jobs, tag_queue, worker_id, store, inline_tags, dedup)
+             for worker_id in range(num_archive_workers)]))
+
+        # Wait until they've all been archived, then clean up.
+        await tag_queue.join()
+        for worker in tag_workers:
+            worker.cancel()
+        tag_executor.shutdown()
+
+    for sampler in samplers:
+        sampler.cancel()
+    logging.info("stats={} Artwork cache stats".format(json.dumps(artwork_cache.stats())))
+
+
+def collect_artwork_stats(metrics, artwork_cache):
+    for name, value in artwork_cache.stats().items():
+        if value is not None:
+            metrics.set("artwork_cache_" + name, value)
+
+
+# Sample the job queue's depth (jobs by kind and state) into metrics every interval seconds. This is a query, so it's
+# done periodically rather than on every render.
+async def sample_job_counts(archive, metrics, interval=5):
+    while True:
+        try:
+            for (kind, state), count in (await archive.count_jobs()).items():
+                metrics.set("jobs", count, kind=kind, state=state)
+        except Exception as e:
+            logging.error("Failed to sample job counts: {}".format(e))
+        await asyncio.sleep(interval)
+
+
+# Expose metrics as configured: a Prometheus endpoint on SC_METRICS_PORT (plus worker_index, so each worker process
+# gets its own port), and/or JSON snapshots appended to SC_METRICS_FILE. Returns the tasks and servers to clean up.
+async def report_metrics(metrics, config, worker_index=0):
+    runners, tasks = [], []
+    if config["metrics_port"]:
+        runners.append(await metrics.serve(port=config["metrics_port"] + worker_index))
+    if config["metrics_file"]:
+        tasks.append(asyncio.ensure_future(metrics.write_snapshots(config["metrics_file"], config["metrics_interval"])))
+    return runners, tasks
 
-if __name__ == "__main__":
-    # TODO: better logging configuration.
-    logging.basicConfig(level=logging.INFO)
 
-    archive_db = os.environ.get("SC_ARCHIVE_DB", "archive.db")
-    archive_dir = os.environ.get("SC_ARCHIVE_DIR", "data")
-    archive = Archive(db_file=archive_db)
+def read_config():
+    return {
+        "archive_db": os.environ.get("SC_ARCHIVE_DB", "archive.db"),
+        "archive_dir": os.environ.get("SC_ARCHIVE_DIR", "data"),
+        # New downloads are saved with this layout; tracks.uri remembers where earlier ones went.
+        "storage_layout": os.environ.get("SC_STORAGE_LAYOUT", "sharded"),
+        "client_id": os.environ.get("SC_CLIENT_ID"),
+        "api_rate": float(os.environ.get("SC_API_RATE", 10)),
+        "download_rate": float(os.environ.get("SC_DOWNLOAD_RATE", 4)),
+        "num_processes": int(os.environ.get("SC_WORKER_PROCESSES", 1)),
+        "num_crawl_workers": int(os.environ.get("SC_CRAWL_WORKERS", 16)),
+        "num_archive_workers": int(os.environ.get("SC_ARCHIVE_WORKERS", 8)),
+        # Tagging runs on threads by default; SC_TAG_EXECUTOR=process moves it to separate processes.
+        "num_tag_workers": int(os.environ.get("SC_TAG_WORKERS", 2)),
+        "tag_executor": os.environ.get("SC_TAG_EXECUTOR", "thread"),
+        "inline_tags": os.environ.get("SC_INLINE_TAGS", "0") == "1",
+        # Tracks with the same audio as an archived one are stored as hardlinks to it.
+        "dedup": os.environ.get("SC_DEDUP", "1") == "1",
+        # Users are checked for new tracks as often as their upload cadence calls for, within these bounds (seconds).
+        "min_check_interval": float(os.environ.get("SC_MIN_CHECK_INTERVAL", 60 * 60)),
+        "max_check_interval": float(os.environ.get("SC_MAX_CHECK_INTERVAL", 30 * 24 * 60 * 60)),
+        # API requests each run may make crawling, shared by all the worker processes; 0 means no limit.
+        "request_budget": int(os.environ.get("SC_REQUEST_BUDGET", 0)),
+        "artwork_cache_dir": os.environ.get("SC_ARTWORK_CACHE_DIR", "artwork"),
+        "artwork_cache_bytes": int(os.environ.get("SC_ARTWORK_CACHE_BYTES", 1024 ** 3)),
+        "metrics_port": int(os.environ.get("SC_METRICS_PORT", 0)),
+        "metrics_file": os.environ.get("SC_METRICS_FILE"),
+        "metrics_interval": float(os.environ.get("SC_METRICS_INTERVAL", 10)),
+    }
 
-    client_id = os.environ.get("SC_CLIENT_ID")
-    client = Client(client_id=client_id)
 
+# Set up an archive, client and event loop from config, and run coro_fn(archive, client, artwork_cache, metrics) on it.
+def run(config, coro_fn):
+    metrics = Metrics()
+    archive = AsyncArchive(db_file=config["archive_db"], cache_ids=True, metrics=metrics)
+    client = Client(client_id=config["client_id"], api_rate=config["api_rate"], download_rate=config["download_rate"],
+                    metrics=metrics)
+    artwork_cache = ArtworkCache(
+        archive, client, cache_dir=config["artwork_cache_dir"], max_bytes=config["artwork_cache_bytes"])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     try:
-        loop = asyncio.get_event_loop()
         loop.set_debug(enabled=True)
-        loop.run_until_complete(main(archive, client, archive_dir))
+        loop.run_until_complete(coro_fn(archive, client, artwork_cache, metrics))
     finally:
+        loop.run_until_complete(client.close())
+        loop.run_until_complete(archive.close())
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
+
+
+def open_store(config):
+    return TrackStore.for_layout(config["storage_layout"], config["archive_dir"])
+
+
+def open_scheduler(config):
+    return CrawlScheduler(min_interval=config["min_check_interval"], max_interval=config["max_check_interval"])
+
+
+def run_worker(config, worker_index=0):
+    logging.basicConfig(level=logging.INFO)
+
+    if config["tag_executor"] == "process":
+        tag_executor = ProcessPoolExecutor(max_workers=config["num_tag_workers"])
+    else:
+        tag_executor = ThreadPoolExecutor(max_workers=config["num_tag_workers"])
+
+    async def work(archive, client, artwork_cache, metrics):
+        runners, tasks = await report_metrics(metrics, config, worker_index)
+        try:
+            await main(archive, client, artwork_cache, open_store(config), config["num_crawl_workers"],
+                       config["num_archive_workers"], config["num_tag_workers"], tag_executor, config["inline_tags"],
+                       metrics, config["dedup"], open_scheduler(config), config["request_budget"])
+        finally:
+            for task in tasks:
+                task.cancel()
+            for runner in runners:
+                await runner.cleanup()
+
+    run(config, work)
+
+
+if __name__ == "__main__":
+    # TODO: better logging configuration.
+    logging.basicConfig(level=logging.INFO)
+
+    config = read_config()
+    run(config, lambda archive, client, artwork_cache, metrics: enqueue(
+        archive, client, open_store(config), scheduler=open_scheduler(config), inline_tags=config["inline_tags"]))
+
+    # SC_WORKER_PROCESSES > 1 spreads the work over several processes, which claim jobs from the same archive.
+    if config["num_processes"] > 1:
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=run_worker, args=(config, worker_index))
+                     for worker_index in range(config["num_processes"])]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        run_worker(config)
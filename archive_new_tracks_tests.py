@@ -0,0 +1,184 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from scarchive import ArtworkCache, AsyncArchive, Client, Job, JobQueue, ShardedTrackStore, Track, TrackStore, User
+from scarchive.fake_soundcloud import FakeSoundcloud
+
+import archive_new_tracks
+
+DAY = 24 * 60 * 60
+
+
+def created_at(timestamp):
+    return time.strftime("%Y/%m/%d %H:%M:%S +0000", time.gmtime(timestamp))
+
+
+class ArchiveNewTracksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.work_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.work_dir, "archive.db")
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.work_dir)
+
+    # Only due users are queued: never crawled users first, then by how many uploads they're likely to have made.
+    def test_enqueue_priorities(self):
+        now = time.time()
+
+        async def test():
+            archive = AsyncArchive(self.db_file, readers=0)
+            try:
+                await archive.add_users([User(x, "user {}".format(x), "user{}".format(x), None) for x in range(1, 5)])
+                # Active: uploads daily, last checked two days ago. Quiet: nothing in two months.
+                await archive.advance_crawl_mark(self.__make_track(2, now - DAY))
+                await archive.update_crawl_status(2, 10, None, now - 2 * DAY, now - DAY, DAY, now - 2 * DAY)
+                await archive.advance_crawl_mark(self.__make_track(3, now - 60 * DAY))
+                await archive.update_crawl_status(3, 10, None, now - 2 * DAY, now - DAY, DAY, now - 60 * DAY)
+                # Not due until tomorrow.
+                await archive.update_crawl_status(4, 10, None, now - DAY, now + DAY, DAY, now - DAY)
+
+                async with Client(client_id="test") as client:
+                    await archive_new_tracks.enqueue(archive, client, TrackStore(self.work_dir))
+                claimed = []
+                async with JobQueue(archive) as jobs:
+                    job = await jobs.claim(Job.CRAWL_USER)
+                    while job is not None:
+                        claimed.append(job.key)
+                        job = await jobs.claim(Job.CRAWL_USER)
+                self.assertEqual(claimed, [1, 2, 3])
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    # The request budget is shared by every worker process, and only the pending crawls left once it's spent are
+    # cancelled. The downloads of the users that were crawled still finish.
+    def test_request_budget_is_shared(self):
+        server = FakeSoundcloud(num_users=10, tracks_per_user=3, track_size=4096, artwork_size=1024)
+
+        store = TrackStore(os.path.join(self.work_dir, "data"))
+
+        # Stands in for one worker process, with its own archive connection and client.
+        async def run_worker(archive):
+            async with Client(client_id="test") as client:
+                client.base_url = server.url
+                artwork_cache = ArtworkCache(archive, client, cache_dir=os.path.join(self.work_dir, "artwork"))
+                await archive_new_tracks.main(archive, client, artwork_cache, store, num_crawl_workers=1,
+                                              num_archive_workers=1, num_tag_workers=1, request_budget=8)
+
+        async def test():
+            await server.start()
+            archives = [AsyncArchive(self.db_file, readers=0) for _ in range(2)]
+            try:
+                await archives[0].add_users([User.from_json(server.user_json(x)) for x in server.user_ids()])
+                async with Client(client_id="test") as client:
+                    await archive_new_tracks.enqueue(archives[0], client, store)
+                await asyncio.wait_for(asyncio.gather(*[run_worker(archive) for archive in archives]), 30)
+                counts = await archives[0].count_jobs()
+            finally:
+                for archive in archives:
+                    await archive.close()
+                await server.stop()
+
+            # Each crawl makes two requests, so the run stops after four (or five, if two start at once).
+            crawled = counts[(Job.CRAWL_USER, "done")]
+            self.assertIn(crawled, (4, 5))
+            self.assertEqual(counts[(Job.CRAWL_USER, "cancelled")], 10 - crawled)
+            self.assertEqual(counts[(Job.DOWNLOAD_TRACK, "done")], 3 * crawled)
+
+        self.loop.run_until_complete(test())
+
+    # Tracks from the same second as the high-water mark are queued, unless they're already archived.
+    def test_queue_new_tracks_since(self):
+        server = FakeSoundcloud(num_users=1, tracks_per_user=5)
+
+        async def test():
+            await server.start()
+            archive = AsyncArchive(self.db_file, readers=0)
+            try:
+                await archive.add_tracks([Track.from_json(server.track_json(100004))])
+                since = Track.from_json(server.track_json(100002)).created_at
+                async with Client(client_id="test") as client, JobQueue(archive) as jobs:
+                    client.base_url = server.url
+                    new_tracks = await archive_new_tracks.queue_new_tracks(client, archive, jobs, 1, since)
+                self.assertEqual([track.id for track in new_tracks], [100003, 100002])
+            finally:
+                await archive.close()
+                await server.stop()
+
+        self.loop.run_until_complete(test())
+
+    # Partials saved under an old layout are moved into the current one and resumed; those that can't be resumed are
+    # removed, and tracks with a queued job are resumed without asking the API for them again.
+    def test_resume_partial_downloads(self):
+        server = FakeSoundcloud(num_users=2, tracks_per_user=3, track_size=4096, artwork_size=1024)
+        data_dir = os.path.join(self.work_dir, "data")
+        flat, sharded = TrackStore(data_dir), ShardedTrackStore(data_dir)
+
+        def write_partial(store, track_id, suffix, size):
+            user_id = track_id // 100000
+            os.makedirs(store.user_dir(user_id), exist_ok=True)
+            with open(store.track_path(user_id, track_id, suffix), "wb") as fd:
+                fd.write(server.track_body(track_id)[:size])
+            return store.track_path(user_id, track_id, suffix)
+
+        async def test():
+            await server.start()
+            archive = AsyncArchive(self.db_file, readers=0)
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    tracks = [await client.fetch_track(x) for x in (100000, 100001, 100002, 200000)]
+                    async with JobQueue(archive) as jobs:
+                        await archive_new_tracks.queue_downloads(jobs, tracks[3:])
+                        await jobs.complete(await jobs.claim(Job.DOWNLOAD_TRACK))
+                        await archive_new_tracks.queue_downloads(jobs, tracks[1:3])
+
+                    # Flat, no job: fetched from the API. Flat, queued: not fetched. Wrong suffix, and already done.
+                    moved = write_partial(flat, 100000, archive_new_tracks.PART_SUFFIX, 1000)
+                    with open(moved + archive_new_tracks.ETAG_SUFFIX, "w") as fd:
+                        fd.write('"track-100000"')
+                    queued = write_partial(flat, 100001, archive_new_tracks.PART_SUFFIX, 2000)
+                    other_mode = write_partial(sharded, 100002, archive_new_tracks.INLINE_TAGS_PART_SUFFIX, 1000)
+                    done = write_partial(sharded, 200000, archive_new_tracks.PART_SUFFIX, 1000)
+                    requests = server.requests
+                    await archive_new_tracks.enqueue(archive, client, sharded)
+                    self.assertEqual(server.requests, requests + 1)
+                    for path in (moved, queued, other_mode, done):
+                        self.assertFalse(os.path.exists(path))
+                    for track_id, size in ((100000, 1000), (100001, 2000)):
+                        with open(sharded.track_path(track_id // 100000, track_id, archive_new_tracks.PART_SUFFIX),
+                                  "rb") as fd:
+                            self.assertEqual(fd.read(), server.track_body(track_id)[:size])
+                    self.assertFalse(os.path.exists(moved + archive_new_tracks.ETAG_SUFFIX))
+                    self.assertEqual(archive_new_tracks.read_etag(
+                        sharded.track_path(1, 100000, archive_new_tracks.PART_SUFFIX + archive_new_tracks.ETAG_SUFFIX)),
+                        '"track-100000"')
+
+                    counts = await archive.count_jobs()
+                    self.assertEqual(counts[(Job.DOWNLOAD_TRACK, "pending")], 3)
+                    self.assertEqual(counts[(Job.DOWNLOAD_TRACK, "done")], 1)
+            finally:
+                await archive.close()
+                await server.stop()
+
+        self.loop.run_until_complete(test())
+
+    @staticmethod
+    def __make_track(user_id, timestamp):
+        return Track(
+            user_id * 100, "https://soundcloud.com/{}/1".format(user_id), user_id, "user", "track", None, None, False,
+            True, created_at(timestamp))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,675 @@
+#!/usr/bin/env python
+
+import aiohttp
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import timeit
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+
+from scarchive import Archive, ArtworkCache, AsyncArchive, Client, Metrics, Track, TrackStore, User
+from scarchive.fake_soundcloud import FakeSoundcloud
+from scarchive.soundcloud import json_loads
+from scarchive.tagging import build_id3_tag, tag_track_file
+
+import archive_new_tracks
+
+# Benchmarks for the archiver. e2e runs the whole pipeline (archive_new_tracks.enqueue and main) against a local fake
+# Soundcloud; decode, scan and search time the hot spots on their own. Each prints a JSON report.
+
+WORDS = ("ambient", "bass", "beat", "blue", "city", "dance", "deep", "dream", "dub", "echo", "fire", "garage",
+         "ghost", "gold", "house", "jungle", "light", "live", "love", "mix", "moon", "night", "ocean", "remix",
+         "rain", "session", "sky", "soul", "summer", "sun", "techno", "tape", "trap", "wave", "wild", "winter")
+
+
+def e2e(args):
+    if args.processes is None:
+        return e2e_run(args, None)
+    # One run per process count, each with its own server and archive, so their throughputs can be compared.
+    return {"runs": [dict(e2e_run(args, processes), processes=processes) for processes in args.processes]}
+
+
+# Run the pipeline once against a fresh fake Soundcloud: in this process, or with processes worker processes.
+def e2e_run(args, processes):
+    fake_options = {
+        "num_users": args.users,
+        "tracks_per_user": args.tracks_per_user,
+        "followings_per_user": 0,
+        "track_size": args.track_size,
+        "artwork_size": args.artwork_size,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "quota": args.quota,
+    }
+    server = FakeServer(fake_options)
+    work_dir = tempfile.mkdtemp(prefix="scarchive-bench-")
+    try:
+        url = server.start()
+        if processes is None:
+            report = run_e2e(args, url, work_dir)
+        else:
+            report = run_e2e_processes(args, url, work_dir, processes)
+        report["server"] = server.stop()
+    finally:
+        server.close()
+        if args.keep:
+            logging.warning("work_dir={} Kept benchmark data".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+class FakeServer(object):
+
+    # A FakeSoundcloud in its own process, so it doesn't compete with what's being benchmarked for the event loop.
+    def __init__(self, options):
+        context = multiprocessing.get_context("spawn")
+        self.conn, server_conn = context.Pipe()
+        self.process = context.Process(target=serve_fake, args=(options, server_conn))
+
+    # Start the server, and return its URL.
+    def start(self):
+        self.process.start()
+        return self.conn.recv()
+
+    # Stop the server, and return its stats.
+    def stop(self):
+        self.conn.send("stop")
+        return self.conn.recv()
+
+    def close(self):
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+# Serve a FakeSoundcloud until told to stop over conn, then send back its stats.
+def serve_fake(options, conn):
+    fake = FakeSoundcloud(**options)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    conn.send(loop.run_until_complete(fake.start()))
+    loop.run_until_complete(loop.run_in_executor(None, conn.recv))
+    loop.run_until_complete(fake.stop())
+    conn.send(fake.stats())
+    loop.close()
+
+
+# Set up the archive, client, artwork cache and store a pipeline runs with, in work_dir.
+def open_pipeline(args, url, work_dir, metrics):
+    archive = AsyncArchive(db_file=os.path.join(work_dir, "archive.db"), cache_ids=True, metrics=metrics)
+    client = Client(client_id="benchmark", api_rate=args.api_rate, download_rate=args.download_rate, metrics=metrics)
+    client.base_url = url
+    artwork_cache = ArtworkCache(archive, client, cache_dir=os.path.join(work_dir, "artwork"))
+    store = TrackStore.for_layout(args.layout, os.path.join(work_dir, "data"))
+    return archive, client, artwork_cache, store
+
+
+async def run_main(args, archive, client, artwork_cache, store, metrics):
+    await archive_new_tracks.main(archive, client, artwork_cache, store, args.crawl_workers, args.archive_workers,
+                                  args.tag_workers, inline_tags=args.inline_tags, metrics=metrics,
+                                  dedup=not args.no_dedup, request_budget=args.request_budget)
+
+
+# Add the fake's users to the archive and queue their crawls, as archive_new_tracks does before starting workers.
+async def start_run(args, archive, client, store):
+    fake = FakeSoundcloud(num_users=args.users, tracks_per_user=args.tracks_per_user)
+    await archive.add_users([User.from_json(fake.user_json(user_id)) for user_id in fake.user_ids()])
+    start = time.perf_counter()
+    await archive_new_tracks.enqueue(archive, client, store, inline_tags=args.inline_tags)
+    return start
+
+
+async def count_archived(archive):
+    return len([track async for track in archive.list_all_tracks() if track.uri])
+
+
+def close_pipeline(loop, archive, client):
+    loop.run_until_complete(client.close())
+    loop.run_until_complete(archive.close())
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+
+
+def run_e2e(args, url, work_dir):
+    metrics = Metrics()
+    archive, client, artwork_cache, store = open_pipeline(args, url, work_dir, metrics)
+
+    async def bench():
+        start = await start_run(args, archive, client, store)
+        await run_main(args, archive, client, artwork_cache, store, metrics)
+        elapsed = time.perf_counter() - start
+        return elapsed, await count_archived(archive)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        elapsed, track_count = loop.run_until_complete(bench())
+    finally:
+        close_pipeline(loop, archive, client)
+    return e2e_report(elapsed, track_count, [worker_report(metrics)])
+
+
+# Run the pipeline in processes worker processes sharing one archive, as archive_new_tracks does with
+# SC_WORKER_PROCESSES. The workers are started (and have imported everything) before the clock starts.
+def run_e2e_processes(args, url, work_dir, processes):
+    context = multiprocessing.get_context("spawn")
+    conns, workers = [], []
+    for worker_index in range(processes):
+        conn, worker_conn = context.Pipe()
+        conns.append(conn)
+        workers.append(context.Process(target=bench_worker, args=(args, url, work_dir, worker_conn)))
+    metrics = Metrics()
+    archive, client, artwork_cache, store = open_pipeline(args, url, work_dir, metrics)
+
+    async def bench():
+        start = await start_run(args, archive, client, store)
+        for conn in conns:
+            conn.send("go")
+        reports = await asyncio.gather(*[loop.run_in_executor(None, conn.recv) for conn in conns])
+        elapsed = time.perf_counter() - start
+        return elapsed, await count_archived(archive), reports
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for worker in workers:
+            worker.start()
+        for conn in conns:
+            conn.recv()
+        elapsed, track_count, reports = loop.run_until_complete(bench())
+    finally:
+        close_pipeline(loop, archive, client)
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+    return e2e_report(elapsed, track_count, reports)
+
+
+# One worker process of run_e2e_processes: say when it's ready, wait to be told to go, run the pipeline, and send
+# back a worker_report.
+def bench_worker(args, url, work_dir, conn):
+    logging.basicConfig(level=args.log_level.upper())
+    metrics = Metrics()
+    archive, client, artwork_cache, store = open_pipeline(args, url, work_dir, metrics)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        conn.send("ready")
+        conn.recv()
+        loop.run_until_complete(run_main(args, archive, client, artwork_cache, store, metrics))
+    finally:
+        close_pipeline(loop, archive, client)
+    conn.send(worker_report(metrics))
+
+
+def worker_report(metrics):
+    snapshot = metrics.snapshot()
+    return {
+        "counters": snapshot["counters"],
+        "p99_seconds": dict((name, histogram["p99"]) for name, histogram in snapshot["histograms"].items()),
+        "loop_lag": snapshot["histograms"].get("event_loop_lag_seconds"),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# Combine the workers' reports: counters are summed, and the p99s and peak RSS are the worst of any worker's. Event
+# loop lag is how late the loop woke from a sleep: the mean over every worker, and the worst worker's p99.
+def e2e_report(elapsed, track_count, reports):
+    counters, p99s = {}, {}
+    lags = [report["loop_lag"] for report in reports if report["loop_lag"]]
+    for report in reports:
+        for name, value in report["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in report["p99_seconds"].items():
+            p99s[name] = value if p99s.get(name) is None else max(p99s[name], value or 0)
+    downloaded_bytes = sum(value for name, value in counters.items() if name.startswith("download_bytes_total"))
+    return {
+        "elapsed_seconds": elapsed,
+        "tracks": track_count,
+        "tracks_per_second": track_count / elapsed,
+        "downloaded_bytes": downloaded_bytes,
+        "mb_per_second": downloaded_bytes / elapsed / 1024 ** 2,
+        "peak_rss_mb": max(report["peak_rss_mb"] for report in reports),
+        # Upper bounds of the histogram buckets the p99s fall in, not exact values.
+        "p99_seconds": dict(sorted(p99s.items())),
+        "loop_lag_seconds": {
+            "mean": sum(lag["sum"] for lag in lags) / sum(lag["count"] for lag in lags),
+            "p99": max(lag["p99"] for lag in lags),
+        } if lags else None,
+        "counters": counters,
+    }
+
+
+# Download args.tracks large tracks (500 MB each by default) from a local fake Soundcloud with download_track, as the
+# pipeline does, args.concurrency at a time. Tracks are streamed to disk in chunks, so peak RSS should stay about
+# where it started however large they are.
+def download(args):
+    server = FakeServer({"num_users": 1, "tracks_per_user": args.tracks, "track_size": args.track_size,
+                         "chunk_size": 1024 * 1024})
+    work_dir = tempfile.mkdtemp(prefix="scarchive-bench-")
+    try:
+        url = server.start()
+        report = {"tracks": args.tracks, "track_size": args.track_size, "start_rss_mb": peak_rss_mb()}
+        client = Client(client_id="benchmark", download_rate=1000)
+        client.base_url = url
+        store = TrackStore(os.path.join(work_dir, "data"))
+
+        async def bench():
+            tracks = [await client.fetch_track(100000 + i) for i in range(args.tracks)]
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def fetch(track):
+                async with semaphore:
+                    track_file = await archive_new_tracks.download_track(track, client, None, store)
+                    assert os.path.getsize(track_file) == args.track_size
+                    os.remove(track_file)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[fetch(track) for track in tracks])
+            return time.perf_counter() - start
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            elapsed = loop.run_until_complete(bench())
+        finally:
+            loop.run_until_complete(client.close())
+            loop.close()
+        report["elapsed_seconds"] = elapsed
+        report["mb_per_second"] = args.tracks * args.track_size / elapsed / 1024 ** 2
+        report["peak_rss_mb"] = peak_rss_mb()
+        report["server"] = server.stop()
+    finally:
+        server.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+# Tag args.tracks synthetic MP3s of args.track_size bytes after they've been downloaded: right on the event loop (as
+# the archiver used to), and on a thread and a process pool, timing each along with the event loop lag it causes.
+# Then time what inline tagging adds instead: rendering the tag and writing it before the audio, so the file is never
+# rewritten.
+def tag(args):
+    fake = FakeSoundcloud(num_users=1, tracks_per_user=args.tracks, track_size=args.track_size)
+    fake.url = "http://localhost"
+    tracks = [Track.from_json(fake.track_json(track_id)) for track_id in fake.track_ids(1)]
+    artwork = os.urandom(args.artwork_size)
+    work_dir = tempfile.mkdtemp(prefix="scarchive-bench-")
+    report = {"tracks": args.tracks, "track_size": args.track_size, "workers": args.workers}
+
+    def write_tracks():
+        for track in tracks:
+            track.uri = os.path.join(work_dir, "{}.mp3".format(track.id))
+            with open(track.uri, "wb") as f:
+                f.write(fake.track_body(track.id))
+
+    async def on_loop(track):
+        tag_track_file(track.uri, track, artwork)
+
+    def on_executor(executor):
+        async def run(track):
+            await asyncio.get_event_loop().run_in_executor(executor, tag_track_file, track.uri, track, artwork)
+        return run
+
+    async def bench(tag_fn):
+        metrics = Metrics()
+        sampler = asyncio.ensure_future(metrics.sample_loop_lag(interval=0.01))
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        await asyncio.gather(*[tag_fn(track) for track in tracks])
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.05)
+        sampler.cancel()
+        return elapsed, metrics.histograms[("event_loop_lag_seconds", ())]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        thread_pool = ThreadPoolExecutor(max_workers=args.workers)
+        process_pool = ProcessPoolExecutor(max_workers=args.workers)
+        for name, tag_fn in (("on_loop", on_loop), ("thread", on_executor(thread_pool)),
+                             ("process", on_executor(process_pool))):
+            write_tracks()
+            elapsed, lag = loop.run_until_complete(bench(tag_fn))
+            report[name + "_seconds"] = elapsed
+            report[name + "_tracks_per_second"] = args.tracks / elapsed
+            report[name + "_loop_lag_p99_seconds"] = lag.quantile(0.99)
+        thread_pool.shutdown()
+        process_pool.shutdown()
+
+        start = time.perf_counter()
+        for track in tracks:
+            with open(track.uri, "wb") as f:
+                f.write(build_id3_tag(track, artwork))
+        report["inline_seconds"] = time.perf_counter() - start
+    finally:
+        loop.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+# Fetch users from a local fake Soundcloud, args.concurrency at a time, with a new session (and connection) for every
+# request, as Client did before it shared one, and then through Client's shared, pooled session.
+def session(args):
+    server = FakeServer({"num_users": args.users, "latency": args.latency})
+    try:
+        url = server.start()
+        report = {"requests": args.requests, "concurrency": args.concurrency}
+
+        async def fresh_get(request_url):
+            async with aiohttp.ClientSession() as fresh_session:
+                async with fresh_session.get(request_url) as r:
+                    return json_loads(await r.read())
+
+        async def bench():
+            client = Client(client_id="benchmark", max_connections_per_host=args.concurrency)
+            try:
+                async def shared_get(request_url):
+                    async with client.session.get(request_url) as r:
+                        return json_loads(await r.read())
+
+                for name, get in (("fresh_session", fresh_get), ("shared_session", shared_get)):
+                    semaphore = asyncio.Semaphore(args.concurrency)
+
+                    async def fetch(x):
+                        async with semaphore:
+                            user = await get("{}/users/{}".format(url, x % args.users + 1))
+                            assert user["id"] == x % args.users + 1
+
+                    start = time.perf_counter()
+                    await asyncio.gather(*[fetch(x) for x in range(args.requests)])
+                    elapsed = time.perf_counter() - start
+                    report[name + "_seconds"] = elapsed
+                    report[name + "_requests_per_second"] = args.requests / elapsed
+            finally:
+                await client.close()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(bench())
+        finally:
+            loop.close()
+        report["server"] = server.stop()
+    finally:
+        server.close()
+    return report
+
+
+# Decode one full page of tracks, as the crawler does: the JSON, then a Track per item.
+def decode(args):
+    fake = FakeSoundcloud()
+    fake.url = "http://localhost"
+    page = {
+        "collection": [fake.track_json(100000 + i) for i in range(args.page_size)],
+        "next_href": "http://localhost/users/1/tracks?offset={}".format(args.page_size),
+    }
+    body = json.dumps(page).encode("utf-8")
+
+    def parse(loads):
+        return [Track.from_json(item) for item in loads(body)["collection"]]
+
+    report = {"page_size": args.page_size, "page_bytes": len(body), "decoder": json_loads.__module__}
+    for name, loads in (("json", json.loads), ("default", json_loads)):
+        report[name + "_loads_us"] = best_of(lambda: loads(body), args.repeat) * 1e6
+        report[name + "_page_us"] = best_of(lambda: parse(loads), args.repeat) * 1e6
+    return report
+
+
+# Scan every track in an archive of args.rows tracks: with LIMIT/OFFSET pages, as list_all_tracks used to, then
+# with keyset pages and streamed, as it does now.
+def scan(args):
+    with BenchmarkArchive(args) as archive:
+        report = {"rows": count_tracks(archive)}
+        variants = (("offset", lambda: offset_scan(archive)),
+                    ("paged", lambda: archive.list_all_tracks()),
+                    ("stream", lambda: archive.list_all_tracks(stream=True)))
+        for name, list_tracks in variants:
+            start = time.perf_counter()
+            count = sum(1 for _ in list_tracks())
+            elapsed = time.perf_counter() - start
+            report[name + "_seconds"] = elapsed
+            report[name + "_rows_per_second"] = count / elapsed
+        report["peak_rss_mb"] = peak_rss_mb()
+        return report
+
+
+# Insert args.rows tracks into a new archive file: one add_track (and commit) per row, add_tracks in batches of
+# args.batch_size, and through a BufferedWriter.
+def insert(args):
+    tracks = make_tracks(random.Random(0), range(1, args.rows + 1))
+
+    def one_per_row(archive):
+        for track in tracks:
+            archive.add_track(track)
+
+    def batched(archive):
+        for batch_start in range(0, len(tracks), args.batch_size):
+            archive.add_tracks(tracks[batch_start:batch_start + args.batch_size])
+
+    def buffered(archive):
+        with archive.buffered_writer(max_rows=args.batch_size) as writer:
+            for track in tracks:
+                writer.add_track(track)
+
+    report = {"rows": args.rows, "batch_size": args.batch_size}
+    for name, fn in (("per_row", one_per_row), ("add_tracks", batched), ("buffered_writer", buffered)):
+        work_dir = tempfile.mkdtemp(prefix="scarchive-bench-")
+        try:
+            with closing(Archive(db_file=os.path.join(work_dir, "archive.db"))) as archive:
+                start = time.perf_counter()
+                fn(archive)
+                elapsed = time.perf_counter() - start
+                assert count_tracks(archive) == args.rows
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        report[name + "_seconds"] = elapsed
+        report[name + "_rows_per_second"] = args.rows / elapsed
+    return report
+
+
+# Run searches against an archive of args.rows tracks: one and two word queries, the page after each, and facets.
+def search(args):
+    rng = random.Random(1)
+    queries = [" ".join(rng.sample(WORDS, rng.choice((1, 2)))) for _ in range(args.queries)]
+    with BenchmarkArchive(args) as archive:
+        first_pages, next_pages, facets = [], [], []
+        for query in queries:
+            start = time.perf_counter()
+            tracks, cursor = archive.search_tracks(query)
+            first_pages.append(time.perf_counter() - start)
+            if cursor is not None:
+                start = time.perf_counter()
+                archive.search_tracks(query, cursor=cursor)
+                next_pages.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            archive.search_facets(query)
+            facets.append(time.perf_counter() - start)
+        return {
+            "rows": count_tracks(archive),
+            "queries": len(queries),
+            "first_page_ms": percentiles(first_pages),
+            "next_page_ms": percentiles(next_pages),
+            "facets_ms": percentiles(facets),
+        }
+
+
+# The OFFSET paging list_all_tracks did before keyset paging: every page skips over all the rows before it again.
+def offset_scan(archive):
+    q = """SELECT id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable, created_at,
+                  sha256 FROM tracks ORDER BY id LIMIT ? OFFSET ?"""
+    for page in itertools.count():
+        rows = archive.conn.execute(q, (archive.page_size, archive.page_size * page)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield Track.from_row(row)
+
+
+class BenchmarkArchive(object):
+
+    # An Archive of args.rows generated tracks, for the scan and search benchmarks. With args.db, the archive is
+    # kept there and only filled the first time, since filling a large one takes a while.
+    def __init__(self, args):
+        self.args = args
+        self.work_dir = None
+        self.archive = None
+
+    def __enter__(self):
+        db_file = self.args.db
+        if db_file is None:
+            self.work_dir = tempfile.mkdtemp(prefix="scarchive-bench-")
+            db_file = os.path.join(self.work_dir, "archive.db")
+        self.archive = Archive(db_file=db_file)
+        if count_tracks(self.archive) < self.args.rows:
+            fill_archive(self.archive, self.args.rows)
+        return self.archive
+
+    def __exit__(self, exc_type, exc, tb):
+        self.archive.close()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def fill_archive(archive, rows, users=10000, batch_size=10000):
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for batch_start in range(1, rows + 1, batch_size):
+        archive.add_tracks(make_tracks(rng, range(batch_start, min(batch_start + batch_size, rows + 1)), users))
+    logging.info("rows={} seconds={:.1f} Filled benchmark archive".format(rows, time.perf_counter() - start))
+
+
+def make_tracks(rng, track_ids, users=10000):
+    tracks = []
+    for track_id in track_ids:
+        user_id = track_id % users + 1
+        title = " ".join(rng.sample(WORDS, 3))
+        tracks.append(Track(track_id, "https://soundcloud.com/user{}/{}".format(user_id, track_id), user_id,
+                            "user {}".format(user_id), title, "data/{}/{}.mp3".format(user_id, track_id), None,
+                            False, True, "2018/01/01 00:00:00 +0000"))
+    return tracks
+
+
+def count_tracks(archive):
+    return archive.conn.execute("SELECT count(*) FROM tracks").fetchone()[0]
+
+
+def best_of(fn, repeat):
+    number = max(1, repeat // 10)
+    return min(timeit.repeat(fn, number=number, repeat=10)) / number
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return dict(("p{}".format(p), samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000)
+                for p in (50, 90, 99))
+
+
+def process_counts(value):
+    return [int(count) for count in value.split(",")]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the archiver.")
+    parser.add_argument("--output", help="also append the JSON report to this file")
+    parser.add_argument("--log-level", default="WARNING", help="logging level (default: WARNING)")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    p = subparsers.add_parser("e2e", help="crawl and archive everything from a local fake Soundcloud")
+    p.set_defaults(fn=e2e)
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--tracks-per-user", type=int, default=20)
+    p.add_argument("--track-size", type=int, default=512 * 1024, help="bytes per track")
+    p.add_argument("--artwork-size", type=int, default=32 * 1024, help="bytes per artwork image")
+    p.add_argument("--latency", type=float, default=0.02, help="seconds the server waits before each response")
+    p.add_argument("--jitter", type=float, default=0.01, help="up to this many more seconds of latency")
+    p.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    p.add_argument("--quota", type=int, help="requests per second the server allows before answering 429")
+    p.add_argument("--api-rate", type=float, default=1000)
+    p.add_argument("--download-rate", type=float, default=1000)
+    p.add_argument("--crawl-workers", type=int, default=16)
+    p.add_argument("--archive-workers", type=int, default=8)
+    p.add_argument("--tag-workers", type=int, default=2)
+    p.add_argument("--request-budget", type=int, help="API requests the crawl stage may make")
+    p.add_argument("--inline-tags", action="store_true")
+    p.add_argument("--no-dedup", action="store_true")
+    p.add_argument("--layout", default="sharded", choices=("flat", "sharded"))
+    p.add_argument("--keep", action="store_true", help="keep the archive and files afterwards")
+    p.add_argument("--processes", type=process_counts,
+                   help="run with this many worker processes, e.g. 1,2,4,8 for one run with each")
+
+    p = subparsers.add_parser("tag", help="tag large synthetic MP3s on the event loop, a thread and a process pool, "
+                                          "and inline")
+    p.set_defaults(fn=tag)
+    p.add_argument("--tracks", type=int, default=8)
+    p.add_argument("--track-size", type=int, default=100 * 1024 ** 2, help="bytes per track")
+    p.add_argument("--artwork-size", type=int, default=100 * 1024, help="bytes of artwork in each tag")
+    p.add_argument("--workers", type=int, default=2)
+
+    p = subparsers.add_parser("download", help="download large tracks from a local fake Soundcloud, for peak RSS")
+    p.set_defaults(fn=download)
+    p.add_argument("--tracks", type=int, default=2)
+    p.add_argument("--track-size", type=int, default=500 * 1024 ** 2, help="bytes per track")
+    p.add_argument("--concurrency", type=int, default=2)
+
+    p = subparsers.add_parser("session", help="fetch from a local fake Soundcloud with a new session per request, "
+                                              "and with Client's shared session")
+    p.set_defaults(fn=session)
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=20)
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--latency", type=float, default=0.0, help="seconds the server waits before each response")
+
+    p = subparsers.add_parser("insert", help="insert tracks one at a time, in batches, and with a BufferedWriter")
+    p.set_defaults(fn=insert)
+    p.add_argument("--rows", type=int, default=100000)
+    p.add_argument("--batch-size", type=int, default=500)
+
+    p = subparsers.add_parser("decode", help="decode an API page of tracks, with json and the default decoder")
+    p.set_defaults(fn=decode)
+    p.add_argument("--page-size", type=int, default=200)
+    p.add_argument("--repeat", type=int, default=1000)
+
+    for name, fn, description in (("scan", scan, "scan every track in a large archive"),
+                           ("search", search, "search the tracks of a large archive")):
+        p = subparsers.add_parser(name, help=description)
+        p.set_defaults(fn=fn)
+        p.add_argument("--rows", type=int, default=1000000, help="number of tracks in the archive")
+        p.add_argument("--db", help="keep the generated archive in this file, to reuse it next time")
+        if name == "search":
+            p.add_argument("--queries", type=int, default=200)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+
+    report = dict(args.fn(args), benchmark=args.benchmark)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(report, sort_keys=True) + "\n")
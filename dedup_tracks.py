@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from scarchive import AsyncArchive
+from scarchive.dedup import hash_audio_file, link_duplicate
+
+
+# Deduplicate the archive's existing track files: hash every archived track that doesn't have a hash yet, then
+# replace the files of tracks with identical audio by hardlinks to the oldest one's. New downloads are deduplicated
+# as they're archived, so this only needs to run once over older data (or after SC_DEDUP=0 runs).
+async def main(archive, num_workers=4, dry_run=False):
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        hashed_count = await hash_tracks(archive, executor, num_workers)
+        linked_count, reclaimed_bytes = await link_duplicates(archive, executor, dry_run)
+    finally:
+        executor.shutdown()
+    summary = {"hashed": hashed_count, "linked": linked_count, "reclaimed_bytes": reclaimed_bytes, "dry_run": dry_run}
+    logging.info("summary={} Deduplicated tracks".format(json.dumps(summary)))
+    return summary
+
+
+async def hash_tracks(archive, executor, num_workers, batch_size=100):
+    queue = asyncio.Queue(maxsize=num_workers * 2)
+    hashed = []
+
+    async def hash_worker():
+        loop = asyncio.get_event_loop()
+        while True:
+            track = await queue.get()
+            try:
+                if await loop.run_in_executor(executor, os.path.exists, track.uri):
+                    track.sha256 = (await loop.run_in_executor(executor, hash_audio_file, track.uri)).hexdigest()
+                    hashed.append(track)
+                else:
+                    logging.warning("track_id={} uri={} Track file missing".format(track.id, track.uri))
+            except OSError as e:
+                logging.error("track_id={} uri={} Failed to hash track: {}".format(track.id, track.uri, e))
+            queue.task_done()
+
+    workers = [asyncio.ensure_future(hash_worker()) for _ in range(num_workers)]
+    hashed_count = 0
+    async for track in archive.list_all_tracks():
+        if track.uri and not track.sha256:
+            await queue.put(track)
+        if len(hashed) >= batch_size:
+            # Take the batch before saving it: the workers carry on adding to hashed while this waits.
+            batch, hashed[:] = list(hashed), []
+            hashed_count += await archive.add_tracks(batch)
+    await queue.join()
+    for worker in workers:
+        worker.cancel()
+    hashed_count += await archive.add_tracks(hashed)
+    return hashed_count
+
+
+async def link_duplicates(archive, executor, dry_run):
+    loop = asyncio.get_event_loop()
+    linked_count, reclaimed_bytes = 0, 0
+    for sha256 in await archive.list_duplicate_sha256s():
+        tracks = await archive.find_tracks_by_sha256(sha256)
+        original = tracks[0]
+        for track in tracks[1:]:
+            size = await loop.run_in_executor(executor, unshared_size, original.uri, track.uri)
+            if size is None:
+                continue
+            if dry_run or await loop.run_in_executor(executor, link_duplicate, original.uri, track.uri):
+                logging.info("track_id={} original_track_id={} Linked duplicate track".format(track.id, original.id))
+                linked_count += 1
+                reclaimed_bytes += size
+    return linked_count, reclaimed_bytes
+
+
+# Return the size of dst if it's a separate copy of src, or None if they're already the same file or either is missing.
+def unshared_size(src, dst):
+    try:
+        if os.path.samefile(src, dst):
+            return None
+        return os.stat(dst).st_size
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hardlink archived tracks that have identical audio.")
+    parser.add_argument("--workers", type=int, default=4, help="number of files to hash in parallel")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be linked, without linking (hashes are still recorded)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    archive = AsyncArchive(db_file=os.environ.get("SC_ARCHIVE_DB", "archive.db"))
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(main(archive, args.workers, args.dry_run))
+    finally:
+        loop.run_until_complete(archive.close())
+        loop.close()
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from scarchive import AsyncArchive, Track
+
+import dedup_tracks
+
+
+class DedupTracksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.work_dir)
+
+    # Every track gets its hash saved, including those hashed while an earlier batch was being written.
+    def test_hash_tracks(self):
+        tracks = []
+        for x in range(1, 301):
+            path = os.path.join(self.work_dir, "{}.mp3".format(x))
+            with open(path, "wb") as f:
+                f.write(str(x % 7).encode("utf-8") * 1000)
+            tracks.append(Track(x, "https://soundcloud.com/1/{}".format(x), 1, "user", "track", path, None, False,
+                                True))
+
+        async def test():
+            archive = AsyncArchive(os.path.join(self.work_dir, "archive.db"), readers=0)
+            executor = ThreadPoolExecutor(max_workers=8)
+            try:
+                await archive.add_tracks(tracks)
+                self.assertEqual(await dedup_tracks.hash_tracks(archive, executor, 8, batch_size=10), 300)
+                hashes = [track.sha256 async for track in archive.list_all_tracks()]
+                self.assertNotIn(None, hashes)
+                self.assertEqual(len(set(hashes)), 7)
+            finally:
+                executor.shutdown()
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,13 @@
 from .archive import Archive
+from .artwork import Artwork
+from .artwork_cache import ArtworkCache
+from .async_archive import AsyncArchive
+from .crawl_state import CrawlState
+from .job import Job
+from .job_queue import JobQueue
+from .metrics import Metrics
+from .scheduler import CrawlScheduler, RequestBudget
 from .soundcloud import Client
+from .storage import ShardedTrackStore, TrackStore
 from .track import Track
 from .user import User
@@ -1,36 +1,229 @@
-import itertools
 import sqlite3
+import time
 
 from contextlib import closing
 
+from .artwork import Artwork
+from .crawl_state import CrawlState
+from .job import Job
 from .track import Track
 from .user import User
 
 
 class Archive(object):
 
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file)
+    # Schema changes made after the initial tables, applied in order. PRAGMA user_version records how many have run.
+    migrations = [
+        "create index if not exists tracks_user_id on tracks (user_id)",
+        "alter table tracks add column created_at text",
+        """
+        create table if not exists crawl_state (
+          user_id integer PRIMARY KEY,
+          last_track_id integer,
+          last_track_created_at text,
+          track_count integer,
+          etag text,
+          last_checked real,
+          FOREIGN KEY(user_id) REFERENCES users(id)
+        );""",
+        """
+        create table if not exists artwork (
+          url text PRIMARY KEY,
+          sha256 text,
+          size integer,
+          etag text,
+          last_modified text,
+          last_validated real,
+          last_used real
+        );""",
+        "create index if not exists artwork_sha256 on artwork (sha256)",
+        "create index if not exists artwork_last_used on artwork (last_used)",
+        """
+        create table if not exists crawl_frontier (
+          user_id integer PRIMARY KEY,
+          depth integer,
+          done boolean DEFAULT 0
+        );""",
+        """
+        create table if not exists jobs (
+          id integer PRIMARY KEY,
+          kind text,
+          key integer,
+          payload text,
+          state text,
+          attempts integer DEFAULT 0,
+          lease_owner text,
+          lease_expires real,
+          last_error text,
+          UNIQUE(kind, key)
+        );""",
+        "create index if not exists jobs_kind_state on jobs (kind, state)",
+        # Full-text search over track titles and artists. rowid is the track id; username is the name on the track,
+        # artist the current name of its user. Triggers keep it in sync with tracks and users.
+        "create virtual table if not exists tracks_fts using fts5 (title, username, artist)",
+        """
+        insert into tracks_fts (rowid, title, username, artist)
+          select tracks.id, tracks.title, tracks.username, users.username
+          from tracks left join users on users.id = tracks.user_id""",
+        """
+        create trigger if not exists tracks_fts_insert after insert on tracks begin
+          insert into tracks_fts (rowid, title, username, artist)
+            values (new.id, new.title, new.username, (select username from users where id = new.user_id));
+        end""",
+        """
+        create trigger if not exists tracks_fts_update after update of title, username, user_id on tracks
+        when old.title is not new.title or old.username is not new.username or old.user_id is not new.user_id begin
+          delete from tracks_fts where rowid = old.id;
+          insert into tracks_fts (rowid, title, username, artist)
+            values (new.id, new.title, new.username, (select username from users where id = new.user_id));
+        end""",
+        """
+        create trigger if not exists tracks_fts_delete after delete on tracks begin
+          delete from tracks_fts where rowid = old.id;
+        end""",
+        """
+        create trigger if not exists users_fts_insert after insert on users begin
+          update tracks_fts set artist = new.username where rowid in (select id from tracks where user_id = new.id);
+        end""",
+        """
+        create trigger if not exists users_fts_update after update of username on users begin
+          update tracks_fts set artist = new.username where rowid in (select id from tracks where user_id = new.id);
+        end""",
+        "alter table tracks add column sha256 text",
+        "create index if not exists tracks_sha256 on tracks (sha256)",
+        # Crawl scheduling: each user's upload cadence, when new tracks were last found, and when they're next due.
+        "alter table crawl_state add column upload_interval real",
+        "alter table crawl_state add column last_new_track_at real",
+        "alter table crawl_state add column next_check_at real",
+        "alter table jobs add column priority real DEFAULT 0",
+        "create index if not exists jobs_kind_state_priority on jobs (kind, state, priority)",
+        # Named counters shared by every process working on the archive, e.g. the API requests spent in a run.
+        """
+        create table if not exists counters (
+          name text PRIMARY KEY,
+          value integer
+        );""",
+        # Upserting a user always sets username, so only reindex their tracks when it actually changed.
+        "drop trigger if exists users_fts_update",
+        """
+        create trigger if not exists users_fts_update after update of username on users
+        when old.username is not new.username begin
+          update tracks_fts set artist = new.username where rowid in (select id from tracks where user_id = new.id);
+        end""",
+    ]
+
+    # Max number of ids bound to a single IN (...) query; older SQLite builds allow at most 999 variables.
+    max_query_ids = 500
+
+    def __init__(self, db_file, page_size=500, cache_ids=False, check_same_thread=True):
+        self.conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
         self.__init_tables()
-        self.page_size = 25
+        self.__migrate()
+        self.page_size = page_size
+
+        # Optionally keep every archived user and track id in memory, so membership checks skip the database.
+        self.user_ids = None
+        self.track_ids = None
+        if cache_ids:
+            self.user_ids = set(self.__select_ids("SELECT id FROM users"))
+            self.track_ids = set(self.__select_ids("SELECT id FROM tracks"))
 
-    # Add a user to the archive.
+    # Add a user to the archive, replacing any existing row with the same id.
     def add_user(self, user):
-        with closing(self.conn.cursor()) as c:
-            q = "INSERT INTO users (id, username, permalink, avatar_url) VALUES (?, ?, ?, ?)"
-            c.execute(q, (user.id, user.username, user.permalink, user.avatar_url))
-            self.conn.commit()
-            return user.id
+        self.add_users([user])
+        return user.id
+
+    # Add many users to the archive in a single transaction.
+    def add_users(self, users):
+        users = list(users)
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """INSERT INTO users (id, username, permalink, avatar_url) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET
+                     username=excluded.username, permalink=excluded.permalink, avatar_url=excluded.avatar_url"""
+            c.executemany(q, ((user.id, user.username, user.permalink, user.avatar_url) for user in users))
+        if self.user_ids is not None:
+            self.user_ids.update(user.id for user in users)
+        return len(users)
 
-    # Add a track to the archive.
+    # Add a track to the archive, replacing any existing row with the same id.
     def add_track(self, track):
+        self.add_tracks([track])
+        return track.id
+
+    # Add many tracks to the archive in a single transaction.
+    def add_tracks(self, tracks):
+        tracks = list(tracks)
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """INSERT INTO tracks (id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable, created_at, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(id) DO UPDATE SET
+                     permalink=excluded.permalink, user_id=excluded.user_id, username=excluded.username,
+                     title=excluded.title, uri=excluded.uri, artwork_url=excluded.artwork_url,
+                     is_downloadable=excluded.is_downloadable, is_streamable=excluded.is_streamable,
+                     created_at=excluded.created_at, sha256=coalesce(excluded.sha256, tracks.sha256)"""
+            c.executemany(q, (track.to_row() for track in tracks))
+        if self.track_ids is not None:
+            self.track_ids.update(track.id for track in tracks)
+        return len(tracks)
+
+    # Buffer writes to the archive, flushing every max_rows rows or max_delay_ms milliseconds. The delay is only checked
+    # when a row is added, so rows added last wait for flush() or the end of the with block.
+    def buffered_writer(self, max_rows=500, max_delay_ms=1000):
+        return BufferedWriter(self, max_rows, max_delay_ms)
+
+    # Find archived tracks (ones with a file) whose audio hashes to sha256, oldest first.
+    def find_tracks_by_sha256(self, sha256):
+        with closing(self.conn.cursor()) as c:
+            c.row_factory = Track.row_factory
+            return c.execute(self.__track_query("WHERE sha256 = ? AND uri IS NOT NULL"), (sha256,)).fetchall()
+
+    # List the hashes shared by more than one archived track.
+    def list_duplicate_sha256s(self):
+        q = """SELECT sha256 FROM tracks WHERE sha256 IS NOT NULL AND uri IS NOT NULL
+               GROUP BY sha256 HAVING count(*) > 1 ORDER BY sha256"""
+        return self.__select_ids(q)
+
+    # Search track titles and artists for query, best matches first. Each word of query matches words starting with
+    # it, and all of them have to match. Returns (tracks, cursor), where cursor is passed back to get the next page of
+    # results, and is None after the last page. With user_id, only that user's tracks are searched.
+    def search_tracks(self, query, limit=20, cursor=None, user_id=None):
+        match = self.__match_query(query)
+        if match is None:
+            return [], None
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("tracks.user_id = ?")
+            params.append(user_id)
+        if cursor is not None:
+            # Results are ordered by (rank, id), so carry on after the last result of the previous page.
+            rank, _, track_id = cursor.partition(":")
+            try:
+                rank, track_id = float(rank), int(track_id)
+            except ValueError:
+                raise ValueError("Invalid search cursor: {!r}".format(cursor)) from None
+            conditions.append("(matches.rank > ? OR (matches.rank = ? AND tracks.id > ?))")
+            params.extend([rank, rank, track_id])
+        with closing(self.conn.cursor()) as c:
+            # Title matches count double.
+            q = """SELECT {}, matches.rank FROM (
+                     SELECT rowid, bm25(tracks_fts, 10.0, 5.0, 5.0) AS rank FROM tracks_fts WHERE tracks_fts MATCH ?
+                   ) AS matches JOIN tracks ON tracks.id = matches.rowid
+                   {} ORDER BY matches.rank, tracks.id LIMIT ?""".format(
+                self.__track_columns("tracks."), "WHERE " + " AND ".join(conditions) if conditions else "")
+            rows = c.execute(q, [match] + params + [limit]).fetchall()
+        tracks = [Track.from_row(row[:-1]) for row in rows]
+        next_cursor = "{!r}:{}".format(rows[-1][-1], rows[-1][0]) if rows and len(rows) == limit else None
+        return tracks, next_cursor
+
+    # Count the tracks matching query by user, as (user_id, username, count)s for the limit users with most matches.
+    def search_facets(self, query, limit=20):
+        match = self.__match_query(query)
+        if match is None:
+            return []
         with closing(self.conn.cursor()) as c:
-            q = "INSERT INTO tracks (id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-            c.execute(q, (
-                track.id, track.permalink, track.user_id, track.username, track.title, track.uri, track.artwork_url,
-                track.is_downloadable, track.is_streamable))
-            self.conn.commit()
-            return track.id
+            q = """SELECT tracks.user_id, coalesce(users.username, tracks.username), count(*) AS matches
+                   FROM tracks_fts JOIN tracks ON tracks.id = tracks_fts.rowid LEFT JOIN users ON users.id = tracks.user_id
+                   WHERE tracks_fts MATCH ? GROUP BY tracks.user_id ORDER BY matches DESC, tracks.user_id LIMIT ?"""
+            return c.execute(q, (match, limit)).fetchall()
 
     # Search for user in archive by user_id.
     def find_user(self, user_id):
@@ -42,57 +235,360 @@ class Archive(object):
     # Search for track in archive by track_id.
     def find_track(self, track_id):
         with closing(self.conn.cursor()) as c:
-            q = "SELECT id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable FROM tracks WHERE id = ?"
+            q = self.__track_query("WHERE id = ?")
             row = c.execute(q, (track_id,)).fetchone()
             return Track.from_row(row) if row else None
 
-    # List all users in archive.
-    def list_all_users(self):
-        for user in self.__crawl_pages(self.list_users_page):
-            yield user
+    # Queue jobs of kind, one per (key, payload) or (key, payload, priority). Jobs that are already queued or leased
+    # are left alone; existing jobs in one of the requeue states are queued again.
+    def enqueue_jobs(self, kind, items, requeue=("done", "failed")):
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """INSERT INTO jobs (kind, key, payload, state, attempts, priority) VALUES (?, ?, ?, 'pending', 0, ?)
+                   ON CONFLICT(kind, key) DO UPDATE SET
+                     payload=excluded.payload, state='pending', attempts=0, last_error=NULL, priority=excluded.priority
+                   WHERE jobs.state IN ({})""".format(", ".join("?" * len(requeue)))
+            c.executemany(q, ((kind, item[0], item[1], item[2] if len(item) > 2 else 0) + tuple(requeue)
+                              for item in items))
+
+    # Lease up to limit jobs of kind to owner for lease_seconds, highest priority first. Pending jobs are claimable,
+    # as are leased jobs whose lease has run out (their worker died). Jobs which have used up max_attempts are marked
+    # failed instead.
+    def claim_jobs(self, kind, owner, now, limit=1, lease_seconds=60, max_attempts=5):
+        claimable = "kind = ? AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))"
+        with self.conn, closing(self.conn.cursor()) as c:
+            # Take the write lock up front, so two processes can't claim the same job.
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("UPDATE jobs SET state = 'failed', lease_owner = NULL WHERE {} AND attempts >= ?".format(claimable),
+                      (kind, now, max_attempts))
+            q = "SELECT id FROM jobs WHERE {} ORDER BY priority DESC, id LIMIT ?".format(claimable)
+            job_ids = [row[0] for row in c.execute(q, (kind, now, limit))]
+            c.executemany("""UPDATE jobs SET state = 'leased', attempts = attempts + 1, lease_owner = ?, lease_expires = ?
+                             WHERE id = ?""", ((owner, now + lease_seconds, job_id) for job_id in job_ids))
+            return [self.__find_job(c, job_id) for job_id in job_ids]
+
+    # Extend owner's leases on job_ids. Returns the number of leases still held.
+    def renew_leases(self, job_ids, owner, lease_expires):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.executemany("UPDATE jobs SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND state = 'leased'",
+                          ((lease_expires, job_id, owner) for job_id in job_ids))
+            return c.rowcount
+
+    def complete_job(self, job_id, owner):
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = "UPDATE jobs SET state = 'done', lease_owner = NULL WHERE id = ? AND lease_owner = ?"
+            c.execute(q, (job_id, owner))
+
+    # Give a job back after a failed attempt, to be retried until it has used up max_attempts.
+    def fail_job(self, job_id, owner, error, max_attempts=5):
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                     lease_owner = NULL, last_error = ?
+                   WHERE id = ? AND lease_owner = ?"""
+            c.execute(q, (max_attempts, str(error), job_id, owner))
+
+    def find_job(self, kind, key):
+        with closing(self.conn.cursor()) as c:
+            row = c.execute("SELECT id FROM jobs WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            return self.__find_job(c, row[0]) if row else None
+
+    # Cancel every pending job of kind, e.g. to leave them for the next run. Returns the number cancelled.
+    def cancel_jobs(self, kind):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.execute("UPDATE jobs SET state = 'cancelled' WHERE kind = ? AND state = 'pending'", (kind,))
+            return c.rowcount
 
-    # List users in archive, one page at a time.
-    def list_users_page(self, page=0):
+    # Count jobs of the given kinds which are still waiting to run or running.
+    def count_active_jobs(self, kinds):
         with closing(self.conn.cursor()) as c:
-            q = "SELECT id, username, permalink, avatar_url FROM users ORDER BY id LIMIT ? OFFSET ?"
-            params = (self.page_size, self.page_size * page)
-            for row in c.execute(q, params).fetchall():
-                yield User.from_row(row)
+            q = "SELECT count(*) FROM jobs WHERE state IN ('pending', 'leased') AND kind IN ({})".format(
+                ", ".join("?" * len(kinds)))
+            return c.execute(q, list(kinds)).fetchone()[0]
 
-    # List all tracks in archive.
-    def list_all_tracks(self):
-        for track in self.__crawl_pages(self.list_tracks_page):
-            yield track
+    # Count jobs by kind and state, as a {(kind, state): count} dict.
+    def count_jobs(self):
+        with closing(self.conn.cursor()) as c:
+            q = "SELECT kind, state, count(*) FROM jobs GROUP BY kind, state"
+            return dict(((kind, state), count) for kind, state, count in c.execute(q))
+
+    @staticmethod
+    def __find_job(c, job_id):
+        q = """SELECT id, kind, key, payload, state, attempts, lease_owner, lease_expires, last_error, priority
+               FROM jobs WHERE id = ?"""
+        return Job.from_row(c.execute(q, (job_id,)).fetchone())
+
+    # Add delta to the named counter (which starts at 0), and return its new value.
+    def add_to_counter(self, name, delta):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.execute("""INSERT INTO counters (name, value) VALUES (?, ?)
+                         ON CONFLICT(name) DO UPDATE SET value = value + excluded.value""", (name, delta))
+            return c.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+    def reset_counter(self, name):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.execute("DELETE FROM counters WHERE name = ?", (name,))
+
+    # Add (user_id, depth) entries to the following-graph crawl frontier. A user already in it is only changed when
+    # found at a shallower depth, and then has to be expanded again, since its followings are shallower too.
+    def add_frontier(self, entries):
+        entries = list(entries)
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.executemany("INSERT OR IGNORE INTO crawl_frontier (user_id, depth) VALUES (?, ?)", entries)
+            c.executemany("UPDATE crawl_frontier SET depth = ?, done = 0 WHERE user_id = ? AND depth > ?",
+                          ((depth, user_id, depth) for user_id, depth in entries))
+
+    # Mark (user_id, depth) entries in the crawl frontier as expanded. An expansion at a depth the user has since
+    # been found shallower than doesn't count.
+    def finish_frontier(self, entries):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.executemany("UPDATE crawl_frontier SET done = 1 WHERE user_id = ? AND depth = ?", entries)
+
+    # List (user_id, depth, done) for every user in the crawl frontier.
+    def list_frontier(self):
+        with closing(self.conn.cursor()) as c:
+            return c.execute("SELECT user_id, depth, done FROM crawl_frontier ORDER BY depth, user_id").fetchall()
+
+    # Write a buffered writer's rows. Users and tracks are written before the frontier changes that depend on them,
+    # so a crash part way through never marks a user as expanded without its followings saved.
+    def write_rows(self, users, tracks, frontier, finished):
+        if users:
+            self.add_users(users)
+        if tracks:
+            self.add_tracks(tracks)
+        if frontier:
+            self.add_frontier(frontier)
+        if finished:
+            self.finish_frontier(finished)
+
+    def clear_frontier(self):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.execute("DELETE FROM crawl_frontier")
 
-    # List tracks in archive, one page at a time.
-    def list_tracks_page(self, page=0):
+    # Look up cached artwork by URL.
+    def find_artwork(self, url):
         with closing(self.conn.cursor()) as c:
-            q = "SELECT id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable FROM tracks ORDER BY id LIMIT ? OFFSET ?"
-            params = (self.page_size, self.page_size * page)
-            for row in c.execute(q, params).fetchall():
-                yield Track.from_row(row)
+            q = "SELECT url, sha256, size, etag, last_modified, last_validated, last_used FROM artwork WHERE url = ?"
+            row = c.execute(q, (url,)).fetchone()
+            return Artwork.from_row(row) if row else None
 
-    # List tracks in archive by user_id, one page at a time.
-    def list_user_tracks_page(self, user_id, page=0):
+    # Add artwork to the cache index, replacing any existing entry for the same URL.
+    def add_artwork(self, artwork):
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """INSERT OR REPLACE INTO artwork (url, sha256, size, etag, last_modified, last_validated, last_used)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)"""
+            c.execute(q, (artwork.url, artwork.sha256, artwork.size, artwork.etag, artwork.last_modified,
+                          artwork.last_validated, artwork.last_used))
+            return artwork.url
+
+    # Remove artwork from the cache index. Returns the number of URLs still referring to the same image.
+    def remove_artwork(self, artwork):
+        with self.conn, closing(self.conn.cursor()) as c:
+            c.execute("DELETE FROM artwork WHERE url = ?", (artwork.url,))
+            return c.execute("SELECT count(*) FROM artwork WHERE sha256 = ?", (artwork.sha256,)).fetchone()[0]
+
+    # List cached artwork, least recently used first.
+    def list_artwork_lru(self, limit):
+        with closing(self.conn.cursor()) as c:
+            q = "SELECT url, sha256, size, etag, last_modified, last_validated, last_used FROM artwork ORDER BY last_used LIMIT ?"
+            return [Artwork.from_row(row) for row in c.execute(q, (limit,))]
+
+    # Total size of the distinct images in the artwork cache.
+    def artwork_cache_size(self):
+        with closing(self.conn.cursor()) as c:
+            q = "SELECT coalesce(sum(size), 0) FROM (SELECT DISTINCT sha256, size FROM artwork)"
+            return c.execute(q).fetchone()[0]
+
+    # Look up the incremental crawl state for user_id.
+    def find_crawl_state(self, user_id):
         with closing(self.conn.cursor()) as c:
-            q = "SELECT id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable FROM tracks WHERE user_id = ? ORDER BY id LIMIT ? OFFSET ?"
-            params = (user_id, self.page_size, self.page_size * page)
-            for row in c.execute(q, params).fetchall():
-                yield Track.from_row(row)
+            q = "SELECT {} FROM crawl_state WHERE user_id = ?".format(self.__crawl_state_columns())
+            row = c.execute(q, (user_id,)).fetchone()
+            return CrawlState.from_row(row) if row else None
 
+    # List the crawl state of every user due to be checked at now, in user id order. Users that have never been
+    # crawled (or scheduled) are always due, and come back as a CrawlState with just their user_id.
+    def list_due_crawl_states(self, now):
+        after_id = None
+        while True:
+            states = list(self.list_due_crawl_states_page(now, after_id))
+            if not states:
+                break
+            yield from states
+            after_id = states[-1].user_id
+
+    def list_due_crawl_states_page(self, now, after_id=None):
+        with closing(self.conn.cursor()) as c:
+            q = """SELECT {} FROM users LEFT JOIN crawl_state ON crawl_state.user_id = users.id
+                   WHERE users.id > ? AND (crawl_state.next_check_at IS NULL OR crawl_state.next_check_at <= ?)
+                   ORDER BY users.id LIMIT ?""".format(self.__crawl_state_columns("users.id", "crawl_state."))
+            for row in c.execute(q, (self.__after(after_id), now, self.page_size)).fetchall():
+                yield CrawlState.from_row(row)
+
+    # Record what the API last reported for a user, leaving the high-water mark alone. The scheduling fields are only
+    # changed when given.
+    def update_crawl_status(self, user_id, track_count, etag, last_checked, next_check_at=None, upload_interval=None,
+                            last_new_track_at=None):
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """INSERT INTO crawl_state (user_id, track_count, etag, last_checked, next_check_at, upload_interval,
+                                            last_new_track_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                     track_count=excluded.track_count, etag=excluded.etag, last_checked=excluded.last_checked,
+                     next_check_at=coalesce(excluded.next_check_at, crawl_state.next_check_at),
+                     upload_interval=coalesce(excluded.upload_interval, crawl_state.upload_interval),
+                     last_new_track_at=coalesce(excluded.last_new_track_at, crawl_state.last_new_track_at)"""
+            c.execute(q, (user_id, track_count, etag, last_checked, next_check_at, upload_interval, last_new_track_at))
+
+    # Move a user's high-water mark forward to track, if it's newer than the current mark.
+    def advance_crawl_mark(self, track):
+        if track.created_at is None:
+            return
+        with self.conn, closing(self.conn.cursor()) as c:
+            q = """INSERT INTO crawl_state (user_id, last_track_id, last_track_created_at) VALUES (?, ?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                     last_track_id=excluded.last_track_id, last_track_created_at=excluded.last_track_created_at
+                   WHERE crawl_state.last_track_created_at IS NULL
+                      OR excluded.last_track_created_at > crawl_state.last_track_created_at"""
+            c.execute(q, (track.user_id, track.id, track.created_at))
+
+    # Return the subset of user_ids that are already in the archive.
+    def known_user_ids(self, user_ids):
+        if self.user_ids is not None:
+            return self.user_ids.intersection(user_ids)
+        return self.__known_ids("users", user_ids)
+
+    # Return the subset of track_ids that are already in the archive.
+    def known_track_ids(self, track_ids):
+        if self.track_ids is not None:
+            return self.track_ids.intersection(track_ids)
+        return self.__known_ids("tracks", track_ids)
+
+    def __known_ids(self, table, ids):
+        ids = list(ids)
+        known = set()
+        for i in range(0, len(ids), self.max_query_ids):
+            batch = ids[i:i + self.max_query_ids]
+            q = "SELECT id FROM {} WHERE id IN ({})".format(table, ", ".join("?" * len(batch)))
+            known.update(self.__select_ids(q, batch))
+        return known
+
+    def __select_ids(self, q, params=()):
+        with closing(self.conn.cursor()) as c:
+            return [row[0] for row in c.execute(q, params)]
+
+    # List all users in archive. With stream=True, a single cursor is used for the whole scan instead of paging.
+    def list_all_users(self, stream=False):
+        if stream:
+            return self.__stream_rows(self.__user_query(), (), User.row_factory)
+        return self.__crawl_pages(self.list_users_page)
+
+    # List users in archive, one page at a time, starting after the user with id after_id.
+    def list_users_page(self, after_id=None):
+        with closing(self.conn.cursor()) as c:
+            q = self.__user_query("WHERE id > ?") + " LIMIT ?"
+            params = (self.__after(after_id), self.page_size)
+            c.row_factory = User.row_factory
+            yield from c.execute(q, params).fetchall()
+
+    # List all tracks in archive. With stream=True, a single cursor is used for the whole scan instead of paging.
+    def list_all_tracks(self, stream=False):
+        if stream:
+            return self.__stream_rows(self.__track_query(), (), Track.row_factory)
+        return self.__crawl_pages(self.list_tracks_page)
+
+    # List tracks in archive, one page at a time, starting after the track with id after_id.
+    def list_tracks_page(self, after_id=None):
+        with closing(self.conn.cursor()) as c:
+            q = self.__track_query("WHERE id > ?") + " LIMIT ?"
+            params = (self.__after(after_id), self.page_size)
+            c.row_factory = Track.row_factory
+            yield from c.execute(q, params).fetchall()
+
+    # List all tracks in archive by user_id.
+    def list_all_user_tracks(self, user_id, stream=False):
+        if stream:
+            return self.__stream_rows(self.__track_query("WHERE user_id = ?"), (user_id,), Track.row_factory)
+        return self.__crawl_pages(lambda after_id: self.list_user_tracks_page(user_id, after_id))
+
+    # List tracks in archive by user_id, one page at a time, starting after the track with id after_id.
+    def list_user_tracks_page(self, user_id, after_id=None):
+        with closing(self.conn.cursor()) as c:
+            q = self.__track_query("WHERE user_id = ? AND id > ?") + " LIMIT ?"
+            params = (user_id, self.__after(after_id), self.page_size)
+            c.row_factory = Track.row_factory
+            yield from c.execute(q, params).fetchall()
+
+    # Walk pages in id order, using the last id of each page as the cursor for the next one.
     def __crawl_pages(self, page_gen):
-        for page in itertools.count():
-            count = 0
-            for item in page_gen(page):
+        after_id = None
+        while True:
+            last_id = None
+            for item in page_gen(after_id):
                 yield item
-                count += 1
-            if count == 0:
+                last_id = item.id
+            if last_id is None:
                 break
+            after_id = last_id
+
+    # Stream the results of q through a single cursor, page_size rows at a time, built by row_factory.
+    def __stream_rows(self, q, params, row_factory):
+        with closing(self.conn.cursor()) as c:
+            c.arraysize = self.page_size
+            c.row_factory = row_factory
+            c.execute(q, params)
+            while True:
+                rows = c.fetchmany()
+                if not rows:
+                    break
+                yield from rows
+
+    @staticmethod
+    def __after(after_id):
+        # SQLite integers are signed 64-bit, so this sorts before any id.
+        return -2 ** 63 if after_id is None else after_id
+
+    @staticmethod
+    def __user_query(where=""):
+        return "SELECT id, username, permalink, avatar_url FROM users {} ORDER BY id".format(where)
+
+    @staticmethod
+    def __track_query(where=""):
+        return "SELECT {} FROM tracks {} ORDER BY id".format(Archive.__track_columns(), where)
+
+    @staticmethod
+    def __crawl_state_columns(user_id="user_id", prefix=""):
+        columns = ["last_track_id", "last_track_created_at", "track_count", "etag", "last_checked", "upload_interval",
+                   "last_new_track_at", "next_check_at"]
+        return ", ".join([user_id] + [prefix + column for column in columns])
+
+    @staticmethod
+    def __track_columns(prefix=""):
+        columns = ["id", "permalink", "user_id", "username", "title", "uri", "artwork_url", "is_downloadable",
+                   "is_streamable", "created_at", "sha256"]
+        return ", ".join(prefix + column for column in columns)
+
+    # Turn free text into an FTS5 query: every word is quoted (so punctuation can't break the query syntax) and
+    # matches as a prefix. Returns None if there are no words to search for.
+    @staticmethod
+    def __match_query(query):
+        words = query.split()
+        if not words:
+            return None
+        return " ".join('"{}"*'.format(word.replace('"', '""')) for word in words)
 
     def close(self):
         self.conn.commit()
         self.conn.close()
 
+    # Apply the migrations the database hasn't had yet, all in one transaction: sqlite3 doesn't start one for DDL by
+    # itself, and a migration failing part way would otherwise leave the schema changed but user_version not.
+    def __migrate(self):
+        with self.conn, closing(self.conn.cursor()) as c:
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(self.migrations):
+                c.execute("BEGIN")
+                for migration in self.migrations[version:]:
+                    c.execute(migration)
+                c.execute("PRAGMA user_version = {:d}".format(len(self.migrations)))
+
     # TODO: include create_tables.sql as pkg_resource and replace this again.
     def __init_tables(self):
         with closing(self.conn.cursor()) as c:
@@ -116,3 +612,53 @@ class Archive(object):
               is_streamable boolean,
               FOREIGN KEY(user_id) REFERENCES users(id)
             );""")
+
+
+class BufferedWriter(object):
+
+    # Has no timer of its own (the archive's connection can only be used from its own thread), so callers must flush()
+    # or leave the with block to write out the last rows.
+    def __init__(self, archive, max_rows, max_delay_ms):
+        self.archive = archive
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.users = []
+        self.tracks = []
+        self.frontier = []
+        self.finished = []
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def add_user(self, user):
+        self.users.append(user)
+        self.__maybe_flush()
+        return user.id
+
+    def add_track(self, track):
+        self.tracks.append(track)
+        self.__maybe_flush()
+        return track.id
+
+    def add_frontier(self, user_id, depth):
+        self.frontier.append((user_id, depth))
+        self.__maybe_flush()
+
+    def finish_frontier(self, user_id, depth):
+        self.finished.append((user_id, depth))
+        self.__maybe_flush()
+
+    # Write all buffered rows to the archive.
+    def flush(self):
+        self.archive.write_rows(self.users, self.tracks, self.frontier, self.finished)
+        self.users, self.tracks, self.frontier, self.finished = [], [], [], []
+        self.last_flush = time.monotonic()
+
+    def __maybe_flush(self):
+        pending = len(self.users) + len(self.tracks) + len(self.frontier) + len(self.finished)
+        if pending >= self.max_rows or time.monotonic() - self.last_flush >= self.max_delay:
+            self.flush()
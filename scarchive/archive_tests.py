@@ -1,9 +1,13 @@
 import json
+import os
+import sqlite3
+import tempfile
 import unittest
 
 from contextlib import closing
 
 from .archive import Archive
+from .crawl_state import CrawlState
 from .track import Track
 from .user import User
 
@@ -11,7 +15,7 @@ from .user import User
 class ArchiveTests(unittest.TestCase):
 
     def setUp(self):
-        self.testArchive = lambda: Archive(db_file=":memory:")
+        self.testArchive = lambda: Archive(db_file=":memory:", page_size=25)
 
         # Basic CRUD tests for the users table.
 
@@ -46,7 +50,7 @@ class ArchiveTests(unittest.TestCase):
             for x in range(num_users):
                 archive.add_user(self.__make_test_user(x))
             # Page through them, making sure the page counts make sense.
-            self.__test_pages(archive.list_users_page, [archive.page_size, num_users - archive.page_size])
+            self.__test_pages(archive.list_users_page, [archive.page_size, num_users - archive.page_size, 0])
 
     # Test pagination logic for track query results.
     def test_tracks_paging(self):
@@ -56,12 +60,187 @@ class ArchiveTests(unittest.TestCase):
             for x in range(num_tracks):
                 archive.add_track(self.__make_test_track(x))
             # Page through them, making sure the page counts make sense.
-            self.__test_pages(archive.list_tracks_page, [archive.page_size, num_tracks - archive.page_size])
+            self.__test_pages(archive.list_tracks_page, [archive.page_size, num_tracks - archive.page_size, 0])
+
+    # Test that bulk inserts land in one go and that re-adding existing rows updates them in place.
+    def test_bulk_upsert(self):
+        with closing(self.testArchive()) as archive:
+            users = [self.__make_test_user(x) for x in range(10)]
+            tracks = [self.__make_test_track(x) for x in range(10)]
+            archive.add_users(users)
+            archive.add_tracks(tracks)
+            self.assertEqual([user.id for user in archive.list_all_users()], [user.id for user in users])
+            self.assertEqual(list(archive.list_all_tracks()), tracks)
+
+            tracks[3].uri = "data/3/3.mp3"
+            self.assertEqual(archive.add_track(tracks[3]), tracks[3].id)
+            archive.add_users(users)
+            self.assertEqual(archive.find_track(3).uri, "data/3/3.mp3")
+            self.assertEqual(len(list(archive.list_all_users())), len(users))
+
+    # Test that the buffered writer holds rows until max_rows is reached, and flushes the rest on exit.
+    def test_buffered_writer(self):
+        with closing(self.testArchive()) as archive:
+            with archive.buffered_writer(max_rows=10, max_delay_ms=60000) as writer:
+                for x in range(15):
+                    writer.add_track(self.__make_test_track(x))
+                    self.assertEqual(len(list(archive.list_all_tracks())), 10 if x >= 9 else 0)
+            self.assertEqual(len(list(archive.list_all_tracks())), 15)
+
+    # Test streaming full scans return the same rows as paged scans.
+    def test_streaming_scans(self):
+        with closing(self.testArchive()) as archive:
+            num_tracks = int(archive.page_size * 2.5)
+            archive.add_tracks(self.__make_test_track(x) for x in range(num_tracks))
+            paged = [track.id for track in archive.list_all_tracks()]
+            streamed = [track.id for track in archive.list_all_tracks(stream=True)]
+            self.assertEqual(paged, list(range(num_tracks)))
+            self.assertEqual(streamed, paged)
+            self.assertEqual([track.id for track in archive.list_all_user_tracks(7)], [7])
+
+    # Test batch membership checks, both against the database and the in-memory id cache.
+    def test_known_ids(self):
+        for cache_ids in (False, True):
+            with closing(Archive(db_file=":memory:", cache_ids=cache_ids)) as archive:
+                archive.max_query_ids = 7
+                archive.add_tracks(self.__make_test_track(x) for x in range(0, 40, 2))
+                archive.add_user(self.__make_test_user(1))
+                self.assertEqual(archive.known_track_ids(range(40)), set(range(0, 40, 2)))
+                self.assertEqual(archive.known_track_ids([]), set())
+                self.assertEqual(archive.known_user_ids([1, 2]), {1})
+
+    # Test that migrations are applied once and recorded in user_version.
+    def test_migrations(self):
+        with closing(self.testArchive()) as archive:
+            version = archive.conn.execute("PRAGMA user_version").fetchone()[0]
+            self.assertEqual(version, len(Archive.migrations))
+            indexes = [row[1] for row in archive.conn.execute("PRAGMA index_list(tracks)")]
+            self.assertIn("tracks_user_id", indexes)
+
+    # Test that crawl status updates and the high-water mark are tracked independently.
+    def test_crawl_state(self):
+        with closing(self.testArchive()) as archive:
+            self.assertEqual(archive.find_crawl_state(1), None)
+            archive.update_crawl_status(1, 10, "etag-1", 100.0)
+            self.assertEqual(archive.find_crawl_state(1), CrawlState(1, None, None, 10, "etag-1", 100.0))
+
+            newer, older = self.__make_test_track(2), self.__make_test_track(3)
+            newer.user_id = older.user_id = 1
+            newer.created_at, older.created_at = "2017/04/02 00:00:00 +0000", "2017/04/01 00:00:00 +0000"
+            archive.advance_crawl_mark(newer)
+            archive.advance_crawl_mark(older)
+            archive.update_crawl_status(1, 11, "etag-2", 200.0)
+            self.assertEqual(archive.find_crawl_state(1), CrawlState(1, 2, newer.created_at, 11, "etag-2", 200.0))
+
+    # Test that users are due until they're scheduled, then again once their next check comes around.
+    def test_due_crawl_states(self):
+        with closing(self.testArchive()) as archive:
+            archive.add_users([self.__make_test_user(x) for x in range(1, 61)])
+            self.assertEqual([state.user_id for state in archive.list_due_crawl_states(100.0)], list(range(1, 61)))
+            self.assertEqual(list(archive.list_due_crawl_states_page(100.0, after_id=59)), [CrawlState(60)])
+
+            archive.update_crawl_status(1, 10, "etag-1", 100.0, next_check_at=200.0, upload_interval=50.0,
+                                        last_new_track_at=100.0)
+            archive.update_crawl_status(2, 10, "etag-2", 100.0)
+            self.assertEqual(archive.find_crawl_state(1), CrawlState(1, None, None, 10, "etag-1", 100.0, 50.0, 100.0, 200.0))
+            due = list(archive.list_due_crawl_states(150.0))
+            self.assertEqual([state.user_id for state in due][:2], [2, 3])
+            self.assertEqual(len(due), 59)
+            self.assertEqual([state.user_id for state in archive.list_due_crawl_states(200.0)][:2], [1, 2])
+
+            # Later updates keep the schedule unless they change it.
+            archive.update_crawl_status(1, 11, "etag-3", 200.0)
+            self.assertEqual(archive.find_crawl_state(1), CrawlState(1, None, None, 11, "etag-3", 200.0, 50.0, 100.0, 200.0))
+
+    def test_counters(self):
+        with closing(self.testArchive()) as archive:
+            self.assertEqual(archive.add_to_counter("requests", 0), 0)
+            self.assertEqual(archive.add_to_counter("requests", 3), 3)
+            self.assertEqual(archive.add_to_counter("requests", 2), 5)
+            self.assertEqual(archive.add_to_counter("other", 1), 1)
+            archive.reset_counter("requests")
+            self.assertEqual(archive.add_to_counter("requests", 0), 0)
+
+    # Test that a failed migration leaves no part of itself behind, so the archive can still be opened.
+    def test_failed_migration(self):
+        class BrokenArchive(Archive):
+            migrations = Archive.migrations + ["alter table tracks add column extra text", "not sql"]
+
+        class FixedArchive(Archive):
+            migrations = Archive.migrations + ["alter table tracks add column extra text", "select 1"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_file = os.path.join(tmp_dir, "archive.db")
+            Archive(db_file).close()
+            with self.assertRaises(sqlite3.OperationalError):
+                BrokenArchive(db_file)
+            with closing(FixedArchive(db_file)) as archive:
+                self.assertEqual(archive.conn.execute("PRAGMA user_version").fetchone()[0], len(FixedArchive.migrations))
+
+    # Test that the buffered writer saves followings before marking their user expanded in the crawl frontier.
+    def test_crawl_frontier(self):
+        with closing(self.testArchive()) as archive:
+            with archive.buffered_writer(max_rows=100) as writer:
+                writer.add_frontier(1, 0)
+                writer.add_frontier(1, 0)
+                writer.add_user(self.__make_test_user(2))
+                writer.add_frontier(2, 1)
+                writer.finish_frontier(1, 0)
+                self.assertEqual(archive.list_frontier(), [])
+            self.assertEqual(archive.list_frontier(), [(1, 0, 1), (2, 1, 0)])
+            # Found shallower: it needs expanding again, and only an expansion at its new depth finishes it.
+            archive.add_frontier([(2, 0), (1, 1)])
+            archive.finish_frontier([(2, 1)])
+            self.assertEqual(archive.list_frontier(), [(1, 0, 1), (2, 0, 0)])
+            self.assertEqual(archive.known_user_ids([2]), {2})
+            archive.clear_frontier()
+            self.assertEqual(archive.list_frontier(), [])
 
     def __test_pages(self, page_gen, page_counts):
-        for page_number, page_count in enumerate(page_counts):
-            page = list(page_gen(page_number))
+        after_id = None
+        for page_count in page_counts:
+            page = list(page_gen(after_id))
             self.assertEqual(len(page), page_count)
+            after_id = page[-1].id if page else after_id
+
+    # Test that the search index follows track and user changes, and pages through ranked results.
+    def test_search_tracks(self):
+        with closing(self.testArchive()) as archive:
+            archive.add_users([User(1, "Daft Punk", "daftpunk", None), User(2, "Justice", "justice", None)])
+            tracks = [self.__make_test_track(x) for x in range(10)]
+            for track in tracks:
+                track.user_id = 1 if track.id < 6 else 2
+                track.title = "Around the World {}".format(track.id) if track.id % 2 else "Genesis {}".format(track.id)
+            archive.add_tracks(tracks)
+
+            found = []
+            results, cursor = archive.search_tracks("world", limit=2)
+            while results:
+                self.assertLessEqual(len(results), 2)
+                found.extend(track.id for track in results)
+                results, cursor = archive.search_tracks("world", limit=2, cursor=cursor) if cursor else ([], None)
+            self.assertEqual(sorted(found), [1, 3, 5, 7, 9])
+            self.assertEqual(archive.search_tracks("World 7")[0], [tracks[7]])
+
+            # Words match as prefixes, against the title, the track's username and the user's current username.
+            self.assertEqual([t.id for t in archive.search_tracks("daf gen")[0]], [0, 2, 4])
+            self.assertEqual([t.id for t in archive.search_tracks("gen", user_id=2)[0]], [6, 8])
+            self.assertEqual(archive.search_facets("gen"), [(1, "Daft Punk", 3), (2, "Justice", 2)])
+            # Re-adding an unchanged user leaves the index alone.
+            total_changes = archive.conn.total_changes
+            archive.add_users([User(2, "Justice", "justice", None)])
+            self.assertEqual(archive.conn.total_changes - total_changes, 1)
+            archive.add_user(User(2, "Justice Renamed", "justice", None))
+            self.assertEqual(sorted(t.id for t in archive.search_tracks("renamed")[0]), [6, 7, 8, 9])
+
+            tracks[0].title = "Something else"
+            archive.add_track(tracks[0])
+            self.assertEqual([t.id for t in archive.search_tracks("genesis")[0]], [2, 4, 6, 8])
+            self.assertEqual(archive.search_tracks('" *')[0], [])
+            self.assertEqual(archive.search_tracks("  "), ([], None))
+            for cursor in ["", "abc", "1.5", "1.5:", "x:3"]:
+                with self.assertRaisesRegex(ValueError, "Invalid search cursor"):
+                    archive.search_tracks("world", cursor=cursor)
 
     @staticmethod
     def __make_test_user(x):
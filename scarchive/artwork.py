@@ -0,0 +1,30 @@
+class Artwork(object):
+
+    # An artwork image in the on-disk cache. Images are stored by the sha256 of their content, so several URLs
+    # serving the same image share one file.
+    def __init__(self, url, sha256, size, etag=None, last_modified=None, last_validated=None, last_used=None):
+        self.url = url
+        self.sha256 = sha256
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.last_validated = last_validated
+        self.last_used = last_used
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return (self.url == other.url and
+                    self.sha256 == other.sha256 and
+                    self.size == other.size and
+                    self.etag == other.etag and
+                    self.last_modified == other.last_modified and
+                    self.last_validated == other.last_validated and
+                    self.last_used == other.last_used)
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @staticmethod
+    def from_row(row):
+        return Artwork(*row)
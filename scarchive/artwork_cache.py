@@ -0,0 +1,163 @@
+import aiohttp
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from .artwork import Artwork
+
+
+class ArtworkCache(object):
+
+    # An on-disk cache of artwork images, shared by every track that uses the same artwork URL. The index (URL to
+    # content hash, HTTP validators and last use) lives in the archive DB; the images themselves are stored under
+    # cache_dir by content hash, so identical images fetched from different URLs are only stored once. Entries
+    # younger than max_age seconds are served without asking the server; older ones are revalidated with
+    # If-None-Match/If-Modified-Since, and served stale if that fails. Least recently used entries are evicted once the cache exceeds max_bytes.
+    def __init__(self, archive, client, cache_dir, max_bytes=1024 ** 3, max_age=24 * 60 * 60):
+        self.archive = archive
+        self.client = client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.total_bytes = None
+
+        # Metrics.
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.bytes_saved = 0
+
+        # Requests in flight, by URL, so concurrent requests for the same URL share one fetch.
+        self.__pending = {}
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "stale": self.stale,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hit_rate,
+            "bytes_saved": self.bytes_saved,
+            "total_bytes": self.total_bytes,
+        }
+
+    # Return the image at url, from the cache if possible.
+    async def get(self, url):
+        pending = self.__pending.get(url)
+        if pending is not None:
+            data = await asyncio.shield(pending)
+            self.coalesced += 1
+            self.hits += 1
+            self.bytes_saved += len(data)
+            return data
+        future = asyncio.ensure_future(self.__get(url))
+        self.__pending[url] = future
+        future.add_done_callback(lambda f: self.__pending.pop(url, None))
+        return await asyncio.shield(future)
+
+    async def __get(self, url):
+        if self.total_bytes is None:
+            self.total_bytes = await self.archive.artwork_cache_size()
+
+        now = time.time()
+        artwork = await self.archive.find_artwork(url)
+        data = await self.__read_blob(artwork.sha256) if artwork is not None else None
+
+        if data is not None:
+            fresh = artwork.last_validated is not None and now - artwork.last_validated < self.max_age
+            if not fresh:
+                try:
+                    new_data, etag, last_modified = await self.client.revalidate_bytes(
+                        url, etag=artwork.etag, last_modified=artwork.last_modified)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # Better the image we have than none; it's revalidated again next time.
+                    logging.warning("url={} Failed to revalidate artwork, using cached copy: {}".format(url, e))
+                    self.stale += 1
+                else:
+                    if new_data is not None:
+                        return await self.__store(url, new_data, etag, last_modified, replaces=artwork)
+                    self.revalidated += 1
+                    artwork.etag, artwork.last_modified, artwork.last_validated = etag, last_modified, now
+            self.hits += 1
+            self.bytes_saved += len(data)
+            artwork.last_used = now
+            await self.archive.add_artwork(artwork)
+            return data
+
+        # The image is missing from disk, so forget about it and fetch it again.
+        if artwork is not None:
+            await self.__remove(artwork)
+        data, etag, last_modified = await self.client.revalidate_bytes(url)
+        return await self.__store(url, data, etag, last_modified)
+
+    async def __store(self, url, data, etag, last_modified, replaces=None):
+        self.misses += 1
+        now = time.time()
+        sha256 = hashlib.sha256(data).hexdigest()
+        if await self.__write_blob(sha256, data):
+            self.total_bytes += len(data)
+        if replaces is not None and replaces.sha256 != sha256:
+            await self.__remove(replaces)
+        await self.archive.add_artwork(Artwork(url, sha256, len(data), etag, last_modified, now, now))
+        await self.__evict()
+        return data
+
+    async def __evict(self):
+        while self.total_bytes > self.max_bytes:
+            lru = await self.archive.list_artwork_lru(100)
+            if not lru:
+                break
+            for artwork in lru:
+                await self.__remove(artwork)
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    # Drop artwork from the index, and delete its image if no other URL uses it.
+    async def __remove(self, artwork):
+        if await self.archive.remove_artwork(artwork) == 0:
+            self.total_bytes -= artwork.size
+            try:
+                os.remove(self.__blob_path(artwork.sha256))
+            except FileNotFoundError:
+                logging.warning("sha256={} Cached artwork already missing".format(artwork.sha256))
+
+    async def __read_blob(self, sha256):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.__read_file, self.__blob_path(sha256))
+
+    # Returns True if the blob is new, or False if an identical image was already cached.
+    async def __write_blob(self, sha256, data):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.__write_file, self.__blob_path(sha256), data)
+
+    def __blob_path(self, sha256):
+        return os.path.join(self.cache_dir, sha256[:2], sha256)
+
+    @staticmethod
+    def __read_file(path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def __write_file(path, data):
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+
+from .artwork_cache import ArtworkCache
+from .async_archive import AsyncArchive
+from .soundcloud import Client
+from .soundcloud_tests import StubServer
+
+
+class ArtworkCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.requests = []
+        self.images = {"/a.jpg": b"a" * 1000, "/b.jpg": b"b" * 1000, "/c.jpg": b"c" * 1000, "/a2.jpg": b"a" * 1000}
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmp_dir.cleanup()
+
+    async def image(self, request):
+        self.requests.append((request.path, request.headers.get("If-None-Match")))
+        await asyncio.sleep(0.01)
+        if self.images[request.path] is None:
+            return web.Response(status=503)
+        if request.headers.get("If-None-Match") == request.path:
+            return web.Response(status=304)
+        return web.Response(body=self.images[request.path], headers={"ETag": request.path})
+
+    def run_with_cache(self, test, **kwargs):
+        async def run():
+            server = StubServer([web.get("/{name}", self.image)])
+            await server.start()
+            archive = AsyncArchive(":memory:", readers=0)
+            try:
+                async with Client(client_id="test") as client:
+                    cache_dir = os.path.join(self.tmp_dir.name, "artwork")
+                    await test(server.url, ArtworkCache(archive, client, cache_dir, **kwargs))
+            finally:
+                await archive.close()
+                await server.stop()
+
+        self.loop.run_until_complete(run())
+
+    # Concurrent requests for one URL should share one fetch, and later requests should be served from disk.
+    def test_hits_and_coalescing(self):
+        async def test(url, cache):
+            results = await asyncio.gather(*[cache.get(url + "/a.jpg") for _ in range(5)])
+            self.assertEqual(results, [self.images["/a.jpg"]] * 5)
+            self.assertEqual(await cache.get(url + "/a.jpg"), self.images["/a.jpg"])
+            self.assertEqual(len(self.requests), 1)
+            self.assertEqual((cache.hits, cache.misses, cache.coalesced), (5, 1, 4))
+            self.assertEqual(cache.bytes_saved, 5000)
+
+        self.run_with_cache(test)
+
+    # Stale entries should be revalidated with their ETag rather than downloaded again.
+    def test_revalidation(self):
+        async def test(url, cache):
+            await cache.get(url + "/a.jpg")
+            self.assertEqual(await cache.get(url + "/a.jpg"), self.images["/a.jpg"])
+            self.assertEqual(self.requests, [("/a.jpg", None), ("/a.jpg", "/a.jpg")])
+            self.assertEqual(cache.revalidated, 1)
+
+        self.run_with_cache(test, max_age=0)
+
+    # If revalidation fails, the cached image is still served.
+    def test_revalidation_failure(self):
+        async def test(url, cache):
+            await cache.get(url + "/a.jpg")
+            self.images["/a.jpg"] = None
+            self.assertEqual(await cache.get(url + "/a.jpg"), b"a" * 1000)
+            self.assertEqual((cache.stale, cache.revalidated), (1, 0))
+
+        self.run_with_cache(test, max_age=0)
+
+    # Identical images should be stored once, and the least recently used should be evicted first.
+    def test_dedup_and_eviction(self):
+        async def test(url, cache):
+            await cache.get(url + "/a.jpg")
+            await cache.get(url + "/a2.jpg")
+            self.assertEqual(cache.total_bytes, 1000)
+            await cache.get(url + "/b.jpg")
+            await cache.get(url + "/a.jpg")
+            await cache.get(url + "/c.jpg")
+            self.assertEqual(cache.total_bytes, 2000)
+            self.assertEqual(await cache.archive.find_artwork(url + "/b.jpg"), None)
+            self.assertNotEqual(await cache.archive.find_artwork(url + "/a.jpg"), None)
+
+        self.run_with_cache(test, max_bytes=2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .archive import Archive
+from .metrics import Metrics
+
+
+class AsyncArchive(object):
+
+    # Wraps Archive so coroutines can use it without blocking the event loop. All writes go through one writer
+    # connection on a dedicated thread; reads are spread over a small pool of threads, each with its own connection.
+    # The database is switched to WAL mode so readers don't block on the writer. With readers=0, reads also go to the
+    # writer thread. That's always the case for ":memory:" databases, since each connection would get its own.
+    def __init__(self, db_file, readers=2, page_size=500, cache_ids=False, metrics=None):
+        if db_file == ":memory:":
+            readers = 0
+        self.db_file = db_file
+        self.page_size = page_size
+        self.writer = Archive(db_file, page_size=page_size, cache_ids=cache_ids, check_same_thread=False)
+        self.writer.conn.execute("PRAGMA journal_mode=WAL")
+        self.__writer_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Known-id checks are answered from the writer's in-memory cache when it has one. They still run on the writer
+        # thread, since that's the thread which updates the cache.
+        self.cache_ids = cache_ids
+        self.readers = []
+        self.__reader_executor = ThreadPoolExecutor(max_workers=readers) if readers > 0 else None
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.metrics = metrics or Metrics()
+
+    async def add_user(self, user):
+        return await self.__write("add_user", lambda archive: archive.add_user(user))
+
+    async def add_users(self, users):
+        users = list(users)
+        return await self.__write("add_users", lambda archive: archive.add_users(users))
+
+    async def add_track(self, track):
+        return await self.__write("add_track", lambda archive: archive.add_track(track))
+
+    async def add_tracks(self, tracks):
+        tracks = list(tracks)
+        return await self.__write("add_tracks", lambda archive: archive.add_tracks(tracks))
+
+    async def update_crawl_status(self, user_id, track_count, etag, last_checked, next_check_at=None,
+                                  upload_interval=None, last_new_track_at=None):
+        return await self.__write("update_crawl_status", lambda archive: archive.update_crawl_status(
+            user_id, track_count, etag, last_checked, next_check_at, upload_interval, last_new_track_at))
+
+    async def advance_crawl_mark(self, track):
+        return await self.__write("advance_crawl_mark", lambda archive: archive.advance_crawl_mark(track))
+
+    async def add_artwork(self, artwork):
+        return await self.__write("add_artwork", lambda archive: archive.add_artwork(artwork))
+
+    async def remove_artwork(self, artwork):
+        return await self.__write("remove_artwork", lambda archive: archive.remove_artwork(artwork))
+
+    async def find_artwork(self, url):
+        return await self.__read("find_artwork", lambda archive: archive.find_artwork(url))
+
+    async def list_artwork_lru(self, limit):
+        return await self.__read("list_artwork_lru", lambda archive: archive.list_artwork_lru(limit))
+
+    async def artwork_cache_size(self):
+        return await self.__read("artwork_cache_size", lambda archive: archive.artwork_cache_size())
+
+    async def enqueue_jobs(self, kind, items, requeue=("done", "failed")):
+        items = list(items)
+        return await self.__write("enqueue_jobs", lambda archive: archive.enqueue_jobs(kind, items, requeue))
+
+    async def claim_jobs(self, kind, owner, now, limit=1, lease_seconds=60, max_attempts=5):
+        return await self.__write(
+            "claim_jobs", lambda archive: archive.claim_jobs(kind, owner, now, limit, lease_seconds, max_attempts))
+
+    async def renew_leases(self, job_ids, owner, lease_expires):
+        return await self.__write("renew_leases", lambda archive: archive.renew_leases(job_ids, owner, lease_expires))
+
+    async def complete_job(self, job_id, owner):
+        return await self.__write("complete_job", lambda archive: archive.complete_job(job_id, owner))
+
+    async def fail_job(self, job_id, owner, error, max_attempts=5):
+        return await self.__write("fail_job", lambda archive: archive.fail_job(job_id, owner, error, max_attempts))
+
+    async def find_job(self, kind, key):
+        return await self.__read("find_job", lambda archive: archive.find_job(kind, key))
+
+    async def cancel_jobs(self, kind):
+        return await self.__write("cancel_jobs", lambda archive: archive.cancel_jobs(kind))
+
+    async def add_to_counter(self, name, delta):
+        return await self.__write("add_to_counter", lambda archive: archive.add_to_counter(name, delta))
+
+    async def reset_counter(self, name):
+        return await self.__write("reset_counter", lambda archive: archive.reset_counter(name))
+
+    async def write_rows(self, users, tracks, frontier, finished):
+        return await self.__write(
+            "write_rows", lambda archive: archive.write_rows(users, tracks, frontier, finished))
+
+    async def list_frontier(self):
+        return await self.__read("list_frontier", lambda archive: archive.list_frontier())
+
+    async def clear_frontier(self):
+        return await self.__write("clear_frontier", lambda archive: archive.clear_frontier())
+
+    def buffered_writer(self, max_rows=500, max_delay_ms=1000):
+        return AsyncBufferedWriter(self, max_rows, max_delay_ms)
+
+    async def count_active_jobs(self, kinds):
+        return await self.__read("count_active_jobs", lambda archive: archive.count_active_jobs(kinds))
+
+    async def count_jobs(self):
+        return await self.__read("count_jobs", lambda archive: archive.count_jobs())
+
+    async def find_tracks_by_sha256(self, sha256):
+        return await self.__read("find_tracks_by_sha256", lambda archive: archive.find_tracks_by_sha256(sha256))
+
+    async def list_duplicate_sha256s(self):
+        return await self.__read("list_duplicate_sha256s", lambda archive: archive.list_duplicate_sha256s())
+
+    async def search_tracks(self, query, limit=20, cursor=None, user_id=None):
+        return await self.__read("search_tracks", lambda archive: archive.search_tracks(query, limit, cursor, user_id))
+
+    async def search_facets(self, query, limit=20):
+        return await self.__read("search_facets", lambda archive: archive.search_facets(query, limit))
+
+    async def find_user(self, user_id):
+        return await self.__read("find_user", lambda archive: archive.find_user(user_id))
+
+    async def find_track(self, track_id):
+        return await self.__read("find_track", lambda archive: archive.find_track(track_id))
+
+    async def find_crawl_state(self, user_id):
+        return await self.__read("find_crawl_state", lambda archive: archive.find_crawl_state(user_id))
+
+    async def list_due_crawl_states_page(self, now, after_id=None):
+        return await self.__read("list_due_crawl_states_page", lambda archive: list(archive.list_due_crawl_states_page(now, after_id)))
+
+    async def list_due_crawl_states(self, now):
+        after_id = None
+        while True:
+            states = await self.list_due_crawl_states_page(now, after_id)
+            if not states:
+                break
+            for state in states:
+                yield state
+            after_id = states[-1].user_id
+
+    async def known_user_ids(self, user_ids):
+        user_ids = list(user_ids)
+        if self.cache_ids:
+            return await self.__write("known_user_ids", lambda archive: archive.known_user_ids(user_ids))
+        return await self.__read("known_user_ids", lambda archive: archive.known_user_ids(user_ids))
+
+    async def known_track_ids(self, track_ids):
+        track_ids = list(track_ids)
+        if self.cache_ids:
+            return await self.__write("known_track_ids", lambda archive: archive.known_track_ids(track_ids))
+        return await self.__read("known_track_ids", lambda archive: archive.known_track_ids(track_ids))
+
+    async def list_users_page(self, after_id=None):
+        return await self.__read("list_users_page", lambda archive: list(archive.list_users_page(after_id)))
+
+    async def list_tracks_page(self, after_id=None):
+        return await self.__read("list_tracks_page", lambda archive: list(archive.list_tracks_page(after_id)))
+
+    async def list_user_tracks_page(self, user_id, after_id=None):
+        return await self.__read("list_user_tracks_page", lambda archive: list(archive.list_user_tracks_page(user_id, after_id)))
+
+    async def list_all_users(self):
+        async for user in self.__crawl_pages(self.list_users_page):
+            yield user
+
+    async def list_all_tracks(self):
+        async for track in self.__crawl_pages(self.list_tracks_page):
+            yield track
+
+    async def list_all_user_tracks(self, user_id):
+        async for track in self.__crawl_pages(lambda after_id: self.list_user_tracks_page(user_id, after_id)):
+            yield track
+
+    async def close(self):
+        await self.__write("close", lambda archive: archive.close())
+        self.__writer_executor.shutdown()
+        if self.__reader_executor is not None:
+            self.__reader_executor.shutdown()
+        for reader in self.readers:
+            reader.close()
+
+    async def __crawl_pages(self, page_gen):
+        after_id = None
+        while True:
+            page = await page_gen(after_id)
+            if not page:
+                break
+            for item in page:
+                yield item
+            after_id = page[-1].id
+
+    # Writes and reads are timed against the Archive method they call, including time spent queued for a thread.
+    async def __write(self, method, fn):
+        loop = asyncio.get_event_loop()
+        with self.metrics.timer("archive_seconds", method=method):
+            return await loop.run_in_executor(self.__writer_executor, fn, self.writer)
+
+    async def __read(self, method, fn):
+        if self.__reader_executor is None:
+            return await self.__write(method, fn)
+        loop = asyncio.get_event_loop()
+        with self.metrics.timer("archive_seconds", method=method):
+            return await loop.run_in_executor(self.__reader_executor, lambda: fn(self.__reader()))
+
+    # Each reader thread lazily opens its own connection.
+    def __reader(self):
+        reader = getattr(self.__local, "archive", None)
+        if reader is None:
+            reader = Archive(self.db_file, page_size=self.page_size, check_same_thread=False)
+            self.__local.archive = reader
+            with self.__lock:
+                self.readers.append(reader)
+        return reader
+
+
+class AsyncBufferedWriter(object):
+
+    # Archive.buffered_writer for coroutines. Rows are buffered on the event loop, and each flush hands all of them to
+    # the writer thread in one go, so flushes are written in the order they were made even when several coroutines
+    # share the writer. Inside async with, rows are also flushed on a timer, so none wait longer than max_delay_ms
+    # once adds stop.
+    def __init__(self, archive, max_rows, max_delay_ms):
+        self.archive = archive
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.users = []
+        self.tracks = []
+        self.frontier = []
+        self.finished = []
+        self.last_flush = time.monotonic()
+        self.__timer = None
+
+    async def __aenter__(self):
+        self.__timer = asyncio.ensure_future(self.__flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__timer.cancel()
+        await asyncio.gather(self.__timer, return_exceptions=True)
+        await self.flush()
+
+    async def add_user(self, user):
+        self.users.append(user)
+        await self.__maybe_flush()
+        return user.id
+
+    async def add_track(self, track):
+        self.tracks.append(track)
+        await self.__maybe_flush()
+        return track.id
+
+    async def add_frontier(self, user_id, depth):
+        self.frontier.append((user_id, depth))
+        await self.__maybe_flush()
+
+    async def finish_frontier(self, user_id, depth):
+        self.finished.append((user_id, depth))
+        await self.__maybe_flush()
+
+    async def flush(self):
+        users, tracks, frontier, finished = self.users, self.tracks, self.frontier, self.finished
+        self.users, self.tracks, self.frontier, self.finished = [], [], [], []
+        self.last_flush = time.monotonic()
+        await self.archive.write_rows(users, tracks, frontier, finished)
+
+    def __pending(self):
+        return len(self.users) + len(self.tracks) + len(self.frontier) + len(self.finished)
+
+    async def __maybe_flush(self):
+        if self.__pending() >= self.max_rows or time.monotonic() - self.last_flush >= self.max_delay:
+            await self.flush()
+
+    async def __flush_periodically(self):
+        while True:
+            await asyncio.sleep(max(0.0, self.last_flush + self.max_delay - time.monotonic()))
+            if time.monotonic() - self.last_flush < self.max_delay:
+                continue
+            if self.__pending():
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logging.error("error={} Failed to flush buffered rows".format(e))
+            else:
+                self.last_flush = time.monotonic()
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from .async_archive import AsyncArchive
+from .track import Track
+
+
+class AsyncArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmp_dir.name, "archive.db")
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmp_dir.cleanup()
+
+    # Writes made on the writer thread should be visible to the reader pool.
+    def test_read_your_writes(self):
+        async def test():
+            archive = AsyncArchive(self.db_file, readers=2, page_size=10)
+            try:
+                await archive.add_tracks(self.make_test_track(x) for x in range(25))
+                self.assertEqual((await archive.find_track(3)).id, 3)
+                self.assertEqual(await archive.known_track_ids([1, 30]), {1})
+                self.assertEqual([track.id async for track in archive.list_all_tracks()], list(range(25)))
+                results = await asyncio.gather(*[archive.find_track(x) for x in range(25)])
+                self.assertEqual([track.id for track in results], list(range(25)))
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    # ":memory:" databases always run everything on the single writer connection, whatever readers says.
+    def test_memory_database(self):
+        async def test():
+            archive = AsyncArchive(":memory:", cache_ids=True)
+            try:
+                await archive.add_track(self.make_test_track(1))
+                self.assertEqual(await archive.known_track_ids([1, 2]), {1})
+                self.assertEqual((await archive.find_track(1)).id, 1)
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    # The buffered writer flushes once max_rows are buffered, and the rest on exit, without blocking the event loop.
+    def test_buffered_writer(self):
+        async def test():
+            archive = AsyncArchive(self.db_file, readers=2)
+            try:
+                async with archive.buffered_writer(max_rows=10, max_delay_ms=60000) as writer:
+                    for x in range(15):
+                        await writer.add_track(self.make_test_track(x))
+                        tracks = [track async for track in archive.list_all_tracks()]
+                        self.assertEqual(len(tracks), 10 if x >= 9 else 0)
+                    await writer.add_frontier(1, 0)
+                    await writer.finish_frontier(1, 0)
+                self.assertEqual(len([track async for track in archive.list_all_tracks()]), 15)
+                self.assertEqual(await archive.list_frontier(), [(1, 0, 1)])
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    # Rows are flushed after max_delay_ms even when nothing else is added.
+    def test_buffered_writer_timer(self):
+        async def test():
+            archive = AsyncArchive(self.db_file)
+            try:
+                async with archive.buffered_writer(max_rows=10, max_delay_ms=50) as writer:
+                    await writer.add_track(self.make_test_track(1))
+                    await asyncio.sleep(0.3)
+                    self.assertEqual([track.id async for track in archive.list_all_tracks()], [1])
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    @staticmethod
+    def make_test_track(x):
+        return Track(
+            id=x,
+            permalink="https://soundcloud.com/{}/{}".format(x, x),
+            user_id=x,
+            username="fake user {}".format(x),
+            title="fake track {}".format(x),
+            uri=None,
+            artwork_url=None,
+            is_downloadable=False,
+            is_streamable=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+class CrawlState(object):
+
+    # Per-user bookkeeping for incremental crawls: the newest archived track (the high-water mark), plus the
+    # track_count and ETag last seen for the user, and when they were last checked. For scheduling, it also has the
+    # user's upload cadence (seconds between uploads), when a crawl last found new tracks, and when the user is
+    # next due to be checked.
+    def __init__(self, user_id, last_track_id=None, last_track_created_at=None, track_count=None, etag=None,
+                 last_checked=None, upload_interval=None, last_new_track_at=None, next_check_at=None):
+        self.user_id = user_id
+        self.last_track_id = last_track_id
+        self.last_track_created_at = last_track_created_at
+        self.track_count = track_count
+        self.etag = etag
+        self.last_checked = last_checked
+        self.upload_interval = upload_interval
+        self.last_new_track_at = last_new_track_at
+        self.next_check_at = next_check_at
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return (self.user_id == other.user_id and
+                    self.last_track_id == other.last_track_id and
+                    self.last_track_created_at == other.last_track_created_at and
+                    self.track_count == other.track_count and
+                    self.etag == other.etag and
+                    self.last_checked == other.last_checked and
+                    self.upload_interval == other.upload_interval and
+                    self.last_new_track_at == other.last_new_track_at and
+                    self.next_check_at == other.next_check_at)
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @staticmethod
+    def from_row(row):
+        return CrawlState(*row)
@@ -0,0 +1,102 @@
+import hashlib
+import io
+import os
+
+from .tagging import id3_tag_size
+
+# AudioHash and HashingFile only hash the data they're given, so they run inline on the event loop as a download
+# streams in. hash_audio_file and link_duplicate block on the filesystem, so callers run them on an executor.
+
+
+class AudioHash(object):
+
+    # A SHA-256 of a track's audio, fed a chunk at a time. Leading ID3v2 tags are skipped, so the same audio hashes
+    # the same whether it's untagged, tagged inline while downloading or tagged afterwards.
+    def __init__(self):
+        self.__sha256 = hashlib.sha256()
+        self.__header = b""
+        self.__skip = 0
+        self.__in_audio = False
+
+    def update(self, data):
+        while data and not self.__in_audio:
+            if self.__skip:
+                skipped = min(self.__skip, len(data))
+                self.__skip -= skipped
+                data = data[skipped:]
+                continue
+            needed = 10 - len(self.__header)
+            self.__header += data[:needed]
+            data = data[needed:]
+            if len(self.__header) < 10:
+                return
+            tag_size = id3_tag_size(self.__header)
+            if tag_size:
+                self.__skip = tag_size - 10
+            else:
+                self.__sha256.update(self.__header)
+                self.__in_audio = True
+            self.__header = b""
+        if data:
+            self.__sha256.update(data)
+
+    def hexdigest(self):
+        sha256 = self.__sha256.copy()
+        sha256.update(self.__header)
+        return sha256.hexdigest()
+
+
+class HashingFile(object):
+
+    # Wraps a file being downloaded into, hashing everything written to it. The client only ever truncates the file
+    # back to empty (to start a download over), so that's all this supports.
+    def __init__(self, fd, audio_hash=None):
+        self.fd = fd
+        self.audio_hash = audio_hash or AudioHash()
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        return self.fd.seek(pos, whence)
+
+    def tell(self):
+        return self.fd.tell()
+
+    def truncate(self):
+        if self.fd.tell() != 0:
+            raise io.UnsupportedOperation("HashingFile can only be truncated to empty")
+        self.audio_hash = AudioHash()
+        return self.fd.truncate()
+
+    def write(self, data):
+        self.audio_hash.update(data)
+        return self.fd.write(data)
+
+
+# Hash the file at path, e.g. to pick up hashing where an interrupted download left off. A missing file hashes as
+# empty.
+def hash_audio_file(path, chunk_size=1024 * 1024):
+    audio_hash = AudioHash()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                audio_hash.update(chunk)
+    except FileNotFoundError:
+        pass
+    return audio_hash
+
+
+# Replace dst with a hardlink to src, which holds identical audio. Returns False (leaving dst alone) if that isn't
+# possible, e.g. src is gone or on another filesystem.
+def link_duplicate(src, dst):
+    try:
+        if os.path.samefile(src, dst):
+            return True
+        tmp_path = "{}.{}.link".format(dst, os.getpid())
+        os.link(src, tmp_path)
+    except OSError:
+        return False
+    try:
+        os.replace(tmp_path, dst)
+    except OSError:
+        os.remove(tmp_path)
+        return False
+    return True
@@ -0,0 +1,87 @@
+import io
+import os
+import tempfile
+import unittest
+
+from .archive import Archive
+from .dedup import AudioHash, HashingFile, hash_audio_file, link_duplicate
+from .tagging import build_id3_tag
+from .tagging_tests import MP3_FRAME
+from .track import Track
+
+
+class DedupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.track = Track(1, "https://soundcloud.com/1/1", 1, "fake user 1", "fake track 1", None, None, False, True)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    # The same audio hashes the same however it's tagged, and however it's split into chunks.
+    def test_audio_hash(self):
+        audio = MP3_FRAME * 10
+        expected = self.hash(audio)
+        tagged = build_id3_tag(self.track) + build_id3_tag(self.track, artwork=b"jpeg") + audio
+        for chunk_size in (1, 7, 4096):
+            self.assertEqual(self.hash(tagged, chunk_size), expected)
+        self.assertNotEqual(self.hash(audio[:-1]), expected)
+        self.assertEqual(self.hash(b"ID3", 1), self.hash(b"ID3"))
+
+    def test_hashing_file(self):
+        fd = io.BytesIO()
+        hashing_fd = HashingFile(fd)
+        hashing_fd.write(b"stale")
+        with self.assertRaises(io.UnsupportedOperation):
+            hashing_fd.truncate()
+        hashing_fd.seek(0)
+        hashing_fd.truncate()
+        hashing_fd.write(MP3_FRAME)
+        self.assertEqual(hashing_fd.audio_hash.hexdigest(), self.hash(MP3_FRAME))
+
+        # Resuming picks up the hash of what's already on disk.
+        path = os.path.join(self.tmp_dir.name, "1.mp3.part")
+        self.assertEqual(hash_audio_file(path).hexdigest(), self.hash(b""))
+        with open(path, "wb") as f:
+            f.write(build_id3_tag(self.track) + MP3_FRAME)
+        with open(path, "ab") as f:
+            HashingFile(f, hash_audio_file(path)).write(MP3_FRAME)
+        self.assertEqual(hash_audio_file(path).hexdigest(), self.hash(MP3_FRAME * 2))
+
+    def test_link_duplicate(self):
+        src, dst = os.path.join(self.tmp_dir.name, "1.mp3"), os.path.join(self.tmp_dir.name, "2.mp3")
+        for path in (src, dst):
+            with open(path, "wb") as f:
+                f.write(MP3_FRAME)
+        self.assertTrue(link_duplicate(src, dst))
+        self.assertTrue(os.path.samefile(src, dst))
+        self.assertTrue(link_duplicate(src, dst))
+        self.assertFalse(link_duplicate(os.path.join(self.tmp_dir.name, "missing.mp3"), dst))
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), ["1.mp3", "2.mp3"])
+
+    def test_archive_hashes(self):
+        archive = Archive(":memory:")
+        tracks = [Track(x, "p", 1, "u", "t", "/data/{}.mp3".format(x), None, False, True, None, "a" * 64) for x in range(3)]
+        tracks[2].sha256 = "b" * 64
+        archive.add_tracks(tracks)
+        self.assertEqual([track.id for track in archive.find_tracks_by_sha256("a" * 64)], [0, 1])
+        self.assertEqual(archive.list_duplicate_sha256s(), ["a" * 64])
+
+        # Saving a track without a hash doesn't forget the one already recorded.
+        tracks[0].sha256 = None
+        archive.add_track(tracks[0])
+        self.assertEqual(archive.find_track(0).sha256, "a" * 64)
+        archive.close()
+
+    @staticmethod
+    def hash(data, chunk_size=None):
+        audio_hash = AudioHash()
+        chunk_size = chunk_size or max(1, len(data))
+        for i in range(0, len(data), chunk_size):
+            audio_hash.update(data[i:i + chunk_size])
+        return audio_hash.hexdigest()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import random
+import time
+
+from aiohttp import web
+
+# One MPEG-1 Layer III frame header (128 kbps, 44.1 kHz); frames are 417 bytes long.
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64"
+MP3_FRAME_SIZE = 417
+
+
+class FakeSoundcloud(object):
+
+    # A local stand-in for the Soundcloud API, for load testing the pipeline without touching the real one. Users
+    # 1..num_users each have tracks_per_user tracks and follow followings_per_user other users; everything is generated
+    # from ids, so nothing is stored and any size of catalogue costs the same to serve. Point Client.base_url at url.
+    #
+    # Every request waits latency seconds (plus up to jitter more), fails with a 500 with probability error_rate, and
+    # gets a 429 (with Retry-After) once more than quota requests arrive in a second. Tracks are track_size bytes of
+    # valid MP3 frames, unique per track, and can be resumed with Range requests; artwork is artwork_size bytes.
+    def __init__(self, num_users=100, tracks_per_user=20, followings_per_user=10, track_size=256 * 1024,
+                 artwork_size=16 * 1024, latency=0.0, jitter=0.0, error_rate=0.0, quota=None, chunk_size=64 * 1024,
+                 seed=0):
+        self.num_users = num_users
+        self.tracks_per_user = tracks_per_user
+        self.followings_per_user = followings_per_user
+        self.track_size = track_size
+        self.artwork_size = artwork_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota = quota
+        self.chunk_size = chunk_size
+        self.random = random.Random(seed)
+        self.url = None
+
+        # Stats.
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+
+        self.__window = (0, 0)
+        self.__runner = None
+        self.app = web.Application(middlewares=[self.__simulate])
+        self.app.router.add_get("/resolve", self.__resolve)
+        self.app.router.add_get("/users/{id}", self.__user)
+        self.app.router.add_get("/users/{id}/tracks", self.__user_tracks)
+        self.app.router.add_get("/users/{id}/followings", self.__user_followings)
+        self.app.router.add_get("/tracks/{id}", self.__track)
+        self.app.router.add_get("/tracks/{id}/stream", self.__stream)
+        self.app.router.add_get("/tracks/{id}/download", self.__stream)
+        self.app.router.add_get("/artwork/{name}", self.__artwork)
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.__runner = web.AppRunner(self.app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, port)
+        await site.start()
+        self.url = "http://{}:{}".format(host, site._server.sockets[0].getsockname()[1])
+        return self.url
+
+    async def stop(self):
+        await self.__runner.cleanup()
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "bytes_sent": self.bytes_sent,
+        }
+
+    def user_ids(self):
+        return range(1, self.num_users + 1)
+
+    def user_json(self, user_id):
+        return {
+            "kind": "user",
+            "id": user_id,
+            "username": "user {}".format(user_id),
+            "permalink": "user{}".format(user_id),
+            "avatar_url": None,
+            "track_count": self.tracks_per_user,
+        }
+
+    # Tracks are numbered user_id * 100000 + i, and listed newest (highest i) first.
+    def track_ids(self, user_id):
+        return [user_id * 100000 + i for i in reversed(range(self.tracks_per_user))]
+
+    def track_json(self, track_id):
+        user_id, i = divmod(track_id, 100000)
+        return {
+            "kind": "track",
+            "id": track_id,
+            "permalink_url": "https://soundcloud.com/user{}/track{}".format(user_id, i),
+            "title": "track {} by user {}".format(i, user_id),
+            "artwork_url": "{}/artwork/{}-large.jpg".format(self.url, track_id),
+            "downloadable": False,
+            "streamable": True,
+            "created_at": "{:04d}/01/01 00:00:00 +0000".format(2000 + i % 8000),
+            "user": self.user_json(user_id),
+        }
+
+    # The audio of track_id: MP3 frames, each padded with bytes derived from the track id so no two tracks match.
+    def track_body(self, track_id):
+        padding = hashlib.sha256(str(track_id).encode("utf-8")).digest()
+        frame = MP3_FRAME_HEADER + (padding * (MP3_FRAME_SIZE // len(padding) + 1))[:MP3_FRAME_SIZE - 4]
+        return (frame * (self.track_size // MP3_FRAME_SIZE + 1))[:self.track_size]
+
+    def __valid_user(self, request):
+        user_id = int(request.match_info["id"])
+        if not 1 <= user_id <= self.num_users:
+            raise web.HTTPNotFound()
+        return user_id
+
+    def __valid_track(self, request):
+        track_id = int(request.match_info["id"])
+        user_id, i = divmod(track_id, 100000)
+        if not 1 <= user_id <= self.num_users or i >= self.tracks_per_user:
+            raise web.HTTPNotFound()
+        return track_id
+
+    @web.middleware
+    async def __simulate(self, request, handler):
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        if self.quota is not None:
+            second = int(time.monotonic())
+            start, count = self.__window
+            self.__window = (second, count + 1) if start == second else (second, 1)
+            if self.__window[1] > self.quota:
+                self.throttled += 1
+                return web.Response(status=429, headers={"Retry-After": "1"})
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500)
+        return await handler(request)
+
+    async def __resolve(self, request):
+        permalink = request.query.get("url", "").rstrip("/").rpartition("/")[2]
+        if not permalink.startswith("user") or not permalink[4:].isdigit():
+            raise web.HTTPNotFound()
+        user_id = int(permalink[4:])
+        if not 1 <= user_id <= self.num_users:
+            raise web.HTTPNotFound()
+        return web.json_response(self.user_json(user_id))
+
+    async def __user(self, request):
+        user_json = self.user_json(self.__valid_user(request))
+        etag = '"{}-{}"'.format(user_json["id"], user_json["track_count"])
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.json_response(user_json, headers={"ETag": etag})
+
+    async def __user_tracks(self, request):
+        user_id = self.__valid_user(request)
+        return self.__page(request, [self.track_json(track_id) for track_id in self.track_ids(user_id)])
+
+    async def __user_followings(self, request):
+        user_id = self.__valid_user(request)
+        followings = [(user_id + k - 1) % self.num_users + 1 for k in range(1, self.followings_per_user + 1)]
+        return self.__page(request, [self.user_json(following_id) for following_id in followings if following_id != user_id])
+
+    async def __track(self, request):
+        return web.json_response(self.track_json(self.__valid_track(request)))
+
+    # Serve a page of collection, with a next_href if there's more, the way linked_partitioning does.
+    def __page(self, request, collection):
+        limit = min(int(request.query.get("limit", 50)), 200)
+        offset = int(request.query.get("offset", 0))
+        page = {"collection": collection[offset:offset + limit]}
+        if offset + limit < len(collection):
+            page["next_href"] = "{}{}?offset={}&limit={}&linked_partitioning=1".format(
+                self.url, request.path, offset + limit, limit)
+        else:
+            page["next_href"] = None
+        return web.json_response(page)
+
+    async def __stream(self, request):
+        track_id = self.__valid_track(request)
+        body = self.track_body(track_id)
+        etag = '"track-{}"'.format(track_id)
+        start = 0
+        range_header = request.headers.get("Range")
+        if range_header and request.headers.get("If-Range", etag) == etag:
+            start = int(range_header.partition("=")[2].partition("-")[0])
+            if start >= len(body):
+                return web.Response(status=416, headers={"Content-Range": "bytes */{}".format(len(body))})
+
+        response = web.StreamResponse(status=206 if start else 200, headers={"ETag": etag})
+        response.content_type = "audio/mpeg"
+        response.content_length = len(body) - start
+        if start:
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(start, len(body) - 1, len(body))
+        await response.prepare(request)
+        for offset in range(start, len(body), self.chunk_size):
+            chunk = body[offset:offset + self.chunk_size]
+            await response.write(chunk)
+            self.bytes_sent += len(chunk)
+        await response.write_eof()
+        return response
+
+    async def __artwork(self, request):
+        name = request.match_info["name"]
+        etag = '"{}"'.format(name)
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        body = hashlib.sha256(name.encode("utf-8")).digest() * (self.artwork_size // 32 + 1)
+        self.bytes_sent += self.artwork_size
+        return web.Response(body=body[:self.artwork_size], content_type="image/jpeg", headers={"ETag": etag})
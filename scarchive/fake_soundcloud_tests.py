@@ -0,0 +1,127 @@
+import asyncio
+import tempfile
+import unittest
+
+from .dedup import hash_audio_file
+from .fake_soundcloud import FakeSoundcloud
+from .soundcloud import Client
+
+
+class FakeSoundcloudTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def run_with_client(self, server, test_fn):
+        async def test():
+            await server.start()
+            try:
+                async with Client(client_id="test", api_rate=1000, download_rate=1000) as client:
+                    client.base_url = server.url
+                    client.retry_delay = 0
+                    await test_fn(client)
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    def test_crawl(self):
+        server = FakeSoundcloud(num_users=20, tracks_per_user=450, followings_per_user=5)
+
+        async def test(client):
+            user = await client.resolve_user("https://soundcloud.com/user3")
+            self.assertEqual(user.id, 3)
+
+            tracks = [track async for track in client.crawl_user_tracks(3)]
+            self.assertEqual([track.id for track in tracks], server.track_ids(3))
+            self.assertEqual(len(set(track.created_at for track in tracks)), 450)
+            fanned_out = []
+            async for page in client.crawl_user_track_pages(3, total=450):
+                fanned_out.extend(page)
+            self.assertEqual(fanned_out, tracks)
+
+            followings = [u async for u in client.crawl_user_followings(20)]
+            self.assertEqual([u.id for u in followings], [1, 2, 3, 4, 5])
+
+            self.assertEqual(await client.fetch_track(tracks[0].id), tracks[0])
+            self.assertIsNone(await client.fetch_track(2100000))
+
+        self.run_with_client(server, test)
+
+    def test_download(self):
+        server = FakeSoundcloud(num_users=2, tracks_per_user=2, track_size=100000, chunk_size=4096)
+
+        async def test(client):
+            track = await client.fetch_track(100001)
+            with tempfile.NamedTemporaryFile() as fd:
+                self.assertTrue(await client.save_track_to_file(track, fd))
+                fd.flush()
+                fd.seek(0)
+                self.assertEqual(fd.read(), server.track_body(100001))
+                self.assertNotEqual(hash_audio_file(fd.name).hexdigest(),
+                                    hash_audio_file_body(server.track_body(100000)))
+
+                # Resume from part way through.
+                fd.seek(0)
+                fd.truncate()
+                fd.write(server.track_body(100001)[:30000])
+                self.assertTrue(await client.save_track_to_file(track, fd))
+                fd.seek(0)
+                self.assertEqual(fd.read(), server.track_body(100001))
+
+                # Already complete: the server's 416 says so, and nothing is downloaded.
+                self.assertTrue(await client.save_track_to_file(track, fd, '"track-100001"'))
+                fd.seek(0)
+                self.assertEqual(fd.read(), server.track_body(100001))
+            self.assertEqual(server.bytes_sent, 170000)
+
+            # A partial of another version of the track is downloaded again from the start.
+            with tempfile.NamedTemporaryFile() as fd:
+                fd.write(b"x" * 30000)
+                self.assertTrue(await client.save_track_to_file(track, fd, '"track-1"'))
+                fd.seek(0)
+                self.assertEqual(fd.read(), server.track_body(100001))
+            self.assertEqual(server.bytes_sent, 270000)
+
+            artwork = await client.fetch_bytes(track.artwork_url.replace("-large.jpg", "-t500x500.jpg"))
+            self.assertEqual(len(artwork), server.artwork_size)
+
+        self.run_with_client(server, test)
+
+    def test_errors_and_quota(self):
+        server = FakeSoundcloud(num_users=1, error_rate=0.5, seed=1)
+
+        async def test(client):
+            client.max_attempts = 20
+            for _ in range(10):
+                user = await client.resolve_user("https://soundcloud.com/user1")
+                self.assertEqual(user.id, 1)
+            self.assertGreater(server.errors, 0)
+            self.assertEqual(server.requests, server.errors + 10)
+
+            server.error_rate = 0
+            server.quota = 2
+            results = await asyncio.gather(*[client.fetch_user_track_count(1) for _ in range(3)])
+            self.assertEqual([track_count for track_count, _, _ in results], [20] * 3)
+            self.assertGreater(server.throttled, 0)
+
+        self.run_with_client(server, test)
+
+
+def hash_audio_file_body(body):
+    with tempfile.NamedTemporaryFile() as fd:
+        fd.write(body)
+        fd.flush()
+        return hash_audio_file(fd.name).hexdigest()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+
+from .track import Track
+
+
+class Job(object):
+
+    # Kinds of job in the archive's job queue.
+    CRAWL_USER = "crawl_user"
+    DOWNLOAD_TRACK = "download_track"
+
+    # A unit of work in the archive's job queue: crawl a user (key is the user_id) or download a track (key is the
+    # track_id, and payload holds the track). Jobs are leased by one worker at a time, until lease_expires. Jobs
+    # with a higher priority are claimed first.
+    def __init__(self, id, kind, key, payload, state, attempts, lease_owner=None, lease_expires=None, last_error=None,
+                 priority=0):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.state = state
+        self.attempts = attempts
+        self.lease_owner = lease_owner
+        self.lease_expires = lease_expires
+        self.last_error = last_error
+        self.priority = priority
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return (self.id == other.id and
+                    self.kind == other.kind and
+                    self.key == other.key and
+                    self.payload == other.payload and
+                    self.state == other.state and
+                    self.attempts == other.attempts and
+                    self.lease_owner == other.lease_owner and
+                    self.lease_expires == other.lease_expires and
+                    self.last_error == other.last_error and
+                    self.priority == other.priority)
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def track(self):
+        return Track.from_row(json.loads(self.payload))
+
+    @staticmethod
+    def track_payload(track):
+        return json.dumps(track.to_row())
+
+    @staticmethod
+    def from_row(row):
+        return Job(*row)
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+from .metrics import Metrics
+
+
+class JobQueue(object):
+
+    # A durable queue of jobs, kept in the archive DB (through an AsyncArchive) so that it survives crashes and can
+    # be shared by several worker processes. Each JobQueue is one lease owner: jobs it claims are leased to it for
+    # lease_seconds, and a heartbeat renews the leases of every job it still holds. If the process dies, its leases
+    # run out and other workers pick the jobs up again.
+    def __init__(self, archive, lease_seconds=60, max_attempts=5, poll_interval=1.0, metrics=None):
+        self.archive = archive
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.held = {}
+        self.metrics = metrics or Metrics()
+        self.__heartbeat = None
+
+    async def __aenter__(self):
+        self.__heartbeat = asyncio.ensure_future(self.__renew_leases())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__heartbeat.cancel()
+
+    async def enqueue(self, kind, items, requeue=("done", "failed")):
+        items = list(items)
+        if items:
+            await self.archive.enqueue_jobs(kind, items, requeue)
+
+    # Claim the next job of kind, or return None if there isn't one right now.
+    async def claim(self, kind):
+        jobs = await self.archive.claim_jobs(
+            kind, self.owner, time.time(), limit=1, lease_seconds=self.lease_seconds, max_attempts=self.max_attempts)
+        for job in jobs:
+            self.held[job.id] = job
+            self.metrics.inc("jobs_claimed_total", kind=kind)
+        return jobs[0] if jobs else None
+
+    # Claim the next job of kind, waiting while other workers still have work in progress (which may queue more
+    # jobs) for any of wait_for_kinds. Returns None once all of that work is finished.
+    async def claim_next(self, kind, wait_for_kinds):
+        while True:
+            job = await self.claim(kind)
+            if job is not None:
+                return job
+            if await self.archive.count_active_jobs(wait_for_kinds) == 0:
+                return None
+            await asyncio.sleep(self.poll_interval)
+
+    async def complete(self, job):
+        self.held.pop(job.id, None)
+        self.metrics.inc("jobs_completed_total", kind=job.kind)
+        await self.archive.complete_job(job.id, self.owner)
+
+    async def fail(self, job, error):
+        self.held.pop(job.id, None)
+        self.metrics.inc("jobs_failed_total", kind=job.kind)
+        await self.archive.fail_job(job.id, self.owner, error, self.max_attempts)
+
+    # Cancel the pending jobs of kind, returning how many there were. Jobs already claimed carry on.
+    async def cancel_pending(self, kind):
+        cancelled_count = await self.archive.cancel_jobs(kind)
+        self.metrics.inc("jobs_cancelled_total", cancelled_count, kind=kind)
+        return cancelled_count
+
+    async def __renew_leases(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if self.held:
+                try:
+                    await self.archive.renew_leases(list(self.held), self.owner, time.time() + self.lease_seconds)
+                except Exception as e:
+                    logging.error("owner={} Failed to renew job leases: {}".format(self.owner, e))
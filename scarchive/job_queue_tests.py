@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+
+from .archive import Archive
+from .async_archive import AsyncArchive
+from .job import Job
+from .job_queue import JobQueue
+
+
+class JobQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_claim_and_complete(self):
+        async def test():
+            archive = AsyncArchive(":memory:", readers=0)
+            try:
+                async with JobQueue(archive) as jobs:
+                    await jobs.enqueue(Job.CRAWL_USER, [(1, None), (2, None)])
+                    first = await jobs.claim(Job.CRAWL_USER)
+                    second = await jobs.claim(Job.CRAWL_USER)
+                    self.assertEqual([first.key, second.key], [1, 2])
+                    self.assertEqual(first.state, "leased")
+                    self.assertEqual(first.lease_owner, jobs.owner)
+                    self.assertIsNone(await jobs.claim(Job.CRAWL_USER))
+                    self.assertIsNone(await jobs.claim(Job.DOWNLOAD_TRACK))
+
+                    await jobs.complete(first)
+                    self.assertEqual(await archive.count_active_jobs([Job.CRAWL_USER]), 1)
+                    await jobs.complete(second)
+                    self.assertIsNone(await jobs.claim_next(Job.CRAWL_USER, [Job.CRAWL_USER]))
+                    self.assertEqual(jobs.held, {})
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    # Failed jobs go back in the queue until they've used up max_attempts.
+    def test_fail_and_retry(self):
+        async def test():
+            archive = AsyncArchive(":memory:", readers=0)
+            try:
+                async with JobQueue(archive, max_attempts=2) as jobs:
+                    await jobs.enqueue(Job.CRAWL_USER, [(1, None)])
+                    job = await jobs.claim(Job.CRAWL_USER)
+                    await jobs.fail(job, ValueError("boom"))
+                    job = await jobs.claim(Job.CRAWL_USER)
+                    self.assertEqual(job.attempts, 2)
+                    self.assertEqual(job.last_error, "boom")
+                    await jobs.fail(job, "boom again")
+                    self.assertIsNone(await jobs.claim(Job.CRAWL_USER))
+                    self.assertEqual((await archive.find_job(Job.CRAWL_USER, 1)).state, "failed")
+            finally:
+                await archive.close()
+
+        self.loop.run_until_complete(test())
+
+    # A worker that dies keeps its jobs only until their leases run out.
+    def test_expired_leases(self):
+        archive = Archive(":memory:")
+        archive.enqueue_jobs(Job.CRAWL_USER, [(1, None)])
+        job, = archive.claim_jobs(Job.CRAWL_USER, "dead", now=100, lease_seconds=10)
+        self.assertEqual(archive.claim_jobs(Job.CRAWL_USER, "alive", now=105), [])
+        self.assertEqual(archive.renew_leases([job.id], "someone else", 1000), 0)
+
+        job, = archive.claim_jobs(Job.CRAWL_USER, "alive", now=111, lease_seconds=10)
+        self.assertEqual(job.lease_owner, "alive")
+        self.assertEqual(job.attempts, 2)
+
+        # The dead worker's late updates are ignored.
+        archive.complete_job(job.id, "dead")
+        self.assertEqual(archive.find_job(Job.CRAWL_USER, 1).state, "leased")
+        self.assertEqual(archive.renew_leases([job.id], "alive", 1000), 1)
+        self.assertEqual(archive.find_job(Job.CRAWL_USER, 1).lease_expires, 1000)
+        archive.close()
+
+    # Re-enqueuing leaves jobs in progress alone, and only requeues finished jobs in the requeue states.
+    def test_requeue(self):
+        archive = Archive(":memory:")
+        archive.enqueue_jobs(Job.DOWNLOAD_TRACK, [(1, "a"), (2, "b")])
+        done, failed = archive.claim_jobs(Job.DOWNLOAD_TRACK, "worker", now=0, limit=2)
+        archive.complete_job(done.id, "worker")
+        archive.fail_job(failed.id, "worker", "boom", max_attempts=1)
+
+        archive.enqueue_jobs(Job.DOWNLOAD_TRACK, [(1, "c"), (2, "d"), (3, "e")], requeue=("failed",))
+        self.assertEqual(archive.find_job(Job.DOWNLOAD_TRACK, 1).state, "done")
+        self.assertEqual(archive.find_job(Job.DOWNLOAD_TRACK, 2).state, "pending")
+        self.assertEqual(archive.find_job(Job.DOWNLOAD_TRACK, 2).payload, "d")
+        self.assertEqual(archive.find_job(Job.DOWNLOAD_TRACK, 2).attempts, 0)
+        self.assertEqual(archive.count_active_jobs([Job.DOWNLOAD_TRACK]), 2)
+
+        archive.enqueue_jobs(Job.DOWNLOAD_TRACK, [(1, "f")])
+        self.assertEqual(archive.find_job(Job.DOWNLOAD_TRACK, 1).state, "pending")
+        archive.close()
+
+    # Higher priority jobs are claimed first; requeueing updates the priority, and cancelled jobs can be requeued.
+    def test_priority_and_cancel(self):
+        archive = Archive(":memory:")
+        archive.enqueue_jobs(Job.CRAWL_USER, [(1, None, 0.5), (2, None, 2.0), (3, None), (4, None, 2.0)])
+        claimed = archive.claim_jobs(Job.CRAWL_USER, "worker", now=0, limit=2)
+        self.assertEqual([(job.key, job.priority) for job in claimed], [(2, 2.0), (4, 2.0)])
+
+        self.assertEqual(archive.cancel_jobs(Job.CRAWL_USER), 2)
+        self.assertEqual(archive.find_job(Job.CRAWL_USER, 1).state, "cancelled")
+        self.assertEqual(archive.count_active_jobs([Job.CRAWL_USER]), 2)
+
+        archive.enqueue_jobs(Job.CRAWL_USER, [(1, None, 0.1), (3, None, 5.0)], requeue=("cancelled",))
+        self.assertEqual([job.key for job in archive.claim_jobs(Job.CRAWL_USER, "worker", now=0, limit=2)], [3, 1])
+        archive.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+
+from aiohttp import web
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+
+    # Counts observations into fixed buckets, Prometheus style. Observing is a bisect and two additions.
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Estimate the q-th quantile as the upper bound of the bucket it falls in (inf if it's past the last bucket).
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Busy(object):
+
+    # Counts a worker as busy in the workers_busy gauge for as long as it's inside the with block, and adds the time
+    # to the worker_busy_seconds counter, so worker utilization is busy seconds / (workers * elapsed seconds).
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.metrics.add("workers_busy", 1, stage=self.stage)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.add("workers_busy", -1, stage=self.stage)
+        self.metrics.inc("worker_busy_seconds_total", time.perf_counter() - self.start, stage=self.stage)
+
+
+class Metrics(object):
+
+    # An in-process registry of counters, gauges and latency histograms for the archiving pipeline, which can be
+    # rendered in the Prometheus text format (and served over HTTP), or written out as JSON snapshots. Metrics are
+    # keyed by name and labels, and updating one is a dict lookup, so it's cheap enough for the hot path. It isn't
+    # thread safe: only update it from the event loop.
+    def __init__(self, prefix="scarchive_", buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started_at = time.time()
+        self.__collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    # Adjust a gauge by value.
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    # Time a with block into the named histogram.
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    # Track a worker of stage as busy for the duration of a with block.
+    def busy(self, stage):
+        return Busy(self, stage)
+
+    # Register fn to be called just before metrics are rendered, to sample gauges (e.g. queue depths) which would
+    # be wasteful to keep up to date on every change.
+    def add_collector(self, fn):
+        self.__collectors.append(fn)
+
+    def collect(self):
+        for fn in self.__collectors:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.error("collector={} Failed to collect metrics: {}".format(fn, e))
+
+    def render_prometheus(self):
+        self.collect()
+        lines = []
+        for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+            for name, series in self.__by_name(metrics):
+                lines.append("# TYPE {}{} {}".format(self.prefix, name, kind))
+                for labels, value in series:
+                    lines.append("{}{}{} {}".format(self.prefix, name, self.__labels(labels), value))
+        for name, series in self.__by_name(self.histograms):
+            lines.append("# TYPE {}{} histogram".format(self.prefix, name))
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    bucket_labels = labels + (("le", bound),)
+                    lines.append("{}{}_bucket{} {}".format(self.prefix, name, self.__labels(bucket_labels), cumulative))
+                lines.append("{}{}_sum{} {}".format(self.prefix, name, self.__labels(labels), histogram.sum))
+                lines.append("{}{}_count{} {}".format(self.prefix, name, self.__labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        self.collect()
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started_at,
+            "pid": os.getpid(),
+            "counters": self.__flatten(self.counters),
+            "gauges": self.__flatten(self.gauges),
+            "histograms": dict(
+                (self.__series_name(key), {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5),
+                    "p99": histogram.quantile(0.99),
+                }) for key, histogram in self.histograms.items()),
+        }
+
+    # Serve render_prometheus() at http://host:port/metrics until the returned runner is cleaned up.
+    async def serve(self, host="0.0.0.0", port=9100):
+        async def handle(request):
+            return web.Response(text=self.render_prometheus(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info("host={} port={} Serving metrics".format(host, port))
+        return runner
+
+    # Measure how late the event loop runs things, by sleeping for interval seconds at a time and observing how much
+    # longer than that each sleep took into the event_loop_lag_seconds histogram. Anything blocking the loop (a slow
+    # callback, a synchronous query) shows up as lag.
+    async def sample_loop_lag(self, interval=0.1):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.observe("event_loop_lag_seconds", max(0.0, loop.time() - start - interval))
+
+    # Append a JSON snapshot to path every interval seconds, one per line. Each snapshot also has the per-second
+    # rate of every counter since the previous one.
+    async def write_snapshots(self, path, interval=10):
+        loop = asyncio.get_event_loop()
+        previous = None
+        while True:
+            await asyncio.sleep(interval)
+            snapshot = self.snapshot()
+            if previous is not None:
+                elapsed = snapshot["time"] - previous["time"]
+                snapshot["rates"] = dict(
+                    (name, (value - previous["counters"].get(name, 0)) / elapsed)
+                    for name, value in snapshot["counters"].items())
+            previous = snapshot
+            try:
+                await loop.run_in_executor(None, self.__append_line, path, json.dumps(snapshot))
+            except OSError as e:
+                logging.error("path={} Failed to write metrics snapshot: {}".format(path, e))
+
+    @staticmethod
+    def __append_line(path, line):
+        with open(path, "a") as f:
+            f.write(line + "\n")
+
+    @staticmethod
+    def __by_name(metrics):
+        by_name = {}
+        for (name, labels), value in sorted(metrics.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            by_name.setdefault(name, []).append((labels, value))
+        return sorted(by_name.items())
+
+    @staticmethod
+    def __labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+    def __flatten(self, metrics):
+        return dict((self.__series_name(key), value) for key, value in metrics.items())
+
+    def __series_name(self, key):
+        name, labels = key
+        return name + self.__labels(labels)
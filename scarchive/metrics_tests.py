@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+import aiohttp
+
+from .metrics import Histogram, Metrics
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2, 5))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 16)
+        self.assertEqual(histogram.quantile(0.4), 1)
+        self.assertEqual(histogram.quantile(0.5), 2)
+        self.assertEqual(histogram.quantile(0.99), float("inf"))
+
+    def test_render_prometheus(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.inc("requests_total", endpoint="users/:id", status=200)
+        metrics.inc("requests_total", 2, endpoint="users/:id", status=200)
+        metrics.set("workers", 4, stage="crawl")
+        metrics.observe("request_seconds", 0.5, endpoint="users/:id")
+        metrics.add_collector(lambda m: m.set("queue_depth", 7, queue="tag"))
+        self.assertEqual(metrics.render_prometheus().splitlines(), [
+            "# TYPE scarchive_requests_total counter",
+            'scarchive_requests_total{endpoint="users/:id",status="200"} 3',
+            "# TYPE scarchive_queue_depth gauge",
+            'scarchive_queue_depth{queue="tag"} 7',
+            "# TYPE scarchive_workers gauge",
+            'scarchive_workers{stage="crawl"} 4',
+            "# TYPE scarchive_request_seconds histogram",
+            'scarchive_request_seconds_bucket{endpoint="users/:id",le="0.1"} 0',
+            'scarchive_request_seconds_bucket{endpoint="users/:id",le="1"} 1',
+            'scarchive_request_seconds_bucket{endpoint="users/:id",le="+Inf"} 1',
+            'scarchive_request_seconds_sum{endpoint="users/:id"} 0.5',
+            'scarchive_request_seconds_count{endpoint="users/:id"} 1',
+        ])
+
+    def test_sample_loop_lag(self):
+        metrics = Metrics()
+
+        async def test():
+            sampler = asyncio.ensure_future(metrics.sample_loop_lag(interval=0.01))
+            await asyncio.sleep(0.05)
+            time.sleep(0.1)
+            await asyncio.sleep(0.05)
+            sampler.cancel()
+
+        self.loop.run_until_complete(test())
+        histogram = metrics.histograms[("event_loop_lag_seconds", ())]
+        self.assertGreater(histogram.count, 2)
+        self.assertGreaterEqual(histogram.quantile(1), 0.1)
+        self.assertLess(histogram.quantile(0.5), 0.1)
+
+    def test_busy(self):
+        metrics = Metrics()
+        with metrics.busy("download"):
+            self.assertEqual(metrics.gauges[("workers_busy", (("stage", "download"),))], 1)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["gauges"]['workers_busy{stage="download"}'], 0)
+        self.assertGreaterEqual(snapshot["counters"]['worker_busy_seconds_total{stage="download"}'], 0)
+
+    def test_serve_and_snapshots(self):
+        metrics = Metrics()
+        metrics.inc("requests_total", endpoint="resolve", status=200)
+
+        async def test():
+            port = self.free_port()
+            runner = await metrics.serve(host="127.0.0.1", port=port)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get("http://127.0.0.1:{}/metrics".format(port)) as r:
+                        self.assertIn('scarchive_requests_total{endpoint="resolve",status="200"} 1', await r.text())
+            finally:
+                await runner.cleanup()
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "metrics.jsonl")
+                writer = asyncio.ensure_future(metrics.write_snapshots(path, interval=0.05))
+                await asyncio.sleep(0.01)
+                metrics.inc("requests_total", 5, endpoint="resolve", status=200)
+                await asyncio.sleep(0.2)
+                writer.cancel()
+                with open(path) as f:
+                    snapshots = [json.loads(line) for line in f]
+                self.assertGreaterEqual(len(snapshots), 2)
+                self.assertEqual(snapshots[-1]["counters"]['requests_total{endpoint="resolve",status="200"}'], 6)
+                self.assertIn("rates", snapshots[-1])
+
+        self.loop.run_until_complete(test())
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            return s.getsockname()[1]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import email.utils
+import logging
+import time
+
+
+class TokenBucket(object):
+
+    # Allows rate requests per second on average, with bursts of up to burst requests.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.paused_until = 0
+
+    # Wait until a token is available, then take it.
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # Hand out no tokens for the next seconds, e.g. when the server asks us to back off with Retry-After.
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveLimiter(object):
+
+    # Limits both the request rate (with a TokenBucket) and the number of requests in flight. The concurrency limit
+    # is adjusted AIMD-style: it grows by about one for every limit successful requests, and is cut by
+    # decrease_factor whenever the server pushes back (429 or 5xx).
+    def __init__(self, rate, burst=None, initial_concurrency=4, min_concurrency=1, max_concurrency=64,
+                 decrease_factor=0.5):
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(1, rate))
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.__condition = None
+        self.__notify_tasks = set()
+
+    async def __aenter__(self):
+        # Created lazily, so that it's bound to the running event loop.
+        if self.__condition is None:
+            self.__condition = asyncio.Condition()
+        async with self.__condition:
+            while self.in_flight >= int(self.limit):
+                await self.__condition.wait()
+            self.in_flight += 1
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            # Cancelled while waiting for a token: __aexit__ won't run, so give the slot back here. This can't wait
+            # for the condition's lock, so the waiters are woken by a separate task, which is kept until it's done.
+            self.in_flight -= 1
+            task = asyncio.ensure_future(self.__notify())
+            self.__notify_tasks.add(task)
+            task.add_done_callback(self.__notify_done)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.__condition:
+            self.in_flight -= 1
+            self.__condition.notify_all()
+
+    async def __notify(self):
+        async with self.__condition:
+            self.__condition.notify_all()
+
+    def __notify_done(self, task):
+        self.__notify_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Failed to wake limiter waiters: {}".format(task.exception()))
+
+    def on_success(self):
+        self.successes += 1
+        self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def on_throttle(self, retry_after=None):
+        self.throttles += 1
+        self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+        if retry_after:
+            self.bucket.pause(retry_after)
+
+
+# Parse a Retry-After header, which is either a number of seconds or an HTTP date, into seconds from now.
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_to_datetime(value) if email.utils.parsedate_tz(value) else None
+    if date is None:
+        return None
+    return max(0.0, date.timestamp() - time.time())
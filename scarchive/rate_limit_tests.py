@@ -0,0 +1,103 @@
+import asyncio
+import time
+import unittest
+
+from .rate_limit import AdaptiveLimiter, TokenBucket, parse_retry_after
+
+
+class RateLimitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    # After the initial burst, tokens should be handed out at the bucket's rate.
+    def test_token_bucket_rate(self):
+        async def test():
+            bucket = TokenBucket(rate=100, burst=5)
+            start = time.monotonic()
+            for _ in range(15):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        self.assertGreaterEqual(self.loop.run_until_complete(test()), 0.09)
+
+    # Concurrency should shrink multiplicatively on throttling and grow additively on success.
+    def test_aimd(self):
+        limiter = AdaptiveLimiter(rate=10, initial_concurrency=8, max_concurrency=10)
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(4):
+            limiter.on_success()
+        self.assertAlmostEqual(limiter.limit, 5, delta=0.2)
+        for _ in range(1000):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 10)
+        for _ in range(10):
+            limiter.on_throttle()
+        self.assertEqual(limiter.limit, limiter.min_concurrency)
+
+    # No more than limit requests should be in flight at once.
+    def test_concurrency_limit(self):
+        limiter = AdaptiveLimiter(rate=1000, burst=1000, initial_concurrency=3)
+        peak = []
+
+        async def request():
+            async with limiter:
+                peak.append(limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        self.loop.run_until_complete(asyncio.gather(*[request() for _ in range(12)]))
+        self.assertEqual(max(peak), 3)
+
+    # A request cancelled while it waits for a token should give its slot back.
+    def test_cancel_while_waiting_for_token(self):
+        async def test():
+            limiter = AdaptiveLimiter(rate=2, burst=1, initial_concurrency=2)
+            async with limiter:
+                pass
+            waiters = [asyncio.ensure_future(limiter.__aenter__()) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            self.assertEqual(limiter.in_flight, 2)
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            self.assertEqual(limiter.in_flight, 0)
+
+            # The slots are usable again.
+            async with limiter:
+                self.assertEqual(limiter.in_flight, 1)
+
+        self.loop.run_until_complete(asyncio.wait_for(test(), 5))
+
+    # A task waiting for a slot is woken when the one holding it is cancelled while waiting for a token.
+    def test_cancel_wakes_waiters(self):
+        async def test():
+            limiter = AdaptiveLimiter(rate=10, burst=1, initial_concurrency=1)
+            async with limiter:
+                pass
+            holder = asyncio.ensure_future(limiter.__aenter__())
+            await asyncio.sleep(0.01)
+            waiter = asyncio.ensure_future(limiter.__aenter__())
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            holder.cancel()
+            await asyncio.gather(holder, return_exceptions=True)
+            self.assertIs(await waiter, limiter)
+            self.assertEqual(limiter.in_flight, 1)
+
+        self.loop.run_until_complete(asyncio.wait_for(test(), 5))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("3"), 3.0)
+        self.assertEqual(parse_retry_after(None), None)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+        self.assertEqual(parse_retry_after("soon"), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import calendar
+import time
+
+
+# Parse a track's created_at ("YYYY/MM/DD HH:MM:SS +0000", always UTC) into a timestamp, or None.
+def parse_created_at(created_at):
+    if not created_at:
+        return None
+    try:
+        return calendar.timegm(time.strptime(created_at[:19], "%Y/%m/%d %H:%M:%S"))
+    except ValueError:
+        return None
+
+
+class CrawlScheduler(object):
+
+    # Users who have never been checked are crawled before anyone else.
+    NEW_USER_PRIORITY = 1e9
+
+    # Decides when each user is next checked for new tracks, and which due users go first. A user's upload cadence is
+    # the smoothed time between their uploads; they're checked every check_fraction of it, so active users are
+    # checked often. Users who've gone quiet for longer than their cadence are checked less and less often, and
+    # users without a cadence (fewer than two uploads) as rarely as possible. Intervals are kept between
+    # min_interval and max_interval seconds.
+    def __init__(self, min_interval=60 * 60, max_interval=30 * 24 * 60 * 60, check_fraction=0.5, smoothing=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.check_fraction = check_fraction
+        self.smoothing = smoothing
+
+    # Return the user's cadence after a crawl found new_tracks, from the gaps between them and the previous newest
+    # track. Each crawl's estimate is blended into the running one, so one burst of uploads doesn't swing it.
+    def upload_interval(self, state, new_tracks):
+        times = [parse_created_at(track.created_at) for track in new_tracks]
+        times.append(parse_created_at(state.last_track_created_at))
+        times = sorted(t for t in times if t is not None)
+        if len(times) < 2:
+            return state.upload_interval
+        interval = (times[-1] - times[0]) / (len(times) - 1)
+        if state.upload_interval is None:
+            return interval
+        return state.upload_interval + self.smoothing * (interval - state.upload_interval)
+
+    # The time we expect between the user's uploads as of now: their cadence, or the time since their last upload
+    # if that's longer.
+    def expected_interval(self, state, now):
+        interval = state.upload_interval or self.max_interval
+        last_upload = parse_created_at(state.last_track_created_at) or state.last_new_track_at
+        if last_upload is not None:
+            interval = max(interval, now - last_upload)
+        return interval
+
+    def check_interval(self, state, now):
+        interval = self.expected_interval(state, now) * self.check_fraction
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def next_check_at(self, state, now):
+        return now + self.check_interval(state, now)
+
+    # The crawl priority of a due user: how many uploads they're expected to have made since they were last checked.
+    def priority(self, state, now):
+        if state.last_checked is None:
+            return self.NEW_USER_PRIORITY
+        return (now - state.last_checked) / self.expected_interval(state, now)
+
+
+class RequestBudget(object):
+
+    # A budget of API requests for one run, shared by every worker process through a counter in the archive. Each
+    # process adds the requests its client has made since it last reported, and gets back the run's total.
+    COUNTER = "run_api_requests"
+
+    def __init__(self, archive, client, budget):
+        self.archive = archive
+        self.client = client
+        self.budget = budget
+        self.reported = 0
+
+    # Start a new run's count. Only one process should do this, before the workers start.
+    @staticmethod
+    async def reset(archive):
+        await archive.reset_counter(RequestBudget.COUNTER)
+
+    # Report this process's requests, and return whether the run has spent its budget.
+    async def spent(self):
+        delta = self.client.api_requests - self.reported
+        self.reported += delta
+        return await self.archive.add_to_counter(self.COUNTER, delta) >= self.budget
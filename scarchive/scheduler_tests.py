@@ -0,0 +1,71 @@
+import unittest
+
+from .crawl_state import CrawlState
+from .scheduler import CrawlScheduler, parse_created_at
+from .track import Track
+
+DAY = 24 * 60 * 60
+
+
+class CrawlSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = CrawlScheduler(min_interval=60 * 60, max_interval=30 * DAY, check_fraction=0.5, smoothing=0.5)
+        self.now = parse_created_at("2018/03/01 00:00:00 +0000")
+
+    def test_parse_created_at(self):
+        self.assertEqual(parse_created_at("1970/01/02 00:00:01 +0000"), DAY + 1)
+        self.assertIsNone(parse_created_at(None))
+        self.assertIsNone(parse_created_at("yesterday"))
+
+    # Cadence comes from the gaps between uploads, including the previous newest track, and is smoothed over crawls.
+    def test_upload_interval(self):
+        state = CrawlState(1)
+        tracks = [self.__make_test_track(created_at) for created_at in
+                  ("2018/02/28 00:00:00 +0000", "2018/02/24 00:00:00 +0000", "2018/02/26 00:00:00 +0000", None)]
+        self.assertEqual(self.scheduler.upload_interval(state, tracks), 2 * DAY)
+        self.assertIsNone(self.scheduler.upload_interval(state, tracks[:1]))
+
+        state = CrawlState(1, last_track_created_at="2018/02/20 00:00:00 +0000", upload_interval=2 * DAY)
+        self.assertEqual(self.scheduler.upload_interval(state, tracks[:1]), 5 * DAY)
+
+    # Active users are checked often, quiet and unknown ones rarely, within the scheduler's bounds.
+    def test_check_interval(self):
+        active = CrawlState(1, last_track_created_at="2018/02/28 12:00:00 +0000", upload_interval=DAY)
+        self.assertEqual(self.scheduler.check_interval(active, self.now), DAY / 2)
+        prolific = CrawlState(2, last_track_created_at="2018/02/28 23:59:00 +0000", upload_interval=60)
+        self.assertEqual(self.scheduler.check_interval(prolific, self.now), 60 * 60)
+        quiet = CrawlState(3, last_track_created_at="2018/02/19 00:00:00 +0000", upload_interval=DAY)
+        self.assertEqual(self.scheduler.check_interval(quiet, self.now), 5 * DAY)
+        dormant = CrawlState(4, last_track_created_at="2012/01/01 00:00:00 +0000", upload_interval=DAY)
+        self.assertEqual(self.scheduler.check_interval(dormant, self.now), 30 * DAY)
+        self.assertEqual(self.scheduler.check_interval(CrawlState(5), self.now), 15 * DAY)
+        self.assertEqual(self.scheduler.next_check_at(active, self.now), self.now + DAY / 2)
+
+        # Without a created_at, the last time new tracks were found stands in for the last upload.
+        found = CrawlState(6, upload_interval=DAY, last_new_track_at=self.now - 10 * DAY)
+        self.assertEqual(self.scheduler.check_interval(found, self.now), 5 * DAY)
+
+    # New users come first, then users by how many uploads they're likely to have made since their last check.
+    def test_priority(self):
+        checked = self.now - 2 * DAY
+        active = CrawlState(1, last_track_created_at="2018/02/28 00:00:00 +0000", upload_interval=DAY,
+                            last_checked=checked)
+        quiet = CrawlState(2, last_track_created_at="2018/01/01 00:00:00 +0000", upload_interval=DAY,
+                           last_checked=checked)
+        unknown = CrawlState(3, last_checked=checked)
+        self.assertEqual(self.scheduler.priority(active, self.now), 2)
+        self.assertEqual(self.scheduler.priority(CrawlState(4), self.now), CrawlScheduler.NEW_USER_PRIORITY)
+        states = [quiet, unknown, active, CrawlState(4)]
+        ranked = sorted(states, key=lambda state: -self.scheduler.priority(state, self.now))
+        # Two months without an upload counts for less than no cadence at all, which is capped at max_interval.
+        self.assertEqual([state.user_id for state in ranked], [4, 1, 3, 2])
+
+    @staticmethod
+    def __make_test_track(created_at):
+        return Track(1, "https://soundcloud.com/1/1", 1, "fake user 1", "fake track", None, None, False, True,
+                     created_at)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,78 +1,397 @@
 import asyncio
 import aiohttp
+import collections
+import json
 import logging
 import math
+import os
+import random
+import re
+import time
 
+from .metrics import Metrics
+from .rate_limit import AdaptiveLimiter, parse_retry_after
 from .track import Track
 from .user import User
 
+# orjson decodes API pages several times faster than the json module, and straight from bytes. It's optional.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+_ID_SEGMENT = re.compile(r"(?<=/)\d+(?=/|$)|^\d+(?=/|$)")
+
+
+class CrawlError(Exception):
+
+    # Raised when a page of a collection can't be fetched, so callers know the crawl didn't see the whole collection.
+    def __init__(self, url, offset=None):
+        super().__init__("Failed to fetch page: url={} offset={}".format(url, offset))
+        self.url = url
+        self.offset = offset
+
 
 class Client(object):
 
-    def __init__(self, client_id):
+    def __init__(self, client_id, max_connections=100, max_connections_per_host=8, keepalive_timeout=30,
+                 dns_cache_ttl=300, download_chunk_size=64 * 1024, api_rate=10, download_rate=4, metrics=None):
 
         self.base_url = "https://api.soundcloud.com"
         self.client_id = client_id
-        self.crawl_page_size = 25
+        # The largest page the API serves, and how many pages of a collection to fetch at once when its size is known.
+        self.crawl_page_size = 200
+        self.crawl_fan_out = 4
         self.max_attempts = 3
+        # API requests made so far (including retries), to hold a run to a request budget.
+        self.api_requests = 0
+        self.retry_delay = 1
+        self.download_chunk_size = download_chunk_size
+
+        # Connection pool settings for the shared session.
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.__session = None
+
+        # API calls and downloads have separate request rate and concurrency budgets, which back off when the
+        # server throttles us and ramp back up while responses are healthy.
+        self.api_limiter = AdaptiveLimiter(rate=api_rate, max_concurrency=max_connections_per_host)
+        self.download_limiter = AdaptiveLimiter(rate=download_rate, max_concurrency=max_connections_per_host)
+
+        # Request counts and latencies per endpoint, bytes downloaded, retries and backoff.
+        self.metrics = metrics or Metrics()
+        self.metrics.add_collector(self.__collect_metrics)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    # One long-lived session (and connection pool) is shared by every request this client makes. It is created
+    # lazily so that it's bound to the running event loop.
+    @property
+    def session(self):
+        if self.__session is None or self.__session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        return self.__session
+
+    async def close(self):
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
 
     async def crawl_user_tracks(self, user_id):
+        async for tracks in self.crawl_user_track_pages(user_id):
+            for track in tracks:
+                yield track
+
+    # Crawl a user's tracks one API page at a time, so callers can handle each page in bulk. Tracks come back
+    # newest first, so if since (a created_at timestamp) is given, crawling stops at the first track that's older.
+    # Otherwise, total (the user's track_count, if known) lets several pages be fetched at once.
+    async def crawl_user_track_pages(self, user_id, since=None, total=None):
         url = "/".join([self.base_url, "users", str(user_id), "tracks"])
-        async for item in self.__crawl_pages(url):
-            if item["kind"] == "track":
-                yield Track.from_json(item)
+        # An incremental crawl usually stops after the first page, so don't fetch ahead.
+        pages = self.__crawl_pages(url, total=total, prefetch=True) if since is None else self.__crawl_pages(url)
+        try:
+            async for page in pages:
+                tracks = [Track.from_json(item) for item in page if item["kind"] == "track"]
+                if since is None:
+                    yield tracks
+                    continue
+                # created_at is always formatted as "YYYY/MM/DD HH:MM:SS +0000", so timestamps compare as strings.
+                # It's only precise to the second, so tracks from the same second as since are included too; the
+                # caller has to skip the ones it already has.
+                newer_tracks = [track for track in tracks if track.created_at is None or track.created_at >= since]
+                if newer_tracks:
+                    yield newer_tracks
+                if len(newer_tracks) < len(tracks):
+                    return
+        finally:
+            await pages.aclose()
 
     async def crawl_user_followings(self, user_id):
+        async for users in self.crawl_user_following_pages(user_id):
+            for user in users:
+                yield user
+
+    # Crawl a user's followings one API page at a time, so callers can handle each page in bulk.
+    async def crawl_user_following_pages(self, user_id):
         url = "/".join([self.base_url, "users", str(user_id), "followings"])
-        async for item in self.__crawl_pages(url):
-            if item["kind"] == "user":
-                yield User.from_json(item)
+        async for page in self.__crawl_pages(url, prefetch=True):
+            yield [User.from_json(item) for item in page if item["kind"] == "user"]
 
     async def resolve_user(self, user_url):
-        async with aiohttp.ClientSession() as session:
-            url = "/".join([self.base_url, "resolve"])
-            user_json = await self.__fetch_json(url, params={"url": user_url})
-            return User.from_json(user_json)
+        url = "/".join([self.base_url, "resolve"])
+        user_json = await self.__fetch_json(url, params={"url": user_url})
+        return User.from_json(user_json)
+
+    async def fetch_track(self, track_id):
+        url = "/".join([self.base_url, "tracks", str(track_id)])
+        track_json = await self.__fetch_json(url)
+        return Track.from_json(track_json) if track_json else None
 
-    async def save_track_to_file(self, track, fd):
+    # Fetch a user's current track_count, along with the response ETag. Returns (track_count, etag, not_modified),
+    # where not_modified is True if etag was given and the user hasn't changed since. track_count is None then, and
+    # also if the request failed or the user has no track_count.
+    async def fetch_user_track_count(self, user_id, etag=None):
+        url = "/".join([self.base_url, "users", str(user_id)])
+        user_json, etag, not_modified = await self.__fetch_conditional_json(url, etag=etag)
+        return (user_json.get("track_count") if user_json else None), etag, not_modified
+
+    # Fetch a URL outside the API (e.g. artwork) through the shared connection pool.
+    async def fetch_bytes(self, url):
+        async with self.download_limiter, self.__timed_get("external", url) as r:
+            self.__check_throttle(self.download_limiter, r)
+            r.raise_for_status()
+            data = await r.read()
+            self.metrics.inc("download_bytes_total", len(data), endpoint="external")
+            return data
+
+    # Fetch a URL outside the API, but only if it has changed since it was last fetched with the given ETag or
+    # Last-Modified validators. Returns (data, etag, last_modified), where data is None if it hasn't changed.
+    async def revalidate_bytes(self, url, etag=None, last_modified=None):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        async with self.download_limiter, self.__timed_get("external", url, headers=headers) as r:
+            self.__check_throttle(self.download_limiter, r)
+            if r.status == 304:
+                return None, etag, last_modified
+            r.raise_for_status()
+            data = await r.read()
+            self.metrics.inc("download_bytes_total", len(data), endpoint="external")
+            return data, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+    # Stream a track's audio into fd, download_chunk_size bytes at a time. fd must be opened for appending; if it
+    # already holds part of the track (from a failed attempt or an earlier run), the download resumes from where it
+    # left off with a Range request. etag is the track's ETag when that part was saved: it's sent as If-Range, so a
+    # track that has changed since is downloaded again from the start. on_etag is awaited with every new ETag the
+    # server sends, before any of the body it belongs to is written, so it can be kept with the partial file.
+    # Returns True if the whole track was saved.
+    async def save_track_to_file(self, track, fd, etag=None, on_etag=None):
         if not track.is_downloadable and not track.is_streamable:
             logging.warning("user_id={} track_id={} is_downloadable={} is_streamable={} Track not downloadable".format(
                 track.user_id, track.id, track.is_downloadable, track.is_streamable))
-            return
+            return False
 
         url = "/".join([self.base_url, "tracks", str(track.id), "download" if track.is_downloadable else "stream"])
+        endpoint = self.__endpoint(url)
         for attempt in range(self.max_attempts):
+            offset = fd.seek(0, os.SEEK_END)
+            headers = {}
+            if offset > 0:
+                headers["Range"] = "bytes={}-".format(offset)
+                if etag is not None:
+                    headers["If-Range"] = etag
+            retry_after = None
             try:
-                async with aiohttp.ClientSession(raise_for_status=True) as session:
-                    async with session.get(url, params={"client_id": self.client_id}) as r:
-                        while True:
-                            chunk = await r.content.read()
-                            if not chunk:
-                                break
-                            fd.write(chunk)
-                        return
-            except aiohttp.ClientResponseError as e:
+                async with self.download_limiter, self.__timed_get(endpoint, url, params={"client_id": self.client_id},
+                                                                  headers=headers) as r:
+                    if r.status == 416:
+                        # Either we already have the whole track (an earlier attempt failed after saving all of it),
+                        # or whatever we have doesn't match the track any more, so start over.
+                        if self.__parse_unsatisfied_range(r.headers.get("Content-Range")) == offset:
+                            return True
+                        self.__truncate(fd)
+                        continue
+                    retry_after = self.__check_throttle(self.download_limiter, r)
+                    r.raise_for_status()
+                    if r.headers.get("ETag", etag) != etag:
+                        etag = r.headers["ETag"]
+                        if on_etag is not None:
+                            await on_etag(etag)
+                    if r.status == 206:
+                        start, total = self.__parse_content_range(r.headers.get("Content-Range"))
+                        if start != offset:
+                            raise aiohttp.ClientPayloadError("Range starts at {}, expected {}".format(start, offset))
+                    else:
+                        # The server sent the whole track, either because we asked for it or it ignored the Range.
+                        self.__truncate(fd)
+                        total = r.content_length
+                    start = time.perf_counter()
+                    async for chunk in r.content.iter_chunked(self.download_chunk_size):
+                        fd.write(chunk)
+                        self.metrics.inc("download_bytes_total", len(chunk), endpoint=endpoint)
+                    size = fd.tell()
+                    if total is not None and size != total:
+                        raise aiohttp.ClientPayloadError("Got {} bytes, expected {}".format(size, total))
+                    self.metrics.observe("download_body_seconds", time.perf_counter() - start)
+                    return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.metrics.inc("request_errors_total", endpoint=endpoint)
                 logging.error("attempt={} url={} Failed to save_track_to_file: {}".format(attempt, url, e))
-                await asyncio.sleep(math.pow(2, attempt))
+            await self.__retry(endpoint, attempt, retry_after)
+        return False
+
+    # Report the outcome of a response to limiter. Returns the server's Retry-After (in seconds) if it throttled us.
+    @staticmethod
+    def __check_throttle(limiter, r):
+        if r.status == 429 or r.status >= 500:
+            retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            limiter.on_throttle(retry_after)
+            return retry_after
+        limiter.on_success()
+        return None
 
-    async def __crawl_pages(self, url):
+    async def __retry(self, endpoint, attempt, retry_after):
+        delay = self.__backoff(attempt, retry_after)
+        self.metrics.inc("retries_total", endpoint=endpoint)
+        self.metrics.inc("backoff_seconds_total", delay, endpoint=endpoint)
+        await asyncio.sleep(delay)
+
+    # Exponential backoff with jitter, unless the server told us exactly how long to wait.
+    def __backoff(self, attempt, retry_after=None):
+        delay = retry_after if retry_after is not None else self.retry_delay * math.pow(2, attempt)
+        return delay + random.uniform(0, delay / 2)
+
+    # GET url through the shared session, counting the response and timing it (up to the response headers) against
+    # endpoint. Time spent waiting on a limiter isn't included.
+    def __timed_get(self, endpoint, url, **kwargs):
+        return _TimedRequest(self.metrics, endpoint, self.session.get(url, **kwargs))
+
+    def __collect_metrics(self, metrics):
+        for name, limiter in (("api", self.api_limiter), ("download", self.download_limiter)):
+            metrics.set("limiter_concurrency", int(limiter.limit), limiter=name)
+            metrics.set("limiter_in_flight", limiter.in_flight, limiter=name)
+            metrics.set("limiter_throttles", limiter.throttles, limiter=name)
+
+    # Label API URLs by endpoint, with ids replaced, e.g. "users/:id/tracks". Anything else is "external".
+    def __endpoint(self, url):
+        if not url.startswith(self.base_url):
+            return "external"
+        path = url[len(self.base_url):].partition("?")[0].strip("/")
+        return _ID_SEGMENT.sub(":id", path)
+
+    @staticmethod
+    def __truncate(fd):
+        fd.seek(0)
+        fd.truncate()
+
+    # Parse "bytes start-end/total" into (start, total); total is None if the server doesn't know it.
+    @staticmethod
+    def __parse_content_range(content_range):
+        try:
+            _, _, byte_range = content_range.partition(" ")
+            span, _, total = byte_range.partition("/")
+            start = int(span.partition("-")[0])
+            return start, (None if total == "*" else int(total))
+        except (AttributeError, ValueError):
+            raise aiohttp.ClientPayloadError("Invalid Content-Range: {}".format(content_range))
+
+    # Parse the "bytes */total" of a 416 into total, or None if it's missing or invalid.
+    @staticmethod
+    def __parse_unsatisfied_range(content_range):
+        try:
+            return int(content_range.partition("/")[2])
+        except (AttributeError, ValueError):
+            return None
+
+    # Yield the pages of a collection in order, following next_href. With prefetch, the next page is fetched while
+    # the caller handles the current one. If total (the size of the collection) is known, up to crawl_fan_out pages
+    # are fetched at once by offset instead, then crawling carries on from the last one's next_href in case total
+    # was out of date. A page that can't be fetched raises CrawlError, since the rest of the collection is unknown.
+    async def __crawl_pages(self, url, total=None, prefetch=False):
+        pending = collections.deque()
+        try:
+            next_url = url
+            if total:
+                for offset in range(0, total, self.crawl_page_size):
+                    pending.append(self.__fetch_page(url, offset))
+                    if len(pending) >= self.crawl_fan_out:
+                        page, next_url = await pending.popleft()
+                        yield page
+                while pending:
+                    page, next_url = await pending.popleft()
+                    yield page
+
+            if next_url is not None:
+                pending.append(self.__fetch_page(next_url))
+            while pending:
+                page, next_url = await pending.popleft()
+                if next_url is not None and prefetch:
+                    pending.append(self.__fetch_page(next_url))
+                yield page
+                if next_url is not None and not prefetch:
+                    pending.append(self.__fetch_page(next_url))
+        finally:
+            for fetch in pending:
+                # Pages fetched ahead may have failed already; their errors don't matter any more.
+                if fetch.done() and not fetch.cancelled():
+                    fetch.exception()
+                fetch.cancel()
+
+    # Start fetching one page of a collection. The future resolves to (collection, next_href), or raises CrawlError if
+    # the page couldn't be fetched.
+    def __fetch_page(self, url, offset=None):
         page_params = {"limit": self.crawl_page_size, "linked_partitioning": 1}
-        while url is not None:
+        if offset is not None:
+            page_params["offset"] = offset
+
+        async def fetch():
             data = await self.__fetch_json(url, params=page_params)
-            if data is not None and "collection" in data:
-                for item in data["collection"]:
-                    yield item
-                url = data.get("next_href")
-            else:
-                logging.error("url={} Unexpected response from __crawl_pages: {}".format(url, data))
-                    
-    async def __fetch_json(self, url, params={}):
-        params.update(client_id=self.client_id)
+            if data is None or "collection" not in data:
+                logging.error("url={} offset={} Unexpected response from __crawl_pages: {}".format(url, offset, data))
+                raise CrawlError(url, offset)
+            return data["collection"], data.get("next_href")
+
+        return asyncio.ensure_future(fetch())
+
+    async def __fetch_json(self, url, params=None):
+        data, _, _ = await self.__fetch_conditional_json(url, params)
+        return data
+
+    # Like __fetch_json, but sends If-None-Match when etag is given. Returns (data, etag, not_modified), where
+    # not_modified is True (and data None) if the server answered 304 Not Modified.
+    async def __fetch_conditional_json(self, url, params=None, etag=None):
+        params = dict(params or {}, client_id=self.client_id)
+        headers = {"If-None-Match": etag} if etag else {}
+        endpoint = self.__endpoint(url)
         for attempt in range(self.max_attempts):
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params) as r:
+            retry_after = None
+            self.api_requests += 1
+            try:
+                async with self.api_limiter, self.__timed_get(endpoint, url, params=params, headers=headers) as r:
+                    retry_after = self.__check_throttle(self.api_limiter, r)
                     if r.status == 200:
-                        return await r.json()
+                        return json_loads(await r.read()), r.headers.get("ETag"), False
+                    elif r.status == 304:
+                        return None, etag, True
                     else:
                         logging.error("attempt={} url={} status={} Failed to __fetch_json: {}".format(attempt, url, r.status, await r.text()))
-                        await asyncio.sleep(math.pow(2, attempt))
+            # A ValueError means the response wasn't valid JSON.
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self.metrics.inc("request_errors_total", endpoint=endpoint)
+                logging.error("attempt={} url={} Failed to __fetch_json: {}".format(attempt, url, e))
+            await self.__retry(endpoint, attempt, retry_after)
+        return None, None, False
+
+
+class _TimedRequest(object):
+
+    def __init__(self, metrics, endpoint, request):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.request = request
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        r = await self.request.__aenter__()
+        self.metrics.observe("request_seconds", time.perf_counter() - start, endpoint=self.endpoint)
+        self.metrics.inc("requests_total", endpoint=self.endpoint, status=r.status)
+        return r
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.request.__aexit__(exc_type, exc, tb)
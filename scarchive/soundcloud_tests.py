@@ -0,0 +1,397 @@
+import asyncio
+import tempfile
+import time
+import unittest
+
+from aiohttp import web
+
+from .soundcloud import Client, CrawlError
+from .track import Track
+
+
+class StubServer(object):
+
+    def __init__(self, routes):
+        self.app = web.Application()
+        self.app.router.add_routes(routes)
+        self.peers = set()
+        self.app.middlewares.append(self.__track_peers)
+        self.runner = None
+        self.url = None
+
+    @web.middleware
+    async def __track_peers(self, request, handler):
+        self.peers.add(request.transport.get_extra_info("peername"))
+        return await handler(request)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}".format(port)
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class ClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    # Requests made by one client should reuse pooled connections instead of opening one per request.
+    def test_session_is_shared(self):
+        async def resolve(request):
+            return web.json_response({"id": 1, "username": "u", "permalink": "u", "avatar_url": None})
+
+        async def test():
+            server = StubServer([web.get("/resolve", resolve)])
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    for _ in range(10):
+                        user = await client.resolve_user("https://soundcloud.com/u")
+                        self.assertEqual(user.id, 1)
+                    self.assertFalse(client.session.closed)
+                self.assertEqual(len(server.peers), 1)
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    def test_save_track_to_file(self):
+        body = b"x" * 100000
+
+        async def stream(request):
+            return web.Response(body=body)
+
+        async def test():
+            server = StubServer([web.get("/tracks/{id}/stream", stream)])
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    with tempfile.TemporaryFile() as fd:
+                        self.assertTrue(await client.save_track_to_file(self.make_test_track(1), fd))
+                        fd.seek(0)
+                        self.assertEqual(fd.read(), body)
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    # Downloads that drop mid-body should resume with Range requests rather than start over.
+    def test_save_track_to_file_resumes(self):
+        body = bytes(range(256)) * 400
+        ranges = []
+
+        async def test():
+            server = StubServer([web.get("/tracks/{id}/stream", range_stream(body, ranges, drop_after=40000))])
+            await server.start()
+            try:
+                async with Client(client_id="test", download_chunk_size=4096) as client:
+                    client.base_url = server.url
+                    client.retry_delay = 0
+                    with tempfile.TemporaryFile() as fd:
+                        self.assertTrue(await client.save_track_to_file(self.make_test_track(1), fd))
+                        fd.seek(0)
+                        self.assertEqual(fd.read(), body)
+                    self.assertEqual(ranges, [None, "bytes=40000-", "bytes=80000-"])
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    # The ETag is handed to on_etag as soon as it's known, so a later run can resume the partial with If-Range.
+    def test_save_track_to_file_keeps_etag(self):
+        body = bytes(range(256)) * 400
+        ranges, if_ranges = [], []
+        stream = range_stream(body, ranges, drop_after=40000)
+
+        async def recording_stream(request):
+            if_ranges.append(request.headers.get("If-Range"))
+            return await stream(request)
+
+        async def test():
+            server = StubServer([web.get("/tracks/{id}/stream", recording_stream)])
+            await server.start()
+            try:
+                async with Client(client_id="test", download_chunk_size=4096) as client:
+                    client.base_url = server.url
+                    client.retry_delay = 0
+                    etags = []
+
+                    async def on_etag(etag):
+                        etags.append(etag)
+
+                    with tempfile.TemporaryFile() as fd:
+                        client.max_attempts = 1
+                        self.assertFalse(await client.save_track_to_file(self.make_test_track(1), fd, None, on_etag))
+                        self.assertEqual(etags, ["v1"])
+                        client.max_attempts = 5
+                        self.assertTrue(await client.save_track_to_file(self.make_test_track(1), fd, "v1", on_etag))
+                        fd.seek(0)
+                        self.assertEqual(fd.read(), body)
+                    self.assertEqual(etags, ["v1"])
+                    self.assertEqual(if_ranges, [None, "v1", "v1"])
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    # A server that ignores Range and sends the whole track again should replace the partial file.
+    def test_save_track_to_file_range_ignored(self):
+        body = b"0123456789" * 10000
+
+        async def stream(request):
+            return web.Response(body=body)
+
+        async def test():
+            server = StubServer([web.get("/tracks/{id}/stream", stream)])
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    with tempfile.TemporaryFile() as fd:
+                        fd.write(b"stale partial download")
+                        self.assertTrue(await client.save_track_to_file(self.make_test_track(1), fd))
+                        fd.seek(0)
+                        self.assertEqual(fd.read(), body)
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    # A server enforcing a quota with 429s should slow the client down, and Retry-After should be honored.
+    def test_fetch_honors_retry_after(self):
+        requests = []
+
+        async def user(request):
+            requests.append(time.monotonic())
+            if len(requests) == 1:
+                return web.Response(status=429, headers={"Retry-After": "0.2"})
+            return web.json_response({"id": 1, "track_count": 26})
+
+        async def test():
+            server = StubServer([web.get("/users/1", user)])
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    limit = client.api_limiter.limit
+                    self.assertEqual(await client.fetch_user_track_count(1), (26, None, False))
+                    self.assertEqual(client.api_limiter.throttles, 1)
+                    self.assertLess(client.api_limiter.limit, limit)
+                    self.assertGreaterEqual(requests[1] - requests[0], 0.2)
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    # Requests, retries and downloaded bytes are counted per endpoint, with ids stripped out of the endpoint.
+    def test_metrics(self):
+        body = b"x" * 10000
+        requests = []
+
+        async def user(request):
+            requests.append(request)
+            if len(requests) == 1:
+                return web.Response(status=503)
+            return web.json_response({"id": 1, "track_count": 26})
+
+        async def stream(request):
+            return web.Response(body=body)
+
+        async def test():
+            server = StubServer([web.get("/users/{id}", user), web.get("/tracks/{id}/stream", stream)])
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    client.retry_delay = 0
+                    await client.fetch_user_track_count(1)
+                    with tempfile.TemporaryFile() as fd:
+                        await client.save_track_to_file(self.make_test_track(1), fd)
+                    counters = client.metrics.snapshot()["counters"]
+                    self.assertEqual(counters['requests_total{endpoint="users/:id",status="503"}'], 1)
+                    self.assertEqual(counters['requests_total{endpoint="users/:id",status="200"}'], 1)
+                    self.assertEqual(counters['retries_total{endpoint="users/:id"}'], 1)
+                    self.assertEqual(counters['download_bytes_total{endpoint="tracks/:id/stream"}'], len(body))
+                    histograms = client.metrics.snapshot()["histograms"]
+                    self.assertEqual(histograms['request_seconds{endpoint="users/:id"}']["count"], 2)
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    # Crawling with a high-water mark should stop at the first page containing an older track. Tracks from the same
+    # second as the mark are included, since created_at can't tell them apart.
+    def test_crawl_user_track_pages_since(self):
+        pages_fetched = []
+
+        async def tracks(request):
+            page = int(request.query.get("page", 0))
+            pages_fetched.append(page)
+            offsets = [page * 3 + i for i in range(3)]
+            collection = [self.make_track_json(100 - x, "2017/04/{:02d} 00:00:00 +0000".format(20 - x)) for x in offsets]
+            next_href = "{}/users/1/tracks?page={}".format(server.url, page + 1)
+            return web.json_response({"collection": collection, "next_href": next_href})
+
+        async def test():
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    crawled = []
+                    async for page in client.crawl_user_track_pages(1, since="2017/04/16 00:00:00 +0000"):
+                        crawled.extend(track.id for track in page)
+                    self.assertEqual(crawled, [100, 99, 98, 97, 96])
+                    self.assertEqual(pages_fetched, [0, 1])
+            finally:
+                await server.stop()
+
+        server = StubServer([web.get("/users/1/tracks", tracks)])
+        self.run_async(test())
+
+    # With the total known, pages are fetched several at a time by offset, but still come back in order; a stale total
+    # is made up for by following next_href from the last page.
+    def test_crawl_user_track_pages_fan_out(self):
+        offsets = []
+        in_flight = [0, 0]
+
+        async def tracks(request):
+            offset = int(request.query.get("offset", 0))
+            limit = int(request.query["limit"])
+            offsets.append(offset)
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            # Answer later pages first, to check they're put back in order.
+            await asyncio.sleep(0.05 if offset == 0 else 0.01)
+            in_flight[0] -= 1
+            collection = [self.make_track_json(1000 - x, None) for x in range(offset, min(offset + limit, 23))]
+            next_href = None
+            if offset + limit < 23:
+                next_href = "{}/users/1/tracks?offset={}".format(server.url, offset + limit)
+            return web.json_response({"collection": collection, "next_href": next_href})
+
+        async def test():
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    client.crawl_page_size = 5
+                    client.crawl_fan_out = 3
+                    crawled = []
+                    async for page in client.crawl_user_track_pages(1, total=14):
+                        crawled.extend(track.id for track in page)
+                    self.assertEqual(crawled, [1000 - x for x in range(23)])
+                    self.assertEqual(offsets[:3], [0, 5, 10])
+                    self.assertEqual(sorted(offsets), [0, 5, 10, 15, 20])
+                    self.assertGreater(in_flight[1], 1)
+            finally:
+                await server.stop()
+
+        server = StubServer([web.get("/users/1/tracks", tracks)])
+        self.run_async(test())
+
+    # A page that can't be fetched ends the crawl with a CrawlError, so it isn't mistaken for the end of the collection.
+    def test_crawl_pages_stops_on_failure(self):
+        requests = []
+
+        async def followings(request):
+            requests.append(request.query.get("page"))
+            if request.query.get("page") == "1":
+                return web.Response(status=500)
+            users = [{"kind": "user", "id": 1, "username": "u", "permalink": "u", "avatar_url": None}]
+            return web.json_response({"collection": users, "next_href": "{}/users/1/followings?page=1".format(server.url)})
+
+        async def test():
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    client.retry_delay = 0
+                    pages = []
+                    with self.assertRaises(CrawlError):
+                        async for page in client.crawl_user_following_pages(1):
+                            pages.append(page)
+                    self.assertEqual([[user.id for user in page] for page in pages], [[1]])
+                    self.assertEqual(requests, [None] + ["1"] * client.max_attempts)
+            finally:
+                await server.stop()
+
+        server = StubServer([web.get("/users/1/followings", followings)])
+        self.run_async(test())
+
+    # A matching ETag should come back as not modified, which a missing track_count isn't.
+    def test_fetch_user_track_count_etag(self):
+        async def user(request):
+            if request.headers.get("If-None-Match") == "v1":
+                return web.Response(status=304)
+            if request.headers.get("If-None-Match") == "v2":
+                return web.json_response({"id": 1}, headers={"ETag": "v3"})
+            return web.json_response({"id": 1, "track_count": 26}, headers={"ETag": "v1"})
+
+        async def test():
+            server = StubServer([web.get("/users/1", user)])
+            await server.start()
+            try:
+                async with Client(client_id="test") as client:
+                    client.base_url = server.url
+                    self.assertEqual(await client.fetch_user_track_count(1), (26, "v1", False))
+                    self.assertEqual(await client.fetch_user_track_count(1, etag="v1"), (None, "v1", True))
+                    self.assertEqual(await client.fetch_user_track_count(1, etag="v2"), (None, "v3", False))
+            finally:
+                await server.stop()
+
+        self.run_async(test())
+
+    @staticmethod
+    def make_track_json(x, created_at):
+        return {"kind": "track", "id": x, "title": "fake track {}".format(x), "created_at": created_at,
+                "streamable": True, "downloadable": False, "user": {"id": 1, "username": "fake user 1", "permalink": "u1", "avatar_url": None}}
+
+    @staticmethod
+    def make_test_track(x):
+        return Track(
+            id=x,
+            permalink="https://soundcloud.com/{}/{}".format(x, x),
+            user_id=x,
+            username="fake user {}".format(x),
+            title="fake track {}".format(x),
+            uri=None,
+            artwork_url=None,
+            is_downloadable=False,
+            is_streamable=True)
+
+
+# A stub download handler that honors Range requests, but drops the connection after drop_after bytes.
+def range_stream(body, ranges, drop_after):
+    async def stream(request):
+        ranges.append(request.headers.get("Range"))
+        start = int(request.headers["Range"][len("bytes="):-1]) if "Range" in request.headers else 0
+        headers = {"Content-Length": str(len(body) - start), "ETag": "v1"}
+        if start > 0:
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, len(body) - 1, len(body))
+        r = web.StreamResponse(status=206 if start > 0 else 200, headers=headers)
+        await r.prepare(request)
+        await r.write(body[start:start + drop_after])
+        if start + drop_after < len(body):
+            request.transport.close()
+        return r
+    return stream
+
+
+if __name__ == "__main__":
+    unittest.main()
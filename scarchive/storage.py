@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import os
+
+
+class TrackStore(object):
+
+    # Decides where tracks are saved under base_dir. This is the original, flat layout: base_dir/user_id/track_id.mp3.
+    # Directories are created off the event loop, and only once: the store remembers which ones exist, and concurrent
+    # requests for the same directory share one mkdir. File operations that can block (on network filesystems in
+    # particular) are run on executor.
+    def __init__(self, base_dir, executor=None):
+        self.base_dir = base_dir
+        self.executor = executor
+        self.__dirs = set()
+        self.__pending = {}
+
+    @staticmethod
+    def for_layout(layout, base_dir, executor=None):
+        layouts = {"flat": TrackStore, "sharded": ShardedTrackStore}
+        if layout not in layouts:
+            raise ValueError("Unknown storage layout: {}".format(layout))
+        return layouts[layout](base_dir, executor)
+
+    def user_dir(self, user_id):
+        return os.path.join(self.base_dir, str(user_id))
+
+    def track_path(self, user_id, track_id, suffix=".mp3"):
+        return os.path.join(self.user_dir(user_id), "{}{}".format(track_id, suffix))
+
+    # Create user_id's directory (and any parents) if it doesn't exist yet, and return it.
+    async def make_user_dir(self, user_id):
+        path = self.user_dir(user_id)
+        if path in self.__dirs:
+            return path
+        pending = self.__pending.get(path)
+        if pending is None:
+            pending = self.__pending[path] = asyncio.ensure_future(self.run(os.makedirs, path, exist_ok=True))
+            pending.add_done_callback(lambda f: self.__pending.pop(path, None))
+        await asyncio.shield(pending)
+        self.__dirs.add(path)
+        return path
+
+    # Run a blocking file operation on the store's executor.
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    # Find every file under base_dir with one of suffixes, whatever layout saved it, scanning each top-level directory
+    # in parallel on the executor. Returns (track_id, suffix, path)s.
+    async def find_files(self, suffixes=(".mp3",)):
+        scans = [self.run(lambda root: list(self.scan(root, suffixes)), root) for root in await self.run(self.list_roots)]
+        return [entry for entries in await asyncio.gather(*scans) for entry in entries]
+
+    # List the top-level entries of base_dir, which can each be scanned in parallel.
+    def list_roots(self):
+        if not os.path.isdir(self.base_dir):
+            return []
+        return [entry.path for entry in os.scandir(self.base_dir) if entry.is_dir()]
+
+    # Walk the tree under root, yielding (track_id, suffix, path) for every track file (or partial download, with
+    # suffixes). This doesn't depend on the layout, so it also finds files saved under a different one.
+    @staticmethod
+    def scan(root, suffixes=(".mp3",)):
+        stack = [root]
+        while stack:
+            for entry in os.scandir(stack.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                for suffix in suffixes:
+                    track_id = entry.name[:-len(suffix)]
+                    if entry.name.endswith(suffix) and track_id.isdigit():
+                        yield int(track_id), suffix, entry.path
+                        break
+
+
+class ShardedTrackStore(TrackStore):
+
+    # Spreads user directories over 65536 shards, base_dir/ab/cd/user_id/track_id.mp3, where abcd is the start of the
+    # MD5 of the user_id. This keeps every directory small, which matters on network filesystems where listing and
+    # stat get slow for directories with thousands of entries.
+    def user_dir(self, user_id):
+        digest = hashlib.md5(str(user_id).encode("utf-8")).hexdigest()
+        return os.path.join(self.base_dir, digest[:2], digest[2:4], str(user_id))
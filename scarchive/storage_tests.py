@@ -0,0 +1,68 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from .storage import ShardedTrackStore, TrackStore
+
+
+class TrackStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base_dir = os.path.join(self.tmp_dir.name, "data")
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.tmp_dir.cleanup()
+
+    def test_layouts(self):
+        flat = TrackStore.for_layout("flat", self.base_dir)
+        self.assertEqual(flat.track_path(1, 2), os.path.join(self.base_dir, "1", "2.mp3"))
+        sharded = TrackStore.for_layout("sharded", self.base_dir)
+        self.assertIsInstance(sharded, ShardedTrackStore)
+        # md5("1") is c4ca4238a0b923820dcc509a6f75849b.
+        self.assertEqual(sharded.track_path(1, 2, ".mp3.part"), os.path.join(self.base_dir, "c4", "ca", "1", "2.mp3.part"))
+        with self.assertRaises(ValueError):
+            TrackStore.for_layout("nested", self.base_dir)
+
+    # User directories are created along with any missing parents (including base_dir), once.
+    def test_make_user_dir(self):
+        store = ShardedTrackStore(self.base_dir)
+        calls = []
+
+        def makedirs(path, exist_ok):
+            calls.append(path)
+            os.makedirs(path, exist_ok=exist_ok)
+
+        async def test():
+            real_run = store.run
+            store.run = lambda fn, *args, **kwargs: real_run(makedirs if fn is os.makedirs else fn, *args, **kwargs)
+            paths = await asyncio.gather(*[store.make_user_dir(1) for _ in range(5)])
+            self.assertEqual(await store.make_user_dir(1), paths[0])
+            return paths
+
+        paths = self.loop.run_until_complete(test())
+        self.assertTrue(os.path.isdir(paths[0]))
+        self.assertEqual(calls, [paths[0]])
+
+    # Scanning finds track files and partial downloads wherever they are, whatever layout saved them.
+    def test_scan(self):
+        store = ShardedTrackStore(self.base_dir)
+        paths = [TrackStore(self.base_dir).track_path(1, 10), store.track_path(2, 20),
+                 store.track_path(2, 21, ".mp3.part"), os.path.join(self.base_dir, "notes.mp3")]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "wb").close()
+
+        found = [entry for root in store.list_roots() for entry in store.scan(root, (".mp3", ".mp3.part"))]
+        self.assertEqual(sorted(found), [(10, ".mp3", paths[0]), (20, ".mp3", paths[1]), (21, ".mp3.part", paths[2])])
+        self.assertEqual(TrackStore(os.path.join(self.tmp_dir.name, "missing")).list_roots(), [])
+        self.assertEqual(sorted(self.loop.run_until_complete(store.find_files((".mp3", ".mp3.part")))), sorted(found))
+
+
+if __name__ == "__main__":
+    unittest.main()
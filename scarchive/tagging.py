@@ -0,0 +1,68 @@
+import io
+import logging
+
+from mutagen import MutagenError
+from mutagen.id3 import APIC, TALB, TPE1, TIT2, ID3
+from mutagen.mp3 import MP3
+
+# These are plain functions (rather than coroutines) so that they can run in a thread or process pool, off the
+# event loop.
+
+
+# We use the 500x500 artwork variant rather than the "large" default.
+def artwork_url(track):
+    if not track.artwork_url:
+        return None
+    return track.artwork_url.replace("-large.jpg", "-t500x500.jpg")
+
+
+# Add ID3 tags (title, artist, album and artwork) to an already downloaded track file. Returns True on success.
+def tag_track_file(track_file, track, artwork=None):
+    try:
+        mp3 = MP3(track_file, ID3=ID3)
+    except Exception as e:
+        logging.warning(
+            "user_id={} track_id={} uri={} Failed to parse MP3 from track file".format(track.user_id, track.id, track.uri))
+        return False
+
+    # Make sure this MP3 has valid ID3 tags header, etc. If the file already
+    # has valid ID3 tags, Mutagen will thrown an Exception, and we'll ignore it!
+    try:
+        mp3.add_tags()
+    except MutagenError:
+        logging.warning(
+            "user_id={} track_id={} uri={} Track file already has ID3 tags".format(track.user_id, track.id, track.uri))
+
+    add_tag_frames(mp3.tags, track, artwork)
+    mp3.save()
+    return True
+
+
+# Render a complete ID3v2 tag for track. Writing this to the start of the file before streaming the audio after it
+# tags the track without rewriting the file once the download is done. If the audio carries its own ID3 tag, it ends
+# up after ours; readers use the first tag they find.
+def build_id3_tag(track, artwork=None):
+    tags = ID3()
+    add_tag_frames(tags, track, artwork)
+    buf = io.BytesIO()
+    tags.save(buf, padding=lambda info: 0)
+    return buf.getvalue()
+
+
+# Return the total size of the ID3v2 tag that header (at least the first 10 bytes of a file) starts with, or 0.
+def id3_tag_size(header):
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    # The tag size is stored as a 28-bit "synchsafe" integer, excluding the 10 byte header (and footer, if any).
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    has_footer = header[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def add_tag_frames(tags, track, artwork=None):
+    # Set title, artist, and album (which is hardcoded to "Soundcloud Tracks").
+    tags.add(TIT2(encoding=3, text=track.title))
+    tags.add(TPE1(encoding=3, text=track.username))
+    tags.add(TALB(encoding=3, text=u"Soundcloud Tracks"))
+    if artwork:
+        tags.add(APIC(encoding=3, mime="image/jpeg", type=3, data=artwork))
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+from mutagen.mp3 import MP3
+
+from .tagging import build_id3_tag, id3_tag_size, tag_track_file
+from .track import Track
+
+# One silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz).
+MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+class TaggingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.track_file = os.path.join(self.tmp_dir.name, "1.mp3")
+        self.track = Track(
+            id=1,
+            permalink="https://soundcloud.com/1/1",
+            user_id=1,
+            username="fake user 1",
+            title="fake track 1",
+            uri=self.track_file,
+            artwork_url=None,
+            is_downloadable=False,
+            is_streamable=True)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_tag_track_file(self):
+        with open(self.track_file, "wb") as fd:
+            fd.write(MP3_FRAME * 100)
+        self.assertTrue(tag_track_file(self.track_file, self.track, artwork=b"jpeg"))
+        self.assertTags(MP3(self.track_file), artwork=b"jpeg")
+
+    # A tag built in memory and written ahead of the audio should read back the same as one added afterwards.
+    def test_build_id3_tag(self):
+        tag = build_id3_tag(self.track, artwork=b"jpeg" * 1000)
+        self.assertEqual(id3_tag_size(tag[:10]), len(tag))
+        with open(self.track_file, "wb") as fd:
+            fd.write(tag)
+            fd.write(MP3_FRAME * 100)
+        mp3 = MP3(self.track_file)
+        self.assertTags(mp3, artwork=b"jpeg" * 1000)
+        self.assertAlmostEqual(mp3.info.length, 2.6, delta=0.1)
+
+    def test_id3_tag_size_without_tag(self):
+        self.assertEqual(id3_tag_size(MP3_FRAME[:10]), 0)
+        self.assertEqual(id3_tag_size(b""), 0)
+
+    def test_tag_track_file_not_mp3(self):
+        with open(self.track_file, "wb") as fd:
+            fd.write(b"not an mp3")
+        self.assertFalse(tag_track_file(self.track_file, self.track))
+
+    def assertTags(self, mp3, artwork):
+        self.assertEqual(str(mp3.tags["TIT2"]), self.track.title)
+        self.assertEqual(str(mp3.tags["TPE1"]), self.track.username)
+        self.assertEqual(str(mp3.tags["TALB"]), "Soundcloud Tracks")
+        self.assertEqual(mp3.tags.getall("APIC")[0].data, artwork)
+
+
+if __name__ == "__main__":
+    unittest.main()
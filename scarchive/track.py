@@ -1,9 +1,11 @@
-from .user import User
-
-
 class Track(object):
 
-    def __init__(self, id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable):
+    # Slots rather than a per-instance __dict__, since archive scans create millions of these.
+    __slots__ = ("id", "permalink", "user_id", "username", "title", "uri", "artwork_url", "is_downloadable",
+                 "is_streamable", "created_at", "sha256")
+
+    def __init__(self, id, permalink, user_id, username, title, uri, artwork_url, is_downloadable, is_streamable,
+                 created_at=None, sha256=None):
         self.id = id
         self.permalink = permalink
         self.user_id = user_id
@@ -13,6 +15,9 @@ class Track(object):
         self.artwork_url = artwork_url
         self.is_downloadable = is_downloadable
         self.is_streamable = is_streamable
+        self.created_at = created_at
+        # The hash of the track's audio, once it's been downloaded (see dedup.AudioHash).
+        self.sha256 = sha256
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -24,28 +29,43 @@ class Track(object):
                     self.uri == other.uri and
                     self.artwork_url == other.artwork_url and
                     self.is_downloadable == other.is_downloadable and
-                    self.is_streamable == other.is_streamable)
+                    self.is_streamable == other.is_streamable and
+                    self.created_at == other.created_at and
+                    self.sha256 == other.sha256)
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.id)
+
+    def to_row(self):
+        return (self.id, self.permalink, self.user_id, self.username, self.title, self.uri, self.artwork_url,
+                self.is_downloadable, self.is_streamable, self.created_at, self.sha256)
+
     @staticmethod
     def from_row(row):
         return Track(*row)
 
+    # For use as a sqlite3 row_factory, so that cursors return Tracks directly.
+    @staticmethod
+    def row_factory(cursor, row):
+        return Track(*row)
+
+    # Only the fields we keep are read, straight out of the decoded JSON.
     @staticmethod
     def from_json(track_json):
-        track_user = User.from_json(track_json["user"])
-        fields_to_save = ["id", "permalink_url", "title", "artwork_url", "streamable", "downloadable"]
-        track_dict = {field: track_json[field] for field in fields_to_save if field in track_json}
+        get = track_json.get
+        track_user = track_json["user"]
         return Track(
-            id=track_dict["id"],
-            permalink=track_dict.get("permalink_url"),
-            user_id=track_user.id,
-            username=track_user.username,
-            title=track_dict.get("title"),
-            uri=None,
-            artwork_url=track_dict.get("artwork_url"),
-            is_downloadable=track_dict.get("downloadable"),
-            is_streamable=track_dict.get("streamable"))
+            track_json["id"],
+            get("permalink_url"),
+            track_user["id"],
+            track_user.get("username"),
+            get("title"),
+            None,
+            get("artwork_url"),
+            get("downloadable"),
+            get("streamable"),
+            get("created_at"))
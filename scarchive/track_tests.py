@@ -0,0 +1,48 @@
+import sqlite3
+import unittest
+
+from .track import Track
+from .user import User
+
+
+class TrackTests(unittest.TestCase):
+
+    def test_from_json(self):
+        track = Track.from_json({
+            "kind": "track",
+            "id": 1,
+            "permalink_url": "https://soundcloud.com/u/t",
+            "title": "t",
+            "artwork_url": None,
+            "downloadable": False,
+            "streamable": True,
+            "created_at": "2018/01/01 00:00:00 +0000",
+            "user": {"id": 2, "username": "u", "permalink": "u", "avatar_url": None},
+            "playback_count": 100,
+        })
+        self.assertEqual(track, Track(1, "https://soundcloud.com/u/t", 2, "u", "t", None, None, False, True,
+                                      "2018/01/01 00:00:00 +0000"))
+        self.assertEqual(User.from_json({"id": 2, "username": "u", "permalink": "u", "avatar_url": None, "kind": "user"}),
+                         User(2, "u", "u", None))
+
+    # Models are slotted and hashable, so they're small and can go in sets.
+    def test_slots_and_hashing(self):
+        track = Track(1, "p", 2, "u", "t", None, None, False, True)
+        self.assertFalse(hasattr(track, "__dict__"))
+        with self.assertRaises(AttributeError):
+            track.extra = 1
+        copy = Track.from_row(track.to_row())
+        self.assertEqual(len({track, copy}), 1)
+        self.assertEqual(len({User(1, "u", "u", None), User(1, "u", "u", None), User(2, "v", "v", None)}), 2)
+
+    def test_row_factory(self):
+        conn = sqlite3.connect(":memory:")
+        conn.row_factory = Track.row_factory
+        track = Track(1, "p", 2, "u", "t", "/tmp/1.mp3", None, 0, 1, None, "ab" * 32)
+        row = conn.execute("SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?", track.to_row()).fetchone()
+        self.assertEqual(row, track)
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
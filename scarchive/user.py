@@ -1,5 +1,7 @@
 class User(object):
 
+    __slots__ = ("id", "permalink", "username", "avatar_url")
+
     def __init__(self, id, username, permalink, avatar_url):
         self.id = id
         self.permalink = permalink
@@ -17,12 +19,18 @@ class User(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash(self.id)
+
     @staticmethod
     def from_row(row):
         return User(*row)
 
+    # For use as a sqlite3 row_factory, so that cursors return Users directly.
+    @staticmethod
+    def row_factory(cursor, row):
+        return User(*row)
+
     @staticmethod
     def from_json(user_json: dict):
-        fields_to_save = ["id", "permalink", "username", "avatar_url"]
-        user_dict = {field: user_json[field] for field in fields_to_save if field in user_json}
-        return User(**user_dict)
+        return User(user_json["id"], user_json["username"], user_json["permalink"], user_json["avatar_url"])
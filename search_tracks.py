@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+
+from scarchive import Archive
+
+
+def main(archive, query, limit=20, cursor=None, user_id=None, facets=False):
+    if facets:
+        for user_id, username, count in archive.search_facets(query, limit):
+            print("{}\t{}\t{}".format(count, user_id, username))
+        return
+
+    tracks, next_cursor = archive.search_tracks(query, limit, cursor, user_id)
+    for track in tracks:
+        print("{}\t{}\t{}\t{}".format(track.id, track.username, track.title, track.uri or track.permalink))
+    if next_cursor is not None:
+        print("# more results: --cursor={}".format(next_cursor))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the archive's tracks by title or artist.")
+    parser.add_argument("query", nargs="+", help="words to search for; each matches words starting with it")
+    parser.add_argument("--limit", type=int, default=20, help="number of results to show (default: 20)")
+    parser.add_argument("--cursor", help="show the results after a previous search's cursor")
+    parser.add_argument("--user-id", type=int, help="only search this user's tracks")
+    parser.add_argument("--facets", action="store_true", help="count matching tracks by user instead")
+    args = parser.parse_args()
+
+    archive = Archive(db_file=os.environ.get("SC_ARCHIVE_DB", "archive.db"))
+    try:
+        main(archive, " ".join(args.query), args.limit, args.cursor, args.user_id, args.facets)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        archive.close()
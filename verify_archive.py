@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+from scarchive import AsyncArchive, Job, JobQueue, TrackStore
+
+from archive_new_tracks import INLINE_TAGS_PART_SUFFIX, PART_SUFFIX
+
+
+# Reconcile the track files on disk against tracks.uri in the archive. Reports tracks whose file is missing, files
+# that no track points to (orphans), and leftover partial downloads. With requeue_missing, download jobs are queued
+# for the missing tracks, so the next archive_new_tracks.py run downloads them again.
+async def main(archive, store, requeue_missing=False):
+    files, tracks = await asyncio.gather(
+        store.find_files((".mp3", PART_SUFFIX, INLINE_TAGS_PART_SUFFIX)), list_archived_tracks(archive))
+
+    on_disk = dict((os.path.abspath(path), track_id) for track_id, suffix, path in files if suffix == ".mp3")
+    partials = [path for track_id, suffix, path in files if suffix != ".mp3"]
+    missing = [track for path, track in tracks.items() if path not in on_disk]
+    orphans = [path for path in on_disk if path not in tracks]
+
+    for track in missing:
+        logging.warning("user_id={} track_id={} uri={} Track file missing".format(track.user_id, track.id, track.uri))
+    for path in orphans:
+        logging.warning("path={} Orphaned track file".format(path))
+    for path in partials:
+        logging.info("path={} Partial download".format(path))
+
+    if requeue_missing and missing:
+        async with JobQueue(archive) as jobs:
+            await jobs.enqueue(Job.DOWNLOAD_TRACK, ((track.id, Job.track_payload(track)) for track in missing))
+        logging.info("requeued_count={} Requeued missing tracks".format(len(missing)))
+
+    summary = {
+        "tracks": len(tracks),
+        "files": len(on_disk),
+        "missing": len(missing),
+        "orphans": len(orphans),
+        "partials": len(partials),
+    }
+    logging.info("summary={} Verified archive".format(json.dumps(summary)))
+    return summary
+
+
+# Map the normalized path of every archived track file to its track.
+async def list_archived_tracks(archive):
+    tracks = {}
+    async for track in archive.list_all_tracks():
+        if track.uri:
+            tracks[os.path.abspath(track.uri)] = track
+    return tracks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the track files on disk against the archive.")
+    parser.add_argument("--requeue-missing", action="store_true", help="queue downloads for tracks whose file is missing")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    archive = AsyncArchive(db_file=os.environ.get("SC_ARCHIVE_DB", "archive.db"))
+    # Scanning doesn't depend on the layout, so this finds files saved under any of them.
+    store = TrackStore(os.environ.get("SC_ARCHIVE_DIR", "data"))
+
+    loop = asyncio.get_event_loop()
+    try:
+        summary = loop.run_until_complete(main(archive, store, args.requeue_missing))
+    finally:
+        loop.run_until_complete(archive.close())
+        loop.close()
+    if summary["missing"] or summary["orphans"]:
+        parser.exit(1)